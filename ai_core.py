@@ -0,0 +1,692 @@
+"""Core Multi-Role AI Assistant tanpa Streamlit.
+
+Role/model registry, system prompt, HTTP client OpenRouter, parser streaming,
+normalisasi usage, serta rate limiter dan scheduler upstream. Dipakai oleh
+final_project.py (UI Streamlit) dan batch_inference.py (CLI batch).
+"""
+import json
+import time
+import random
+import threading
+import functools
+from collections import OrderedDict, deque
+from dataclasses import dataclass, fields
+from email.utils import parsedate_to_datetime
+from types import MappingProxyType
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+# ===========================
+# ROLE CONFIGURATIONS (3 ROLES ONLY)
+# ===========================
+# Data bawaan; load_registry membangun RoleConfig beku dari sini (+ file registry opsional)
+DEFAULT_ROLE_CONFIGS = {
+    "assistant": {
+        "name": "👾 Asisten Umum",
+        "icon": "👾",
+        "color": "#182c7a",
+        "gradient": "linear-gradient(135deg, #182c7a, #1d2f7e)",
+        "description": "Bantuan umum untuk berbagai keperluan",
+        "system_message": """Kamu adalah AI Assistant yang helpful dan efisien. Kamu bertugas memberikan jawaban yang SINGKAT, JELAS, dan LANGSUNG KE INTI.
+
+PENTING - ATURAN RESPONS:
+1. JAWAB MAKSIMAL 2-3 KALIMAT untuk pertanyaan sederhana
+2. LANGSUNG ke point utama tanpa pembukaan panjang
+3. HINDARI penjelasan berlebihan kecuali diminta detail
+4. GUNAKAN bullet points hanya jika benar-benar perlu
+5. BERIKAN jawaban praktis yang bisa langsung diterapkan
+
+PERSONALITY: Ramah tapi efisien, informatif tapi tidak bertele-tele.
+
+CAPABILITIES: 
+- Menjawab pertanyaan umum dengan singkat
+- Memberikan saran praktis
+- Tips efektif tanpa panjang lebar
+- Informasi akurat dan to-the-point
+
+Berikan respons yang helpful namun SINGKAT dan EFISIEN.""",
+        "recommended_models": ["mistralai/mistral-7b-instruct:free", "google/gemma-7b-it:free", "meta-llama/llama-3-8b-instruct:free"],
+        "default_temperature": 0.3,  # Lebih rendah untuk jawaban lebih konsisten
+        "default_max_tokens": 150,   # Lebih rendah untuk jawaban lebih singkat
+        "sample_questions": [
+            "Bagaimana cara meningkatkan produktivitas kerja?",
+            "Apa tips mengatur waktu yang efektif?",
+            "Rekomendasi aplikasi untuk belajar bahasa asing"
+        ]
+    },
+    "guru": {
+        "name": "👨‍🏫 Guru",
+        "icon": "👨‍🏫",
+        "color": "#233382",
+        "gradient": "linear-gradient(135deg, #233382, #283686)",
+        "description": "Pendidikan & pembelajaran interaktif",
+        "system_message": """Kamu adalah Prof. AI, guru yang mengajar dengan EFISIEN dan LANGSUNG KE INTI.
+
+PENTING - ATURAN MENGAJAR:
+1. JAWAB MAKSIMAL 2-3 KALIMAT untuk konsep sederhana
+2. LANGSUNG jelaskan inti materi tanpa pembukaan panjang
+3. GUNAKAN analogi sederhana hanya jika benar-benar membantu
+4. BERIKAN contoh SINGKAT dan KONKRET
+5. HINDARI teori berlebihan, fokus pada pemahaman praktis
+
+TEACHING APPROACH:
+- Langsung ke definisi/konsep utama
+- Contoh singkat dan mudah dipahami
+- Aplikasi praktis dalam 1-2 kalimat
+- Motivasi singkat hanya jika relevan
+
+PERSONALITY: Sabar, jelas, tapi tidak bertele-tele.
+
+Berikan penjelasan yang MUDAH DIPAHAMI namun SINGKAT dan EFEKTIF.""",
+        "recommended_models": ["mistralai/mistral-7b-instruct:free", "google/gemma-7b-it:free", "meta-llama/llama-3-8b-instruct:free"],
+        "default_temperature": 0.4,
+        "default_max_tokens": 200,
+        "sample_questions": [
+            "Jelaskan konsep photosynthesis dengan analogi sederhana",
+            "Strategi belajar matematika yang efektif untuk siswa SMA",
+            "Bagaimana cara menulis essay yang baik dan benar?"
+        ]
+    },
+    "programmer": {
+        "name": "👩‍💻 Programmer",
+        "icon": "👩‍💻",
+        "color": "#2d398a",
+        "gradient": "linear-gradient(135deg, #2d398a, #323d8e)",
+        "description": "Coding, debugging & tech solutions",
+        "system_message": """Kamu adalah Senior Dev AI yang memberikan solusi coding SINGKAT dan EFEKTIF.
+
+PENTING - ATURAN CODING:
+1. JAWAB MAKSIMAL 1-2 KALIMAT penjelasan untuk pertanyaan sederhana
+2. LANGSUNG berikan kode/solusi tanpa penjelasan panjang
+3. GUNAKAN comment dalam kode untuk penjelasan singkat
+4. FOKUS pada solusi yang WORKING dan PRAKTIS
+5. HINDARI penjelasan teori panjang kecuali diminta
+
+CODING APPROACH:
+- Working code first dengan comment singkat
+- Penjelasan teknis minimal tapi jelas
+- Best practices dalam comment
+- Alternative approach hanya jika diminta
+
+PERSONALITY: Logical, solution-focused, straight to the point.
+
+Berikan solusi coding yang EFEKTIF dan LANGSUNG APPLICABLE.""",
+        "recommended_models": ["mistralai/mistral-7b-instruct:free", "google/gemma-7b-it:free", "meta-llama/llama-3-8b-instruct:free"],
+        "default_temperature": 0.2,  # Sangat rendah untuk kode yang konsisten
+        "default_max_tokens": 250,
+        "sample_questions": [
+            "Bagaimana cara optimasi performa query database yang lambat?",
+            "Jelaskan perbedaan async/await dan Promise di JavaScript",
+            "Review dan improve kode Python saya untuk bug dan performance"
+        ]
+    }
+}
+
+# ===========================
+# MODEL CONFIGURATIONS
+# ===========================
+DEFAULT_MODELS = {
+    # ⭐ GRATIS - Recommended untuk pemula
+    "mistralai/mistral-7b-instruct:free": "🆓 Mistral 7B (Free) ⭐",
+    "google/gemma-7b-it:free": "🆓 Google Gemma 7B (Free)",
+    "meta-llama/llama-3-8b-instruct:free": "🆓 Llama 3 8B (Free)",
+    "huggingface/zephyr-7b-beta:free": "🆓 Zephyr 7B (Free)",
+    "openchat/openchat-7b:free": "🆓 OpenChat 7B (Free)",
+    
+    # 💰 PREMIUM - Perlu kredit
+    "openai/gpt-4o": "💰 GPT-4o (Premium)",
+    "openai/gpt-4o-mini": "💰 GPT-4o Mini (Premium)", 
+    "anthropic/claude-3.5-sonnet": "💰 Claude 3.5 Sonnet (Premium)",
+    "anthropic/claude-3-haiku": "💰 Claude 3 Haiku (Premium)",
+    "google/gemini-pro": "💰 Gemini Pro (Premium)",
+    "mistralai/mistral-large": "💰 Mistral Large (Premium)",
+    "mistralai/codestral": "💰 Codestral (Premium)"
+}
+
+MODEL_CONTEXT_LIMITS = {  # Bawaan; bisa ditimpa per model lewat file registry (context_limit)
+    "mistralai/mistral-7b-instruct:free": 32768,
+    "google/gemma-7b-it:free": 8192,
+    "meta-llama/llama-3-8b-instruct:free": 8192,
+    "huggingface/zephyr-7b-beta:free": 4096,
+    "openchat/openchat-7b:free": 8192,
+    "openai/gpt-4o": 128000,
+    "openai/gpt-4o-mini": 128000,
+    "anthropic/claude-3.5-sonnet": 200000,
+    "anthropic/claude-3-haiku": 200000,
+    "google/gemini-pro": 32768,
+    "mistralai/mistral-large": 128000,
+    "mistralai/codestral": 32768,
+}
+
+# ===========================
+# ROLE & MODEL REGISTRY
+# ===========================
+PROMPT_CACHE_PREFIXES = ("anthropic/",)  # Provider yang butuh penanda cache_control eksplisit
+
+@dataclass(frozen=True, slots=True)
+class RoleConfig:
+    """Konfigurasi satu role AI (immutable)"""
+    key: str
+    name: str
+    icon: str
+    color: str
+    gradient: str
+    description: str
+    system_message: str
+    recommended_models: tuple
+    default_temperature: float
+    default_max_tokens: int
+    sample_questions: tuple
+
+@dataclass(frozen=True, slots=True)
+class ModelConfig:
+    """Satu model OpenRouter beserta label UI dan batas context-nya"""
+    id: str
+    label: str
+    context_limit: int = None
+    prompt_cache: bool = False  # Kirim penanda cache_control (prompt caching eksplisit, mis. Anthropic)
+
+@dataclass(frozen=True, slots=True)
+class Registry:
+    """Snapshot role & model yang sudah dibangun; dibagi antar session tanpa disalin"""
+    roles: MappingProxyType
+    models: MappingProxyType
+    model_labels: MappingProxyType
+    source: str = None
+    mtime: float = None
+
+ROLE_FIELDS = tuple(field.name for field in fields(RoleConfig) if field.name != "key")
+
+def build_role_config(key, entry, base=None):
+    """RoleConfig dari dict; field yang tidak ada diambil dari role bawaan dengan key sama"""
+    data = dict(base or {})
+    data.update(entry)
+    unknown = set(data) - set(ROLE_FIELDS)
+    missing = set(ROLE_FIELDS) - set(data)
+    if unknown or missing:
+        raise ValueError(f"Role '{key}': field tidak dikenal {sorted(unknown)}, field kurang {sorted(missing)}")
+    data["recommended_models"] = tuple(data["recommended_models"])
+    data["sample_questions"] = tuple(data["sample_questions"])
+    data["default_temperature"] = float(data["default_temperature"])
+    data["default_max_tokens"] = int(data["default_max_tokens"])
+    return RoleConfig(key=key, **data)
+
+def build_model_config(model_id, entry, base=None):
+    """ModelConfig dari label string atau dict {label, context_limit, prompt_cache}"""
+    if isinstance(entry, str):
+        entry = {"label": entry}
+    label = entry.get("label", base.label if base else model_id)
+    context_limit = entry.get("context_limit", base.context_limit if base else None)
+    prompt_cache = entry.get("prompt_cache", base.prompt_cache if base else model_id.startswith(PROMPT_CACHE_PREFIXES))
+    return ModelConfig(model_id, label, int(context_limit) if context_limit else None, bool(prompt_cache))
+
+def read_registry_file(path):
+    """Baca file registry JSON atau YAML (YAML butuh PyYAML)"""
+    with open(path, "r", encoding="utf-8") as f:
+        if path.endswith((".yaml", ".yml")):
+            if yaml is None:
+                raise RuntimeError("PyYAML belum terpasang; pakai registry .json atau pip install pyyaml")
+            data = yaml.safe_load(f) or {}
+        else:
+            data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("File registry harus berisi object dengan key 'roles' dan/atau 'models'")
+    return data
+
+def load_registry(path=None, mtime=None):
+    """Bangun Registry dari data bawaan, lalu tambah/timpa dengan isi file registry (jika ada)"""
+    roles = {key: build_role_config(key, entry) for key, entry in DEFAULT_ROLE_CONFIGS.items()}
+    models = {
+        model_id: ModelConfig(model_id, label, MODEL_CONTEXT_LIMITS.get(model_id),
+                              model_id.startswith(PROMPT_CACHE_PREFIXES))
+        for model_id, label in DEFAULT_MODELS.items()
+    }
+    if path and mtime is not None:
+        data = read_registry_file(path)
+        for key, entry in (data.get("roles") or {}).items():
+            roles[key] = build_role_config(key, entry, DEFAULT_ROLE_CONFIGS.get(key))
+        for model_id, entry in (data.get("models") or {}).items():
+            models[model_id] = build_model_config(model_id, entry, models.get(model_id))
+    return Registry(
+        roles=MappingProxyType(roles),
+        models=MappingProxyType(models),
+        model_labels=MappingProxyType({model_id: model.label for model_id, model in models.items()}),
+        source=path,
+        mtime=mtime,
+    )
+
+# ===========================
+# SYSTEM PROMPT & PAYLOAD
+# ===========================
+@functools.lru_cache(maxsize=256)
+def build_system_prompt(base_message, user_name):
+    """System prompt per (role, user), dirakit sekali dan identik byte per byte di setiap giliran"""
+    # Bagian yang sama untuk semua user di depan, nama di akhir: prefix terpanjang bisa di-cache provider
+    name_context = f"\n\nNama pengguna adalah {user_name}." if user_name else ""
+    return f"""{base_message}
+
+WAJIB DIINGAT:
+- Panggil pengguna dengan nama mereka jika ada
+- SELALU berikan respons SINGKAT dan EFISIEN
+- MAKSIMAL 2-3 kalimat untuk pertanyaan sederhana
+- LANGSUNG ke inti tanpa pembukaan panjang
+- HINDARI penjelasan berlebihan
+- FOKUS pada jawaban praktis dan aplikatif{name_context}"""
+
+def auth_headers(api_key):
+    """Header request OpenRouter"""
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+
+def build_payload(model, messages, max_tokens, temperature, stream=False, user=None):
+    """Payload chat completion OpenRouter"""
+    payload = {
+        "model": model,
+        "messages": messages,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "usage": {"include": True},  # Minta OpenRouter melaporkan tokens & cost
+    }
+    if user:
+        # Identitas end-user untuk OpenRouter dan scheduler (API key dipakai bersama)
+        payload["user"] = user
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def add_cache_markers(messages):
+    """Salinan messages dengan cache_control di system prompt dan di akhir riwayat sebelum prompt baru"""
+    marked = [dict(message) for message in messages]
+    breakpoints = {0}
+    if len(marked) > 2:
+        breakpoints.add(len(marked) - 2)
+    for i in breakpoints:
+        if isinstance(marked[i]["content"], str):
+            marked[i]["content"] = [{
+                "type": "text",
+                "text": marked[i]["content"],
+                "cache_control": {"type": "ephemeral"},
+            }]
+    return marked
+
+def apply_prompt_cache(payload, model_config):
+    """Salinan payload untuk model_config; tambah penanda prompt caching jika model memintanya"""
+    model_payload = dict(payload, model=model_config.id)
+    if model_config.prompt_cache:
+        model_payload["messages"] = add_cache_markers(payload["messages"])
+    return model_payload
+
+# ===========================
+# HTTP CLIENT (POOLED)
+# ===========================
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+def parse_retry_after(response):
+    """Parse header Retry-After (detik atau HTTP-date), None jika tidak ada/invalid"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+class OpenRouterClient:
+    """HTTP client OpenRouter dengan connection pooling, timeout, dan retry"""
+
+    def __init__(self, base_url=OPENROUTER_BASE_URL, connect_timeout=5.0, read_timeout=60.0,
+                 max_retries=3, backoff_base=0.5, max_backoff=8.0, max_retry_after=30.0,
+                 pool_maxsize=20):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.max_retry_after = max_retry_after
+        
+        # Satu Session = satu pool koneksi keep-alive yang dipakai ulang antar request
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        
+        self._lock = threading.Lock()
+        self._metrics = {"requests": 0, "attempts": 0, "retries": 0, "errors": 0}
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._metrics[key] += n
+
+    def _backoff_delay(self, attempt):
+        """Exponential backoff dengan full jitter"""
+        return random.uniform(0, min(self.max_backoff, self.backoff_base * (2 ** attempt)))
+
+    def post(self, path, headers, payload, stream=False, max_retries=None):
+        """POST JSON ke OpenRouter dengan retry untuk 429/5xx dan gagal koneksi"""
+        self._count("requests")
+        url = f"{self.base_url}{path}"
+        body = json.dumps(payload)
+        if max_retries is None:
+            max_retries = self.max_retries
+        
+        for attempt in range(max_retries + 1):
+            self._count("attempts")
+            try:
+                response = self.session.post(url, headers=headers, data=body,
+                                             timeout=self.timeout, stream=stream)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ConnectTimeout):
+                # Request belum sampai ke upstream, aman untuk diulang
+                if attempt >= max_retries:
+                    self._count("errors")
+                    raise
+                delay = self._backoff_delay(attempt)
+            except requests.exceptions.RequestException:
+                self._count("errors")
+                raise
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                    if response.status_code >= 400:
+                        self._count("errors")
+                        response.close()
+                    response.raise_for_status()
+                    return response
+                delay = parse_retry_after(response)
+                response.close()
+                if delay is None:
+                    delay = self._backoff_delay(attempt)
+                elif delay > self.max_retry_after:
+                    # Upstream minta tunggu terlalu lama, lebih baik gagal cepat
+                    self._count("errors")
+                    response.raise_for_status()
+            self._count("retries")
+            time.sleep(delay)
+
+    def post_chat(self, headers, payload, stream=False, max_retries=None):
+        """POST ke endpoint /chat/completions"""
+        return self.post("/chat/completions", headers, payload, stream=stream, max_retries=max_retries)
+
+    def stats(self):
+        """Metrics client: request, retry, dan pemakaian ulang koneksi pool"""
+        new_connections = 0
+        pooled_requests = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                new_connections += pool.num_connections
+                pooled_requests += pool.num_requests
+        with self._lock:
+            stats = dict(self._metrics)
+        stats["new_connections"] = new_connections
+        stats["pool_hits"] = max(0, pooled_requests - new_connections)
+        return stats
+
+    def close(self):
+        self.session.close()
+
+class UpstreamError(RuntimeError):
+    """Error yang dilaporkan provider di body respons atau di tengah stream (HTTP 200)"""
+
+    def __init__(self, error):
+        error = error if isinstance(error, dict) else {"message": error}
+        super().__init__(error.get("message", error))
+        try:
+            self.code = int(error.get("code"))  # Status HTTP yang setara menurut OpenRouter, jika ada
+        except (TypeError, ValueError):
+            self.code = None
+
+def complete(client, headers, payload, max_retries=None):
+    """Request non-streaming; return (teks, usage mentah dari API)"""
+    data = client.post_chat(headers, payload, max_retries=max_retries).json()
+    if "error" in data:
+        raise UpstreamError(data["error"])
+    return data["choices"][0]["message"]["content"], data.get("usage")
+
+# ===========================
+# STREAMING (SSE)
+# ===========================
+def iter_sse_data(response):
+    """Parse body Server-Sent Events, yield setiap payload 'data:' yang sudah di-decode"""
+    for line in response.iter_lines():
+        # Baris kosong = pemisah event, ':' = komentar keep-alive dari OpenRouter
+        if not line or line.startswith(b":"):
+            continue
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip().decode("utf-8")
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+
+def iter_stream_chunks(response):
+    """Yield (delta_teks, usage) dari stream chat completion; usage biasanya hanya di chunk terakhir"""
+    for chunk in iter_sse_data(response):
+        if "error" in chunk:
+            raise UpstreamError(chunk["error"])
+        choices = chunk.get("choices") or [{}]
+        delta = (choices[0].get("delta") or {}).get("content")
+        yield delta or "", chunk.get("usage")
+
+# ===========================
+# USAGE
+# ===========================
+def normalize_usage(usage):
+    """Ambil field usage OpenRouter yang relevan (tokens + cost) dalam bentuk angka"""
+    if not usage:
+        return None
+    return {
+        "prompt_tokens": int(usage.get("prompt_tokens") or 0),
+        "completion_tokens": int(usage.get("completion_tokens") or 0),
+        "total_tokens": int(usage.get("total_tokens") or 0)
+                        or int(usage.get("prompt_tokens") or 0) + int(usage.get("completion_tokens") or 0),
+        "cost": float(usage.get("cost") or 0.0),
+        # Token prompt yang dilayani dari prompt cache provider (lebih murah & prefill lebih cepat)
+        "cached_tokens": int((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0),
+    }
+
+# ===========================
+# UPSTREAM LIMITS (SCHEDULER & RATE LIMIT)
+# ===========================
+SCHEDULER_POLL_INTERVAL = 0.25  # Detik antar update posisi antrean ke UI
+
+class UpstreamBusyError(Exception):
+    """Tidak mendapat slot upstream (antrean penuh atau batas waktu tunggu habis)"""
+
+class RateLimitedError(UpstreamBusyError):
+    """Kuota rate per key/model habis; ditolak sebelum request dikirim"""
+
+class FairScheduler:
+    """Batasi request upstream yang berjalan (global & per user), bagi slot kosong round-robin antar user"""
+
+    def __init__(self, max_concurrent=16, max_per_user=4, max_waiting=64):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_waiting = max_waiting
+        self._cond = threading.Condition()
+        self._active = {}              # user -> request yang sedang berjalan
+        self._waiting = OrderedDict()  # user -> deque tiket, urutan = giliran round-robin
+        self._granted = set()
+        self._metrics = {"granted": 0, "queued": 0, "timeouts": 0, "rejected": 0}
+
+    def _in_flight(self):
+        return sum(self._active.values())
+
+    def _dispatch(self):
+        # Satu slot per user per putaran, user yang baru dilayani pindah ke belakang antrean
+        granted = False
+        while self._in_flight() < self.max_concurrent:
+            for user, tickets in self._waiting.items():
+                if self._active.get(user, 0) < self.max_per_user:
+                    break
+            else:
+                break
+            ticket = tickets.popleft()
+            if tickets:
+                self._waiting.move_to_end(user)
+            else:
+                del self._waiting[user]
+            self._active[user] = self._active.get(user, 0) + 1
+            self._granted.add(ticket)
+            self._metrics["granted"] += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _position(self, user, ticket):
+        """Perkiraan urutan tiket dalam giliran round-robin (1 = berikutnya dilayani)"""
+        user_order = list(self._waiting)
+        mine = self._waiting[user]
+        index = mine.index(ticket)
+        ahead = index
+        my_turn = user_order.index(user)
+        for turn, other in enumerate(user_order):
+            if other != user:
+                ahead += min(len(self._waiting[other]), index + (1 if turn < my_turn else 0))
+        return ahead + 1
+
+    def acquire(self, user, timeout=None, on_wait=None):
+        """True jika dapat slot, False jika timeout; UpstreamBusyError jika antrean penuh.
+
+        on_wait(posisi) dipanggil di luar lock setiap kali posisi antrean berubah.
+        """
+        ticket = object()
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with self._cond:
+            waiting = sum(len(tickets) for tickets in self._waiting.values())
+            if self.max_waiting is not None and waiting >= self.max_waiting:
+                # Backpressure: tolak sekarang daripada timeout belakangan
+                self._metrics["rejected"] += 1
+                raise UpstreamBusyError(f"Antrean request penuh ({waiting} menunggu), coba lagi sebentar lagi")
+            self._waiting.setdefault(user, deque()).append(ticket)
+            self._dispatch()
+            if ticket not in self._granted:
+                self._metrics["queued"] += 1
+        last_position = None
+        while True:
+            with self._cond:
+                if ticket in self._granted:
+                    self._granted.discard(ticket)
+                    return True
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    # Timeout: keluar dari antrean
+                    tickets = self._waiting[user]
+                    tickets.remove(ticket)
+                    if not tickets:
+                        del self._waiting[user]
+                    self._metrics["timeouts"] += 1
+                    return False
+                position = self._position(user, ticket)
+            if on_wait is not None and position != last_position:
+                on_wait(position)
+                last_position = position
+            with self._cond:
+                if ticket not in self._granted:
+                    wait = SCHEDULER_POLL_INTERVAL if remaining is None else min(SCHEDULER_POLL_INTERVAL, remaining)
+                    self._cond.wait(wait)
+
+    def release(self, user):
+        with self._cond:
+            self._active[user] -= 1
+            if not self._active[user]:
+                del self._active[user]
+            self._dispatch()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._metrics)
+            stats["in_flight"] = self._in_flight()
+            stats["waiting"] = sum(len(tickets) for tickets in self._waiting.values())
+            stats["active_users"] = len(self._active)
+            return stats
+
+class TokenBucket:
+    """Token bucket: `rate_per_min` request per menit dengan burst sampai `capacity`"""
+
+    def __init__(self, rate_per_min, capacity=None):
+        self.rate = rate_per_min / 60.0
+        self.capacity = float(capacity or rate_per_min)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Detik sampai satu token tersedia (token boleh dipesan di muka, jadi bisa negatif)"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def drain(self, now, seconds):
+        """Kosongkan bucket selama `seconds` (mis. setelah 429 dengan Retry-After)"""
+        self._refill(now)
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+class RateLimiter:
+    """Rate limit sisi client per API key dan per (key, model), dengan penolakan dini"""
+
+    def __init__(self, key_rpm=0, model_rpm=0, free_model_rpm=20, max_wait=10.0):
+        self.key_rpm = key_rpm
+        self.model_rpm = model_rpm
+        self.free_model_rpm = free_model_rpm
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._metrics = {"allowed": 0, "delayed": 0, "rejected": 0, "throttled_429": 0}
+
+    def _model_limit(self, model):
+        return self.free_model_rpm if model.endswith(":free") else self.model_rpm
+
+    def _get_buckets(self, key_id, model):
+        # rpm 0 = tanpa batas untuk level tersebut
+        buckets = []
+        for bucket_key, rpm in (((key_id,), self.key_rpm), ((key_id, model), self._model_limit(model))):
+            if rpm:
+                if bucket_key not in self._buckets:
+                    self._buckets[bucket_key] = TokenBucket(rpm)
+                buckets.append(self._buckets[bucket_key])
+        return buckets
+
+    def reserve(self, key_id, model):
+        """Return (diizinkan, detik tunggu). Ditolak tanpa memakai kuota jika tunggu > max_wait"""
+        now = time.monotonic()
+        with self._lock:
+            buckets = self._get_buckets(key_id, model)
+            wait = max((bucket.wait_time(now) for bucket in buckets), default=0.0)
+            if wait > self.max_wait:
+                self._metrics["rejected"] += 1
+                return False, wait
+            for bucket in buckets:
+                bucket.take()
+            self._metrics["delayed" if wait > 0 else "allowed"] += 1
+            return True, wait
+
+    def penalize(self, key_id, model, seconds):
+        """Upstream membalas 429: tahan request berikutnya ke key/model ini selama `seconds`"""
+        now = time.monotonic()
+        with self._lock:
+            self._metrics["throttled_429"] += 1
+            for bucket in self._get_buckets(key_id, model):
+                bucket.drain(now, seconds)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._metrics)
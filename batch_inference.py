@@ -0,0 +1,183 @@
+"""Batch inference headless: jalankan prompt dari file JSONL ke role/model OpenRouter.
+
+Contoh:
+    python batch_inference.py prompts.jsonl hasil.jsonl --role programmer \
+        --model mistralai/mistral-7b-instruct:free --concurrency 8
+
+Setiap baris input berisi {"id": "...", "prompt": "..."} dan boleh menimpa
+"role", "model", "temperature", "max_tokens" atau "user_name" per baris.
+Hasil ditulis satu baris per prompt segera setelah selesai. Menjalankan ulang
+perintah yang sama melanjutkan dari id yang belum sukses (resume).
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+
+from ai_core import (
+    OPENROUTER_BASE_URL, OpenRouterClient, RateLimiter, load_registry, build_system_prompt,
+    auth_headers, build_payload, apply_prompt_cache, complete, normalize_usage, parse_retry_after,
+)
+
+PROGRESS_EVERY = 50  # Cetak progres ke stderr tiap N prompt selesai
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch inference prompt JSONL lewat OpenRouter")
+    parser.add_argument("input", help="File JSONL berisi prompt")
+    parser.add_argument("output", help="File JSONL hasil (di-append, dipakai juga untuk resume)")
+    parser.add_argument("--role", default="assistant", help="Key role dari registry (default: assistant)")
+    parser.add_argument("--model", default=None, help="Model OpenRouter (default: rekomendasi pertama role)")
+    parser.add_argument("--temperature", type=float, default=None, help="Default: temperature bawaan role")
+    parser.add_argument("--max-tokens", type=int, default=None, help="Default: max tokens bawaan role")
+    parser.add_argument("--user-name", default="", help="Nama pengguna di system prompt")
+    parser.add_argument("--concurrency", type=int, default=4, help="Request paralel (default: 4)")
+    parser.add_argument("--api-key", default=os.environ.get("OPENROUTER_API_KEY"),
+                        help="API key OpenRouter (default: env OPENROUTER_API_KEY)")
+    parser.add_argument("--base-url", default=os.environ.get("OPENROUTER_BASE_URL", OPENROUTER_BASE_URL))
+    parser.add_argument("--registry", default=None, help="File registry role/model (JSON/YAML)")
+    parser.add_argument("--max-retries", type=int, default=3, help="Retry per request untuk 429/5xx")
+    parser.add_argument("--free-rpm", type=int, default=20, help="Batas request/menit model :free (0 = tanpa batas)")
+    parser.add_argument("--model-rpm", type=int, default=0, help="Batas request/menit model berbayar (0 = tanpa batas)")
+    parser.add_argument("--skip-errors", action="store_true",
+                        help="Saat resume, jangan ulangi id yang sebelumnya gagal")
+    return parser.parse_args(argv)
+
+def iter_prompts(path):
+    """Yield record prompt dari JSONL; id default 'line-N' jika tidak ada"""
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if isinstance(record, str):
+                record = {"prompt": record}
+            record.setdefault("id", f"line-{line_number}")
+            yield record
+
+def load_finished_ids(path, skip_errors=False):
+    """Id yang sudah selesai di file output; buang baris terakhir yang terpotong (crash saat menulis)"""
+    finished = set()
+    if not os.path.exists(path):
+        return finished
+    with open(path, "rb+") as f:
+        data = f.read()
+        complete_size = data.rfind(b"\n") + 1
+        if complete_size < len(data):
+            f.truncate(complete_size)
+    for line in data[:complete_size].decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        if result.get("status") == "ok" or skip_errors:
+            finished.add(str(result["id"]))
+        else:
+            finished.discard(str(result["id"]))
+    return finished
+
+def build_request(registry, args, record):
+    """Return (role, model, payload) untuk satu record; nilai per baris menimpa argumen CLI"""
+    role_key = record.get("role", args.role)
+    role = registry.roles[role_key]
+    model = record.get("model") or args.model or role.recommended_models[0]
+    temperature = record.get("temperature", args.temperature)
+    max_tokens = record.get("max_tokens", args.max_tokens)
+    messages = [
+        {"role": "system", "content": build_system_prompt(role.system_message, record.get("user_name", args.user_name))},
+        {"role": "user", "content": record["prompt"]},
+    ]
+    payload = build_payload(
+        model,
+        messages,
+        max_tokens if max_tokens is not None else role.default_max_tokens,
+        temperature if temperature is not None else role.default_temperature,
+    )
+    if model in registry.models:
+        payload = apply_prompt_cache(payload, registry.models[model])
+    return role_key, model, payload
+
+def run_prompt(client, limiter, registry, args, record):
+    """Jalankan satu prompt; selalu return dict hasil (error dicatat, bukan dilempar)"""
+    result = {"id": record["id"], "role": record.get("role", args.role), "model": record.get("model") or args.model}
+    started = time.monotonic()
+    try:
+        result["role"], result["model"], payload = build_request(registry, args, record)
+        # max_wait tak terbatas: di batch lebih baik menunggu kuota daripada menolak
+        _, delay = limiter.reserve("batch", result["model"])
+        if delay > 0:
+            time.sleep(delay)
+        started = time.monotonic()
+        text, usage = complete(client, auth_headers(args.api_key), payload)
+    except Exception as e:
+        if isinstance(e, requests.exceptions.HTTPError) and e.response is not None and e.response.status_code == 429:
+            retry_after = parse_retry_after(e.response)
+            limiter.penalize("batch", result["model"], retry_after if retry_after is not None else 60.0)
+        result.update(status="error", error=f"{type(e).__name__}: {e}", latency=round(time.monotonic() - started, 3))
+        return result
+    result.update(
+        status="ok",
+        response=text,
+        usage=normalize_usage(usage),
+        latency=round(time.monotonic() - started, 3),
+    )
+    return result
+
+def main(argv=None):
+    args = parse_args(argv)
+    if not args.api_key:
+        sys.exit("API key OpenRouter wajib diisi (--api-key atau env OPENROUTER_API_KEY)")
+    registry_mtime = os.path.getmtime(args.registry) if args.registry else None
+    registry = load_registry(args.registry, registry_mtime)
+    if args.role not in registry.roles:
+        sys.exit(f"Role '{args.role}' tidak ada. Pilihan: {', '.join(registry.roles)}")
+
+    client = OpenRouterClient(base_url=args.base_url, max_retries=args.max_retries,
+                              pool_maxsize=max(args.concurrency, 10))
+    limiter = RateLimiter(model_rpm=args.model_rpm, free_model_rpm=args.free_rpm, max_wait=float("inf"))
+    finished = load_finished_ids(args.output, args.skip_errors)
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    totals = {"prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+    started = time.monotonic()
+
+    def write_result(out, result):
+        out.write(json.dumps(result, ensure_ascii=False) + "\n")
+        out.flush()
+        counts[result["status"]] += 1
+        for field in totals:
+            totals[field] += (result.get("usage") or {}).get(field, 0)
+        done = counts["ok"] + counts["error"]
+        if done % PROGRESS_EVERY == 0:
+            rate = done / (time.monotonic() - started)
+            print(f"[{done}] ok {counts['ok']} · error {counts['error']} · {rate:.1f} prompt/s", file=sys.stderr)
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor, \
+            open(args.output, "a", encoding="utf-8") as out:
+        pending = set()
+        for record in iter_prompts(args.input):
+            if str(record["id"]) in finished:
+                counts["skipped"] += 1
+                continue
+            # Batasi future yang menunggu agar input besar tidak dimuat sekaligus ke memori
+            if len(pending) >= args.concurrency * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    write_result(out, future.result())
+            pending.add(executor.submit(run_prompt, client, limiter, registry, args, record))
+        for future in pending:
+            write_result(out, future.result())
+
+    elapsed = time.monotonic() - started
+    print(
+        f"Selesai dalam {elapsed:.1f}s: ok {counts['ok']}, error {counts['error']}, "
+        f"dilewati {counts['skipped']} · tokens {totals['prompt_tokens']} + {totals['completion_tokens']} "
+        f"· biaya ${totals['cost']:.4f}",
+        file=sys.stderr,
+    )
+    return 1 if counts["error"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,434 @@
+"""Benchmark pipeline chat terhadap mock OpenRouter lokal, hasil JSON yang bisa dibandingkan.
+
+Contoh:
+    python benchmark.py --output bench-baseline.json
+    python benchmark.py --baseline bench-baseline.json   # exit 1 jika ada regresi
+
+Skenario (--scenarios):
+    turn        latency end-to-end satu giliran chat lewat app Streamlit (AppTest),
+                mode streaming dan non-streaming, plus span TurnTimer (headers, ttfb, render, total)
+    rerun       biaya rerun render_sidebar / render_chat_history terhadap panjang history room
+    render      markdown → HTML per pesan tanpa cache vs window rerun yang dilayani RenderCache
+    throughput  N session paralel lewat ai_core (scheduler + client bersama), giliran/detik
+    archive     round-trip export/import room ke JSONL.gz (SQLite), pesan/detik dan puncak memori
+
+Semua waktu dalam detik. Metric *_per_sec makin besar makin baik, sisanya makin kecil makin baik.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from dataclasses import asdict
+from datetime import datetime
+
+import streamlit
+from streamlit.testing.v1 import AppTest
+
+from ai_core import (
+    OpenRouterClient, FairScheduler, load_registry, build_system_prompt, auth_headers,
+    build_payload, iter_stream_chunks, normalize_usage,
+)
+from final_project import (
+    CHAT_RENDER_WINDOW, RenderCache, SQLiteChatStorage, export_rooms, import_rooms, percentile,
+)
+from mock_openrouter import add_mock_arguments, mock_config_from_args, start_mock_server
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "final_project.py")
+SCENARIOS = ("turn", "rerun", "render", "throughput", "archive")
+BENCH_USER = "bench"
+HIGHER_IS_BETTER = ("_per_sec",)
+POLL_INTERVAL = 0.02  # Jeda antar rerun saat menunggu jawaban di skenario turn
+GATED_STATS = (".p50", ".p95")  # mean/max terlalu sensitif outlier untuk gerbang regresi
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark pipeline chat dengan mock OpenRouter")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Daftar skenario dipisah koma")
+    parser.add_argument("--output", default=None, help="Tulis hasil JSON ke file ini (default: stdout)")
+    parser.add_argument("--baseline", default=None, help="File JSON hasil sebelumnya untuk dibandingkan")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Kenaikan relatif (0.25 = 25%%) yang dianggap regresi")
+    parser.add_argument("--min-delta", type=float, default=0.01,
+                        help="Selisih absolut minimum (detik) agar dianggap regresi, meredam noise")
+    parser.add_argument("--turns", type=int, default=10, help="Giliran per mode pada skenario turn")
+    parser.add_argument("--history", default="0,100,1000", help="Panjang history untuk skenario rerun dan render")
+    parser.add_argument("--reruns", type=int, default=10, help="Rerun per panjang history")
+    parser.add_argument("--sessions", default="1,4,16", help="Jumlah session paralel untuk skenario throughput")
+    parser.add_argument("--turns-per-session", type=int, default=5)
+    parser.add_argument("--max-concurrent", type=int, default=16, help="Slot upstream global scheduler")
+    parser.add_argument("--max-per-user", type=int, default=4, help="Slot upstream per session")
+    parser.add_argument("--archive-messages", type=int, default=100_000, help="Jumlah pesan skenario archive")
+    parser.add_argument("--model", default="mistralai/mistral-7b-instruct:free")
+    parser.add_argument("--role", default="assistant")
+    add_mock_arguments(parser)
+    return parser.parse_args(argv)
+
+def summarize(values):
+    """Ringkasan n/mean/p50/p95/max; None jika tidak ada sampel"""
+    if not values:
+        return None
+    return {
+        "n": len(values),
+        "mean": round(sum(values) / len(values), 5),
+        "p50": round(percentile(values, 0.5), 5),
+        "p95": round(percentile(values, 0.95), 5),
+        "max": round(max(values), 5),
+    }
+
+def new_app(secrets, timeout=60):
+    """AppTest yang sudah login dengan secrets benchmark (metrics export mati, cache respons mati)"""
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+    for name, value in secrets.items():
+        at.secrets[name] = value
+    at.session_state.is_logged_in = True
+    at.session_state.api_key = "bench-key"
+    at.session_state.user_name = BENCH_USER
+    at.session_state.auth_user = BENCH_USER  # Storage SQLite hanya dipakai untuk login terautentikasi
+    at.session_state.use_response_cache = False
+    at.session_state.typing_speed = 0.0
+    return at
+
+def check_app(at):
+    if at.exception:
+        raise RuntimeError(f"App error: {at.exception[0].message}")
+
+def bench_turn(args, base_secrets):
+    """Latency satu giliran chat lewat app penuh (prompt assembly → upstream → render)"""
+    results = {}
+    for mode, stream in (("stream", True), ("typed", False)):
+        at = new_app(base_secrets)
+        at.session_state.stream_responses = stream
+        at.session_state.selected_model = args.model
+        at.run()
+        check_app(at)
+        wall = []
+        for i in range(args.turns):
+            timings = at.session_state.turn_timings
+            last = timings[-1] if timings else None
+            started = time.perf_counter()
+            at.chat_input[0].set_value(f"Pertanyaan benchmark nomor {i}").run()
+            # Script tidak menunggu job; rerun (seperti tick fragment polling) sampai giliran tercatat
+            while not timings or timings[-1] is last:
+                check_app(at)
+                time.sleep(POLL_INTERVAL)
+                at.run()
+            wall.append(time.perf_counter() - started)
+            check_app(at)
+        timings = at.session_state.turn_timings
+        results[mode] = {"wall": summarize(wall)}
+        for span in ("headers", "ttfb", "render", "total"):
+            results[mode][span] = summarize([spans[span] for spans in timings if span in spans])
+    return results
+
+def sample_message(seq):
+    """Pesan unik per seq; jawaban assistant berisi markdown dan blok kode seperti role Programmer"""
+    if seq % 2 == 0:
+        return {"role": "user", "content": f"Pertanyaan {seq}: bagaimana cara membandingkan `a < b` di Python?"}
+    return {"role": "assistant", "content": (
+        f"## Jawaban {seq}\n\nGunakan operator **perbandingan** biasa, misalnya:\n\n"
+        f"```python\ndef lebih_kecil(a, b):\n    return a < b  # {seq}\n\nprint(lebih_kecil(1, 2))\n```\n\n"
+        "- Hasilnya `True` atau `False`\n- Bisa untuk angka dan <string>\n\n" + "Lorem ipsum dolor sit amet. " * 10
+    )}
+
+def seed_history(path, length):
+    """Isi room Default user benchmark dengan `length` pesan bergantian user/assistant"""
+    storage = SQLiteChatStorage(path)
+    storage.ensure_room(BENCH_USER, "Default")
+    for seq in range(length):
+        storage.append_message(BENCH_USER, "Default", sample_message(seq))
+
+def bench_rerun(args, base_secrets):
+    """Biaya rerun (tanpa giliran chat) terhadap panjang history room aktif"""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench-rerun-") as directory:
+        for length in [int(n) for n in args.history.split(",")]:
+            path = os.path.join(directory, f"history-{length}.db")
+            seed_history(path, length)
+            at = new_app(dict(base_secrets, chat_storage="sqlite", chat_storage_path=path))
+            at.run()  # Run pertama: muat room, tidak ikut diukur
+            check_app(at)
+            wall, sidebar, sidebar_controls, chat_history = [], [], [], []
+            for _ in range(args.reruns):
+                started = time.perf_counter()
+                at.run()
+                wall.append(time.perf_counter() - started)
+                check_app(at)
+                sidebar.append(at.session_state.render_timings["sidebar"])
+                sidebar_controls.append(at.session_state.render_timings["sidebar_controls"])
+                chat_history.append(at.session_state.render_timings["chat_history"])
+            results[str(length)] = {
+                "wall": summarize(wall),
+                "render_sidebar": summarize(sidebar),
+                # Fragment kontrol dirender ulang sendiri saat parameter diterapkan
+                "render_sidebar_controls": summarize(sidebar_controls),
+                "render_chat_history": summarize(chat_history),
+            }
+    return results
+
+def bench_render(args):
+    """Render pertama tiap pesan (cache miss) vs rerun yang merender window terakhir dari cache"""
+    results = {}
+    for length in [int(n) for n in args.history.split(",") if int(n) > 0]:
+        contents = [sample_message(seq)["content"] for seq in range(length)]
+        cache = RenderCache()
+        cold = []
+        for content in contents:
+            started = time.perf_counter()
+            cache.render(content)
+            cold.append(time.perf_counter() - started)
+        window = contents[-CHAT_RENDER_WINDOW:]
+        reruns = []
+        for _ in range(args.reruns):
+            started = time.perf_counter()
+            for content in window:
+                cache.render(content)
+            reruns.append(time.perf_counter() - started)
+        results[str(length)] = {
+            "first_render_per_message": summarize(cold),
+            "rerun_window": summarize(reruns),
+            "cache": cache.stats(),
+        }
+    return results
+
+def bench_archive(args):
+    """Export lalu impor satu room berisi --archive-messages pesan; memori diukur di run terpisah"""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench-archive-") as directory:
+        source = SQLiteChatStorage(os.path.join(directory, "source.db"))
+        for start in range(0, args.archive_messages, 1000):
+            end = min(start + 1000, args.archive_messages)
+            source.append_messages(BENCH_USER, "Default", [(sample_message(seq), 0) for seq in range(start, end)])
+        archive_path = os.path.join(directory, "rooms.jsonl.gz")
+
+        def export():
+            with open(archive_path, "wb") as f:
+                return export_rooms(source, BENCH_USER, ["Default"], f)
+
+        def restore(name):
+            target = SQLiteChatStorage(os.path.join(directory, f"{name}.db"))
+            with open(archive_path, "rb") as f:
+                return import_rooms(target, BENCH_USER, f)
+
+        phases = (
+            ("export", export, export),
+            ("import", lambda: restore("target"), lambda: restore("traced")),
+        )
+        for phase, run, traced_run in phases:
+            started = time.perf_counter()
+            counts = run()
+            elapsed = time.perf_counter() - started
+            if sum(counts.values()) != args.archive_messages:
+                raise RuntimeError(f"{phase}: {counts} != {args.archive_messages} pesan")
+            # tracemalloc memperlambat alokasi, jadi puncak memori diukur di run kedua
+            tracemalloc.start()
+            traced_run()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[phase] = {
+                "seconds": round(elapsed, 3),
+                "messages_per_sec": round(args.archive_messages / elapsed, 1),
+                "peak_mb": round(peak / 2**20, 2),
+            }
+        raw_bytes = sum(len(sample_message(seq)["content"].encode("utf-8")) for seq in range(args.archive_messages))
+        results["messages"] = args.archive_messages
+        results["content_mb"] = round(raw_bytes / 2**20, 2)
+        results["file_mb"] = round(os.path.getsize(archive_path) / 2**20, 2)
+    return results
+
+def run_session(session_id, args, client, scheduler, system_prompt, samples, lock):
+    """Satu session: giliran berurutan dengan history yang bertambah, seperti di app"""
+    headers = auth_headers(f"bench-key-{session_id}")
+    messages = [{"role": "system", "content": system_prompt}]
+    for turn in range(args.turns_per_session):
+        messages.append({"role": "user", "content": f"Pertanyaan {turn} dari session {session_id}"})
+        payload = build_payload(args.model, messages, 512, 0.7, stream=True, user=f"session-{session_id}")
+        started = time.perf_counter()
+        first_token = None
+        parts, usage, error = [], None, None
+        scheduler.acquire(payload["user"])
+        try:
+            with client.post_chat(headers, payload, stream=True) as response:
+                for delta, chunk_usage in iter_stream_chunks(response):
+                    if delta:
+                        if first_token is None:
+                            first_token = time.perf_counter()
+                        parts.append(delta)
+                    if chunk_usage:
+                        usage = normalize_usage(chunk_usage)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            scheduler.release(payload["user"])
+        finished = time.perf_counter()
+        messages.append({"role": "assistant", "content": "".join(parts)})
+        with lock:
+            samples.append({
+                "latency": finished - started,
+                "ttft": first_token - started if first_token is not None else None,
+                "completion_tokens": usage["completion_tokens"] if usage else 0,
+                "error": error,
+            })
+
+def bench_throughput(args, base_url):
+    """N session paralel berbagi satu OpenRouterClient dan FairScheduler (seperti server mode)"""
+    role = load_registry().roles[args.role]
+    system_prompt = build_system_prompt(role.system_message, BENCH_USER)
+    results = {}
+    for sessions in [int(n) for n in args.sessions.split(",")]:
+        client = OpenRouterClient(base_url=base_url, max_retries=0, pool_maxsize=max(sessions, 10))
+        scheduler = FairScheduler(max_concurrent=args.max_concurrent, max_per_user=args.max_per_user,
+                                  max_waiting=sessions * args.turns_per_session)
+        samples, lock = [], threading.Lock()
+        threads = [
+            threading.Thread(target=run_session, args=(i, args, client, scheduler, system_prompt, samples, lock))
+            for i in range(sessions)
+        ]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        client.close()
+        ok = [sample for sample in samples if sample["error"] is None]
+        results[str(sessions)] = {
+            "turns": len(samples),
+            "errors": len(samples) - len(ok),
+            "turns_per_sec": round(len(ok) / elapsed, 3),
+            "tokens_per_sec": round(sum(sample["completion_tokens"] for sample in ok) / elapsed, 1),
+            "latency": summarize([sample["latency"] for sample in ok]),
+            "ttft": summarize([sample["ttft"] for sample in ok if sample["ttft"] is not None]),
+        }
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(APP_PATH), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def flatten(results, prefix=""):
+    """{'turn': {'stream': {'wall': {'p50': x}}}} -> {'turn.stream.wall.p50': x} (hanya angka)"""
+    flat = {}
+    for key, value in results.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+def compare_results(current, baseline, tolerance, min_delta):
+    """Return daftar regresi (metric, baseline, sekarang, perubahan relatif; None = error bertambah)"""
+    regressions = []
+    current_flat = flatten(current["results"])
+    for metric, old in flatten(baseline["results"]).items():
+        new = current_flat.get(metric)
+        if new is None or metric.endswith((".n", ".turns")):
+            continue
+        if metric.endswith(".errors"):
+            if new > old:
+                regressions.append((metric, old, new, None))
+        elif not old:
+            continue
+        elif metric.endswith(HIGHER_IS_BETTER):
+            change = (old - new) / old
+            if change > tolerance:
+                regressions.append((metric, old, new, -change))
+        elif metric.endswith(GATED_STATS):
+            change = (new - old) / old
+            if change > tolerance and new - old > min_delta:
+                regressions.append((metric, old, new, change))
+    return regressions
+
+def main(argv=None):
+    args = parse_args(argv)
+    # AppTest mengatur session_state di luar script run; peringatan bare mode ini tidak relevan
+    # (filter, bukan setLevel, karena Streamlit mengatur ulang level logger saat config dimuat)
+    logging.getLogger("streamlit.runtime.scriptrunner_utils.script_run_context").addFilter(
+        lambda record: "missing ScriptRunContext" not in record.getMessage())
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        sys.exit(f"Skenario tidak dikenal: {', '.join(sorted(unknown))}. Pilihan: {', '.join(SCENARIOS)}")
+
+    mock_config = mock_config_from_args(args)
+    server = start_mock_server(mock_config)
+    base_secrets = {
+        "openrouter_base_url": server.base_url,
+        "metrics_export": "off",
+        "chat_storage": "memory",
+        # Batas upstream app dibuat longgar agar yang terukur adalah pipeline, bukan kuota
+        "rate_limit_free_rpm": 0,
+        "rate_limit_model_rpm": 0,
+        "rate_limit_key_rpm": 0,
+    }
+    results = {}
+    try:
+        for name in scenarios:
+            print(f"▶ {name}...", file=sys.stderr)
+            started = time.perf_counter()
+            if name == "turn":
+                results[name] = bench_turn(args, base_secrets)
+            elif name == "rerun":
+                results[name] = bench_rerun(args, base_secrets)
+            elif name == "render":
+                results[name] = bench_render(args)
+            elif name == "archive":
+                results[name] = bench_archive(args)
+            else:
+                results[name] = bench_throughput(args, server.base_url)
+            print(f"  selesai dalam {time.perf_counter() - started:.1f}s", file=sys.stderr)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    report = {
+        "meta": {
+            "ts": datetime.now().isoformat(timespec="seconds"),
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "streamlit": streamlit.__version__,
+            "mock": asdict(mock_config),
+            "mock_requests": server.stats(),
+            "params": {name: getattr(args, name) for name in (
+                "turns", "history", "reruns", "sessions", "turns_per_session",
+                "max_concurrent", "max_per_user", "archive_messages", "model", "role")},
+        },
+        "results": results,
+    }
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+        print(f"Hasil ditulis ke {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["meta"].get("mock") != report["meta"]["mock"] or baseline["meta"].get("params") != report["meta"]["params"]:
+            print("⚠️ Konfigurasi mock/parameter berbeda dari baseline, perbandingan kurang valid", file=sys.stderr)
+        regressions = compare_results(report, baseline, args.tolerance, args.min_delta)
+        if not regressions:
+            print(f"✅ Tidak ada regresi dibanding {args.baseline} (commit {baseline['meta'].get('commit')})",
+                  file=sys.stderr)
+            return 0
+        print(f"❌ {len(regressions)} regresi dibanding {args.baseline}:", file=sys.stderr)
+        for metric, old, new, change in regressions:
+            detail = f"{change:+.0%}" if change is not None else "bertambah"
+            print(f"  {metric}: {old} → {new} ({detail})", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
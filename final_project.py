@@ -1,13 +1,79 @@
 import streamlit as st
 import requests
 import json
+import os
+import re
+import html
+import math
 import time
+import sqlite3
+import hashlib
+import hmac
+import functools
+import contextlib
+import gzip
+import io
+import queue
+import tempfile
+import threading
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from PIL import Image
 
+from ai_core import (
+    OPENROUTER_BASE_URL, OpenRouterClient, UpstreamBusyError, RateLimitedError,
+    FairScheduler, RateLimiter, load_registry, build_system_prompt, auth_headers,
+    UpstreamError, build_payload, apply_prompt_cache, parse_retry_after, iter_stream_chunks, normalize_usage,
+)
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+    from pygments.lexers import get_lexer_by_name
+    from pygments.util import ClassNotFound
+except ImportError:
+    highlight = None
+
 # ===========================
 # PAGE CONFIGURATION
 # ===========================
+THEME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+THEME_FILES = ("theme.css", "theme-lite.css")
+
+@st.cache_resource(show_spinner=False)
+def load_theme_assets():
+    """Baca file tema sekali per proses beserta hash isinya untuk cache busting"""
+    assets = {}
+    for name in THEME_FILES:
+        with open(os.path.join(THEME_DIR, name), "rb") as f:
+            data = f.read()
+        assets[name] = {
+            "css": data.decode("utf-8"),
+            "hash": hashlib.sha256(data).hexdigest()[:12],
+            "bytes": len(data),
+        }
+    return assets
+
+def build_theme_markup(reduced_motion=False):
+    """Markup tema per rerun: <link> ke file statis, fallback ke <style> inline jika static serving mati"""
+    assets = load_theme_assets()
+    names = THEME_FILES if reduced_motion else THEME_FILES[:1]
+    if st.get_option("server.enableStaticServing"):
+        # ?v=<hash> membuat file boleh di-cache lama oleh browser dan berubah URL saat isinya berubah
+        return "".join(
+            f'<link rel="stylesheet" href="app/static/{name}?v={assets[name]["hash"]}">'
+            for name in names
+        )
+    return "<style>\n" + "\n".join(assets[name]["css"] for name in names) + "</style>"
+
 def configure_page():
     """Configure Streamlit page settings"""
     st.set_page_config(
@@ -17,397 +83,94 @@ def configure_page():
         initial_sidebar_state="expanded"
     )
     
-    # Custom CSS for animations and styling
-    st.markdown("""
-    <style>
-    /* Import Google Fonts */
-    @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
-    
-    /* Global Styles */
-    .main {
-        font-family: 'Inter', sans-serif;
-    }
-    
-    /* Animated gradient background */
-    .animated-bg {
-        background: linear-gradient(-45deg, #182c7a, #1d2f7e, #233382, #283686, #2d398a, #323d8e, #364092);
-        background-size: 400% 400%;
-        animation: gradientBG 15s ease infinite;
-        padding: 2rem;
-        border-radius: 15px;
-        color: white;
-        text-align: center;
-        margin-bottom: 2rem;
-    }
-    
-    @keyframes gradientBG {
-        0% { background-position: 0% 50%; }
-        50% { background-position: 100% 50%; }
-        100% { background-position: 0% 50%; }
-    }
-    
-    /* Typing animation */
-    .typing-animation {
-        overflow: hidden;
-        border-right: 3px solid #182c7a;
-        white-space: nowrap;
-        margin: 0 auto;
-        letter-spacing: 0.1em;
-        animation: typing 3.5s steps(40, end), blink-caret 0.75s step-end infinite;
-    }
-    
-    @keyframes typing {
-        from { width: 0; }
-        to { width: 100%; }
-    }
-    
-    @keyframes blink-caret {
-        from, to { border-color: transparent; }
-        50% { border-color: #182c7a; }
-    }
-    
-    /* Pulse animation for AI response */
-    .ai-thinking {
-        animation: pulse 2s infinite;
-        background: linear-gradient(45deg, #182c7a, #1d2f7e);
-        padding: 1rem;
-        border-radius: 10px;
-        color: white;
-        text-align: center;
-        margin: 1rem 0;
-    }
-    
-    @keyframes pulse {
-        0% { transform: scale(1); }
-        50% { transform: scale(1.05); }
-        100% { transform: scale(1); }
-    }
-    
-    /* Slide in animation for messages */
-    .slide-in-left {
-        animation: slideInLeft 0.5s ease-out;
-    }
-    
-    .slide-in-right {
-        animation: slideInRight 0.5s ease-out;
-    }
-    
-    @keyframes slideInLeft {
-        from {
-            transform: translateX(-100%);
-            opacity: 0;
-        }
-        to {
-            transform: translateX(0);
-            opacity: 1;
-        }
-    }
-    
-    @keyframes slideInRight {
-        from {
-            transform: translateX(100%);
-            opacity: 0;
-        }
-        to {
-            transform: translateX(0);
-            opacity: 1;
-        }
-    }
-    
-    /* Role card animations */
-    .role-card {
-        background: white;
-        border-radius: 15px;
-        padding: 1.5rem;
-        margin: 0.5rem;
-        box-shadow: 0 4px 20px rgba(0,0,0,0.1);
-        transition: all 0.3s ease;
-        cursor: pointer;
-        border: 2px solid transparent;
-    }
-    
-    .role-card:hover {
-        transform: translateY(-10px);
-        box-shadow: 0 20px 40px rgba(0,0,0,0.2);
-        border-color: #182c7a;
-    }
-    
-    .role-card.active {
-        background: linear-gradient(135deg, #182c7a, #1d2f7e);
-        color: white;
-        transform: scale(1.05);
-    }
-    
-    /* Glow effect */
-    .glow {
-        animation: glow 2s ease-in-out infinite alternate;
-    }
-    
-    @keyframes glow {
-        from { box-shadow: 0 0 5px #182c7a, 0 0 10px #182c7a, 0 0 15px #182c7a; }
-        to { box-shadow: 0 0 10px #182c7a, 0 0 20px #182c7a, 0 0 30px #182c7a; }
-    }
-    
-    /* Loading spinner */
-    .spinner {
-        border: 4px solid #f3f3f3;
-        border-top: 4px solid #182c7a;
-        border-radius: 50%;
-        width: 30px;
-        height: 30px;
-        animation: spin 1s linear infinite;
-        margin: 0 auto;
-    }
-    
-    @keyframes spin {
-        0% { transform: rotate(0deg); }
-        100% { transform: rotate(360deg); }
-    }
-    
-    /* Text shimmer effect */
-    .shimmer {
-        background: linear-gradient(90deg, #f0f0f0 25%, #e0e0e0 50%, #f0f0f0 75%);
-        background-size: 200% 100%;
-        animation: shimmer 2s infinite;
-        color: transparent;
-        background-clip: text;
-        -webkit-background-clip: text;
-    }
-    
-    @keyframes shimmer {
-        0% { background-position: -200% 0; }
-        100% { background-position: 200% 0; }
-    }
-    
-    /* Sidebar enhancements */
-    .sidebar-item {
-        background: rgba(24, 44, 122, 0.1);
-        border-radius: 10px;
-        padding: 1rem;
-        margin: 0.5rem 0;
-        border-left: 4px solid #182c7a;
-        transition: all 0.3s ease;
-    }
-    
-    .sidebar-item:hover {
-        background: rgba(24, 44, 122, 0.2);
-        transform: translateX(5px);
-    }
-    
-    /* Chat message styling */
-    .chat-message {
-        animation: fadeInUp 0.5s ease-out;
-        margin: 1rem 0;
-    }
-    
-    @keyframes fadeInUp {
-        from {
-            opacity: 0;
-            transform: translateY(30px);
-        }
-        to {
-            opacity: 1;
-            transform: translateY(0);
-        }
-    }
-    
-    /* Success/Error animations */
-    .success-bounce {
-        animation: bounceIn 0.6s ease-out;
-    }
-    
-    .error-shake {
-        animation: shake 0.6s ease-out;
-    }
-    
-    @keyframes bounceIn {
-        0% { transform: scale(0.3); opacity: 0; }
-        50% { transform: scale(1.05); opacity: 1; }
-        70% { transform: scale(0.9); }
-        100% { transform: scale(1); }
-    }
-    
-    @keyframes shake {
-        0%, 100% { transform: translateX(0); }
-        10%, 30%, 50%, 70%, 90% { transform: translateX(-10px); }
-        20%, 40%, 60%, 80% { transform: translateX(10px); }
-    }
-    
-    /* Button enhancements */
-    .stButton > button {
-        background: linear-gradient(45deg, #182c7a, #1d2f7e) !important;
-        color: white !important;
-        border: none !important;
-        border-radius: 25px !important;
-        transition: all 0.3s ease !important;
-        box-shadow: 0 4px 15px rgba(24, 44, 122, 0.3) !important;
-    }
-    
-    .stButton > button:hover {
-        transform: translateY(-2px) !important;
-        box-shadow: 0 8px 25px rgba(24, 44, 122, 0.5) !important;
-    }
-    
-    /* Parameter display enhancements */
-    .param-display {
-        background: linear-gradient(135deg, #182c7a, #1d2f7e);
-        color: white;
-        padding: 0.5rem 1rem;
-        border-radius: 20px;
-        text-align: center;
-        font-weight: bold;
-        animation: paramGlow 3s ease-in-out infinite;
-    }
-    
-    @keyframes paramGlow {
-        0%, 100% { box-shadow: 0 0 5px rgba(24, 44, 122, 0.5); }
-        50% { box-shadow: 0 0 20px rgba(24, 44, 122, 0.8); }
-    }
-    
-    /* Hide Streamlit default elements */
-    #MainMenu {visibility: hidden;}
-    footer {visibility: hidden;}
-    header {visibility: hidden;}
-    </style>
-    """, unsafe_allow_html=True)
+    # Tema dari static/theme.css: cukup tag <link> kecil per rerun, file di-cache browser
+    reduced_motion = st.session_state.get("reduced_motion", get_secret("ui_reduced_motion", False))
+    theme_markup = build_theme_markup(reduced_motion)
+    st.session_state.theme_payload_bytes = len(theme_markup.encode("utf-8"))
+    st.markdown(theme_markup, unsafe_allow_html=True)
 
 # ===========================
-# ROLE CONFIGURATIONS (3 ROLES ONLY) - FIXED
+# ROLE & MODEL REGISTRY
 # ===========================
+REGISTRY_CHECK_INTERVAL = 2.0  # detik antar cek mtime file registry (hot reload)
+
+@st.cache_resource(show_spinner=False)
+def get_registry_holder():
+    """Registry aktif bersama semua session, plus status hot reload"""
+    return {"registry": None, "checked_at": 0.0, "error": None, "lock": threading.Lock()}
+
+def get_registry_path():
+    """Path file registry dari st.secrets['registry_path'], default registry.json di samping app"""
+    default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "registry.json")
+    return get_secret("registry_path", default_path)
+
+def get_registry():
+    """Registry role/model; mtime file dicek paling sering tiap REGISTRY_CHECK_INTERVAL detik"""
+    holder = get_registry_holder()
+    registry = holder["registry"]
+    now = time.monotonic()
+    if registry is not None and now - holder["checked_at"] < REGISTRY_CHECK_INTERVAL:
+        return registry
+    with holder["lock"]:
+        registry = holder["registry"]
+        holder["checked_at"] = now
+        path = get_registry_path()
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            mtime = None
+        if registry is None or registry.source != path or registry.mtime != mtime:
+            try:
+                registry = load_registry(path, mtime)
+                holder["error"] = None
+            except Exception as e:
+                # File rusak: tetap pakai registry terakhir yang valid
+                holder["error"] = f"{os.path.basename(path)}: {e}"
+                if registry is None:
+                    registry = load_registry()
+            holder["registry"] = registry
+    return registry
+
 def get_role_configs():
-    """Konfigurasi untuk 3 role AI"""
-    return {
-        "assistant": {
-            "name": "👾 Asisten Umum",
-            "icon": "👾",
-            "color": "#182c7a",
-            "gradient": "linear-gradient(135deg, #182c7a, #1d2f7e)",
-            "description": "Bantuan umum untuk berbagai keperluan",
-            "system_message": """Kamu adalah AI Assistant yang helpful dan efisien. Kamu bertugas memberikan jawaban yang SINGKAT, JELAS, dan LANGSUNG KE INTI.
-
-PENTING - ATURAN RESPONS:
-1. JAWAB MAKSIMAL 2-3 KALIMAT untuk pertanyaan sederhana
-2. LANGSUNG ke point utama tanpa pembukaan panjang
-3. HINDARI penjelasan berlebihan kecuali diminta detail
-4. GUNAKAN bullet points hanya jika benar-benar perlu
-5. BERIKAN jawaban praktis yang bisa langsung diterapkan
-
-PERSONALITY: Ramah tapi efisien, informatif tapi tidak bertele-tele.
-
-CAPABILITIES: 
-- Menjawab pertanyaan umum dengan singkat
-- Memberikan saran praktis
-- Tips efektif tanpa panjang lebar
-- Informasi akurat dan to-the-point
-
-Berikan respons yang helpful namun SINGKAT dan EFISIEN.""",
-            "recommended_models": ["mistralai/mistral-7b-instruct:free", "google/gemma-7b-it:free", "meta-llama/llama-3-8b-instruct:free"],
-            "default_temperature": 0.3,  # Lebih rendah untuk jawaban lebih konsisten
-            "default_max_tokens": 150,   # Lebih rendah untuk jawaban lebih singkat
-            "sample_questions": [
-                "Bagaimana cara meningkatkan produktivitas kerja?",
-                "Apa tips mengatur waktu yang efektif?",
-                "Rekomendasi aplikasi untuk belajar bahasa asing"
-            ]
-        },
-        "guru": {
-            "name": "👨‍🏫 Guru",
-            "icon": "👨‍🏫",
-            "color": "#233382",
-            "gradient": "linear-gradient(135deg, #233382, #283686)",
-            "description": "Pendidikan & pembelajaran interaktif",
-            "system_message": """Kamu adalah Prof. AI, guru yang mengajar dengan EFISIEN dan LANGSUNG KE INTI.
-
-PENTING - ATURAN MENGAJAR:
-1. JAWAB MAKSIMAL 2-3 KALIMAT untuk konsep sederhana
-2. LANGSUNG jelaskan inti materi tanpa pembukaan panjang
-3. GUNAKAN analogi sederhana hanya jika benar-benar membantu
-4. BERIKAN contoh SINGKAT dan KONKRET
-5. HINDARI teori berlebihan, fokus pada pemahaman praktis
-
-TEACHING APPROACH:
-- Langsung ke definisi/konsep utama
-- Contoh singkat dan mudah dipahami
-- Aplikasi praktis dalam 1-2 kalimat
-- Motivasi singkat hanya jika relevan
-
-PERSONALITY: Sabar, jelas, tapi tidak bertele-tele.
-
-Berikan penjelasan yang MUDAH DIPAHAMI namun SINGKAT dan EFEKTIF.""",
-            "recommended_models": ["mistralai/mistral-7b-instruct:free", "google/gemma-7b-it:free", "meta-llama/llama-3-8b-instruct:free"],
-            "default_temperature": 0.4,
-            "default_max_tokens": 200,
-            "sample_questions": [
-                "Jelaskan konsep photosynthesis dengan analogi sederhana",
-                "Strategi belajar matematika yang efektif untuk siswa SMA",
-                "Bagaimana cara menulis essay yang baik dan benar?"
-            ]
-        },
-        "programmer": {
-            "name": "👩‍💻 Programmer",
-            "icon": "👩‍💻",
-            "color": "#2d398a",
-            "gradient": "linear-gradient(135deg, #2d398a, #323d8e)",
-            "description": "Coding, debugging & tech solutions",
-            "system_message": """Kamu adalah Senior Dev AI yang memberikan solusi coding SINGKAT dan EFEKTIF.
-
-PENTING - ATURAN CODING:
-1. JAWAB MAKSIMAL 1-2 KALIMAT penjelasan untuk pertanyaan sederhana
-2. LANGSUNG berikan kode/solusi tanpa penjelasan panjang
-3. GUNAKAN comment dalam kode untuk penjelasan singkat
-4. FOKUS pada solusi yang WORKING dan PRAKTIS
-5. HINDARI penjelasan teori panjang kecuali diminta
-
-CODING APPROACH:
-- Working code first dengan comment singkat
-- Penjelasan teknis minimal tapi jelas
-- Best practices dalam comment
-- Alternative approach hanya jika diminta
-
-PERSONALITY: Logical, solution-focused, straight to the point.
-
-Berikan solusi coding yang EFEKTIF dan LANGSUNG APPLICABLE.""",
-            "recommended_models": ["mistralai/mistral-7b-instruct:free", "google/gemma-7b-it:free", "meta-llama/llama-3-8b-instruct:free"],
-            "default_temperature": 0.2,  # Sangat rendah untuk kode yang konsisten
-            "default_max_tokens": 250,
-            "sample_questions": [
-                "Bagaimana cara optimasi performa query database yang lambat?",
-                "Jelaskan perbedaan async/await dan Promise di JavaScript",
-                "Review dan improve kode Python saya untuk bug dan performance"
-            ]
-        }
-    }
+    """Konfigurasi role AI (mapping read-only key -> RoleConfig)"""
+    return get_registry().roles
 
-# ===========================
-# MODEL CONFIGURATIONS
-# ===========================
 def get_available_models():
-    """Daftar model AI yang tersedia"""
-    return {
-        # ⭐ GRATIS - Recommended untuk pemula
-        "mistralai/mistral-7b-instruct:free": "🆓 Mistral 7B (Free) ⭐",
-        "google/gemma-7b-it:free": "🆓 Google Gemma 7B (Free)",
-        "meta-llama/llama-3-8b-instruct:free": "🆓 Llama 3 8B (Free)",
-        "huggingface/zephyr-7b-beta:free": "🆓 Zephyr 7B (Free)",
-        "openchat/openchat-7b:free": "🆓 OpenChat 7B (Free)",
-        
-        # 💰 PREMIUM - Perlu kredit
-        "openai/gpt-4o": "💰 GPT-4o (Premium)",
-        "openai/gpt-4o-mini": "💰 GPT-4o Mini (Premium)", 
-        "anthropic/claude-3.5-sonnet": "💰 Claude 3.5 Sonnet (Premium)",
-        "anthropic/claude-3-haiku": "💰 Claude 3 Haiku (Premium)",
-        "google/gemini-pro": "💰 Gemini Pro (Premium)",
-        "mistralai/mistral-large": "💰 Mistral Large (Premium)",
-        "mistralai/codestral": "💰 Codestral (Premium)"
-    }
+    """Daftar model AI yang tersedia (mapping read-only id -> label)"""
+    return get_registry().model_labels
+
+def sync_registry_selection():
+    """Pastikan role & model pilihan session masih ada di registry setelah hot reload.
+
+    Role yang dihapus diganti role pertama, model yang dihapus diganti model rekomendasi pertama role
+    (atau model pertama registry); session diberi peringatan, bukan KeyError di setiap rerun.
+    """
+    registry = get_registry()
+    if st.session_state.get("registry_synced") is registry:
+        return
+    roles, models = registry.roles, registry.model_labels
+    if st.session_state.current_role not in roles:
+        old_role = st.session_state.current_role
+        st.session_state.current_role = next(iter(roles))
+        update_role_defaults()
+        notify(f"Role '{old_role}' tidak ada lagi di registry, beralih ke {roles[st.session_state.current_role].name}",
+               "warning")
+    if st.session_state.selected_model not in models:
+        old_model = st.session_state.selected_model
+        recommended = [m for m in roles[st.session_state.current_role].recommended_models if m in models]
+        st.session_state.selected_model = (recommended or list(models))[0]
+        notify(f"Model '{old_model}' tidak ada lagi di registry, beralih ke {models[st.session_state.selected_model]}",
+               "warning")
+    compare_models = st.session_state.get("compare_models") or []
+    if any(m not in models for m in compare_models):
+        st.session_state.compare_models = [m for m in compare_models if m in models]
+    st.session_state.registry_synced = registry
 
 # ===========================
 # SESSION STATE MANAGEMENT
 # ===========================
 def initialize_session_state():
     """Inisialisasi variabel session state"""
-    if "messages" not in st.session_state:
-        st.session_state.messages = []
     if "api_key" not in st.session_state:
         st.session_state.api_key = ""
     if "user_name" not in st.session_state:
@@ -424,12 +187,32 @@ def initialize_session_state():
         st.session_state.max_tokens = 150   # Default lebih rendah
     if "typing_speed" not in st.session_state:
         st.session_state.typing_speed = 0.02  # Speed for typing animation
-    if "chatrooms" not in st.session_state:
-        st.session_state.chatrooms = {"Default": []}
-    if "current_chatroom" not in st.session_state:
-        st.session_state.current_chatroom = "Default"
-    if "chatroom_counter" not in st.session_state:
-        st.session_state.chatroom_counter = 1
+    if "stream_responses" not in st.session_state:
+        st.session_state.stream_responses = True  # Streaming token-by-token (SSE)
+    if "use_response_cache" not in st.session_state:
+        st.session_state.use_response_cache = True  # Cache respons untuk temperature rendah
+    if "summarize_history" not in st.session_state:
+        st.session_state.summarize_history = False  # Ringkas giliran lama yang keluar context window
+    if "auto_fallback" not in st.session_state:
+        st.session_state.auto_fallback = True  # Pindah ke recommended_models role jika model gagal
+    if "hedge_requests" not in st.session_state:
+        st.session_state.hedge_requests = False  # Tembak model cadangan jika model utama lambat
+    if "turn_timings" not in st.session_state:
+        st.session_state.turn_timings = []  # Span latency per giliran untuk panel p50/p95
+    if "notifications" not in st.session_state:
+        st.session_state.notifications = []  # Antrean toast untuk render berikutnya
+    if "reduced_motion" not in st.session_state:
+        st.session_state.reduced_motion = bool(get_secret("ui_reduced_motion", False))  # Mode ringan tanpa animasi infinite
+    if "compare_mode" not in st.session_state:
+        st.session_state.compare_mode = False  # Kirim prompt ke beberapa model sekaligus
+    if "compare_models" not in st.session_state:
+        st.session_state.compare_models = []
+    if "compare_results" not in st.session_state:
+        st.session_state.compare_results = []  # Latency/TTFT/usage per model per perbandingan
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex  # Key job generate di worker pool
+    if "import_uploader_nonce" not in st.session_state:
+        st.session_state.import_uploader_nonce = 0  # Ganti key file_uploader untuk mengosongkannya setelah impor
 
 # ===========================
 # SYSTEM MESSAGE
@@ -438,25 +221,8 @@ def get_system_message():
     """Return the system message based on current role"""
     user_name = st.session_state.get("user_name", "")
     current_role = st.session_state.get("current_role", "assistant")
-    role_configs = get_role_configs()
-    
-    name_context = f"Nama pengguna adalah {user_name}. " if user_name else ""
-    base_message = role_configs[current_role]["system_message"]
-    
-    return {
-        "role": "system",
-        "content": f"""{base_message} 
-
-{name_context}
-
-WAJIB DIINGAT:
-- Panggil pengguna dengan nama mereka jika ada
-- SELALU berikan respons SINGKAT dan EFISIEN
-- MAKSIMAL 2-3 kalimat untuk pertanyaan sederhana
-- LANGSUNG ke inti tanpa pembukaan panjang
-- HINDARI penjelasan berlebihan
-- FOKUS pada jawaban praktis dan aplikatif"""
-    }
+    base_message = get_role_configs()[current_role].system_message
+    return {"role": "system", "content": build_system_prompt(base_message, user_name)}
 
 # ===========================
 # ANIMATION FUNCTIONS
@@ -473,15 +239,22 @@ def show_typing_animation(text, container):
     
     typing_placeholder.markdown(displayed_text)
 
-def show_thinking_animation():
+def show_thinking_animation(status="🧠 AI sedang berpikir..."):
     """Show AI thinking animation"""
-    return st.markdown("""
+    return st.markdown(f"""
     <div class="ai-thinking">
         <div class="spinner"></div>
-        <p style="margin-top: 10px;">🧠 AI sedang berpikir...</p>
+        <p style="margin-top: 10px;">{status}</p>
     </div>
     """, unsafe_allow_html=True)
 
+def thinking_status_updater(container):
+    """Callback untuk memperbarui teks animasi berpikir (posisi antrean, tunggu kuota)"""
+    def update(status):
+        with container:
+            show_thinking_animation(status)
+    return update
+
 def show_success_message(message):
     """Show animated success message"""
     st.markdown(f"""
@@ -500,81 +273,963 @@ def show_error_message(message):
     </div>
     """, unsafe_allow_html=True)
 
+NOTIFICATION_ICONS = {"success": "✅", "error": "❌", "warning": "⚠️", "info": "💡"}
+
+def notify(message, kind="success"):
+    """Antrekan notifikasi; ditampilkan sebagai toast pada render berikutnya tanpa menahan rerun"""
+    st.session_state.notifications.append({"message": message, "kind": kind})
+
+def render_notifications():
+    """Tampilkan lalu kosongkan antrean notifikasi dari aksi sebelumnya"""
+    while st.session_state.notifications:
+        note = st.session_state.notifications.pop(0)
+        st.toast(note["message"], icon=NOTIFICATION_ICONS.get(note["kind"], "💡"))
+
+# ===========================
+# CHATROOM STORAGE
+# ===========================
+CHAT_PAGE_SIZE = 50  # Jumlah pesan yang dimuat per halaman saat masuk room
+CHAT_RENDER_WINDOW = 20  # Jumlah pesan terakhir yang dirender per rerun
+
+ROOM_STAT_FIELDS = ("messages", "user_messages", "assistant_messages", "chars", "tokens")
+USAGE_FIELDS = ("requests", "prompt_tokens", "cached_tokens", "completion_tokens", "total_tokens", "cost")
+
+def empty_room_stats(last_activity=None):
+    """Counter agregat satu room, diperbarui saat append/clear agar statistik tidak perlu scan pesan"""
+    stats = dict.fromkeys(ROOM_STAT_FIELDS, 0)
+    stats["last_activity"] = last_activity
+    return stats
+
+def count_message_in_stats(stats, message, tokens, now):
+    """Tambahkan satu pesan ke counter agregat room"""
+    stats["messages"] += 1
+    if message["role"] in ("user", "assistant"):
+        stats[f"{message['role']}_messages"] += 1
+    stats["chars"] += len(message["content"])
+    stats["tokens"] += tokens
+    stats["last_activity"] = now
+
+def empty_usage_totals():
+    return dict.fromkeys(USAGE_FIELDS, 0)
+
+def count_usage_in_totals(totals, usage):
+    """Tambahkan usage satu request (sudah dinormalisasi) ke counter usage"""
+    totals["requests"] += 1
+    totals["prompt_tokens"] += usage["prompt_tokens"]
+    totals["cached_tokens"] += usage.get("cached_tokens", 0)
+    totals["completion_tokens"] += usage["completion_tokens"]
+    totals["total_tokens"] += usage["total_tokens"]
+    totals["cost"] += usage["cost"]
+
+class MemoryChatStorage:
+    """Storage default: room disimpan di memori session (hilang saat restart)"""
+
+    def __init__(self):
+        self._rooms = {}  # user -> {room_name: [message, ...]}
+        self._stats = {}  # user -> {room_name: counter agregat}, urutan sama dengan _rooms
+        self._meta = {}  # user -> {room_name: metadata room}
+        self._room_usage = {}  # user -> {room_name: counter usage API}
+        self._user_usage = {}  # user -> counter usage API (termasuk room yang sudah dihapus)
+
+    def _user_rooms(self, user):
+        return self._rooms.setdefault(user, {})
+
+    def _user_stats(self, user):
+        return self._stats.setdefault(user, {})
+
+    def _room_meta(self, user, room):
+        return self._meta.setdefault(user, {}).setdefault(room, {"created_at": time.time()})
+
+    def room_stats(self, user):
+        """Dict nama room -> counter agregat (salinan), urut sesuai waktu dibuat"""
+        return {name: dict(stats) for name, stats in self._user_stats(user).items()}
+
+    def get_room_stats(self, user, room):
+        return dict(self._user_stats(user).get(room) or empty_room_stats())
+
+    def ensure_room(self, user, room):
+        self._user_rooms(user).setdefault(room, [])
+        self._user_stats(user).setdefault(room, empty_room_stats())
+        self._room_meta(user, room)
+
+    def get_room_metadata(self, user, room):
+        if room not in self._meta.get(user, {}):
+            return {}
+        metadata = dict(self._meta[user][room])
+        metadata["updated_at"] = self._user_stats(user).get(room, {}).get("last_activity")
+        return metadata
+
+    def update_room_metadata(self, user, room, changes):
+        """Gabungkan changes ke metadata room; nilai None menghapus key"""
+        metadata = self._room_meta(user, room)
+        for key, value in changes.items():
+            if key == "updated_at":
+                continue  # Diturunkan dari aktivitas pesan terakhir
+            if value is None:
+                metadata.pop(key, None)
+            else:
+                metadata[key] = value
+
+    def add_usage(self, user, room, usage):
+        """Catat usage satu request API ke total room (jika room masih ada) dan total user"""
+        if room in self._user_rooms(user):
+            count_usage_in_totals(self._room_usage.setdefault(user, {}).setdefault(room, empty_usage_totals()), usage)
+        count_usage_in_totals(self._user_usage.setdefault(user, empty_usage_totals()), usage)
+
+    def usage_totals(self, user, room=None):
+        """Counter usage API room, atau seluruh user jika room None"""
+        if room is None:
+            return dict(self._user_usage.get(user) or empty_usage_totals())
+        return dict(self._room_usage.get(user, {}).get(room) or empty_usage_totals())
+
+    def count_messages(self, user, room):
+        return len(self._user_rooms(user).get(room, []))
+
+    def load_messages(self, user, room, offset=0, limit=None):
+        messages = self._user_rooms(user).get(room, [])
+        end = None if limit is None else offset + limit
+        return messages[offset:end]
+
+    def iter_messages(self, user, room):
+        """Yield seluruh pesan room berurutan (export)"""
+        yield from self._user_rooms(user).get(room, [])
+
+    def append_message(self, user, room, message, tokens=0):
+        self._room_meta(user, room)
+        self._user_rooms(user).setdefault(room, []).append(message)
+        count_message_in_stats(self._user_stats(user).setdefault(room, empty_room_stats()), message, tokens, time.time())
+
+    def append_messages(self, user, room, items):
+        """Bulk append (import): items berisi pasangan (message, tokens)"""
+        self._room_meta(user, room)
+        messages = self._user_rooms(user).setdefault(room, [])
+        stats = self._user_stats(user).setdefault(room, empty_room_stats())
+        now = time.time()
+        for message, tokens in items:
+            messages.append(message)
+            count_message_in_stats(stats, message, tokens, message.get("ts") or now)
+
+    def clear_room(self, user, room):
+        self._user_rooms(user)[room] = []
+        self._user_stats(user)[room] = empty_room_stats(time.time())
+
+    def delete_room(self, user, room):
+        self._user_rooms(user).pop(room, None)
+        self._user_stats(user).pop(room, None)
+        self._meta.get(user, {}).pop(room, None)
+        self._room_usage.get(user, {}).pop(room, None)  # Total user tetap mencakup biaya room ini
+
+    def rename_room(self, user, old_name, new_name):
+        # Bangun ulang dict agar urutan room tetap sama
+        self._rooms[user] = {(new_name if name == old_name else name): messages
+                             for name, messages in self._user_rooms(user).items()}
+        self._stats[user] = {(new_name if name == old_name else name): stats
+                             for name, stats in self._user_stats(user).items()}
+        for per_room in (self._meta.get(user, {}), self._room_usage.get(user, {})):
+            if old_name in per_room:
+                per_room[new_name] = per_room.pop(old_name)
+
+class SQLiteChatStorage:
+    """Storage persisten SQLite (WAL), pesan disimpan append-only per (room, seq)"""
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS rooms (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user TEXT NOT NULL,
+        name TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        meta TEXT,
+        UNIQUE (user, name)
+    );
+    CREATE TABLE IF NOT EXISTS messages (
+        room_id INTEGER NOT NULL REFERENCES rooms(id) ON DELETE CASCADE,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        meta TEXT,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (room_id, seq)
+    );
+    CREATE TABLE IF NOT EXISTS room_stats (
+        room_id INTEGER PRIMARY KEY REFERENCES rooms(id) ON DELETE CASCADE,
+        messages INTEGER NOT NULL DEFAULT 0,
+        user_messages INTEGER NOT NULL DEFAULT 0,
+        assistant_messages INTEGER NOT NULL DEFAULT 0,
+        chars INTEGER NOT NULL DEFAULT 0,
+        tokens INTEGER NOT NULL DEFAULT 0,
+        last_activity REAL
+    );
+    CREATE TABLE IF NOT EXISTS room_usage (
+        room_id INTEGER PRIMARY KEY REFERENCES rooms(id) ON DELETE CASCADE,
+        requests INTEGER NOT NULL DEFAULT 0,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        cached_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        total_tokens INTEGER NOT NULL DEFAULT 0,
+        cost REAL NOT NULL DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS user_usage (
+        user TEXT PRIMARY KEY,
+        requests INTEGER NOT NULL DEFAULT 0,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        cached_tokens INTEGER NOT NULL DEFAULT 0,
+        completion_tokens INTEGER NOT NULL DEFAULT 0,
+        total_tokens INTEGER NOT NULL DEFAULT 0,
+        cost REAL NOT NULL DEFAULT 0
+    );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.executescript(self.SCHEMA)
+            # Database lama tanpa kolom metadata room
+            if "meta" not in {row[1] for row in conn.execute("PRAGMA table_info(rooms)")}:
+                conn.execute("ALTER TABLE rooms ADD COLUMN meta TEXT")
+            # Database lama tanpa room_stats: hitung sekali dari messages (token diestimasi len // 4)
+            conn.execute("""
+                INSERT INTO room_stats (room_id, messages, user_messages, assistant_messages, chars, tokens, last_activity)
+                SELECT r.id, COUNT(m.seq), COALESCE(SUM(m.role = 'user'), 0), COALESCE(SUM(m.role = 'assistant'), 0),
+                       COALESCE(SUM(LENGTH(m.content)), 0), COALESCE(SUM(LENGTH(m.content) / 4), 0), MAX(m.created_at)
+                FROM rooms r LEFT JOIN messages m ON m.room_id = r.id
+                WHERE r.id NOT IN (SELECT room_id FROM room_stats)
+                GROUP BY r.id
+            """)
+
+    def _connect(self):
+        """Satu koneksi per thread (thread script Streamlit berbeda tiap session)"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        return conn
+
+    def _room_id(self, conn, user, room):
+        row = conn.execute("SELECT id FROM rooms WHERE user = ? AND name = ?", (user, room)).fetchone()
+        return row[0] if row else None
+
+    def room_stats(self, user):
+        rows = self._connect().execute(f"""
+            SELECT r.name, {", ".join(f"COALESCE(s.{field}, 0)" for field in ROOM_STAT_FIELDS)}, s.last_activity
+            FROM rooms r LEFT JOIN room_stats s ON s.room_id = r.id
+            WHERE r.user = ? ORDER BY r.id
+        """, (user,)).fetchall()
+        return {row[0]: dict(zip(ROOM_STAT_FIELDS + ("last_activity",), row[1:])) for row in rows}
+
+    def get_room_stats(self, user, room):
+        row = self._connect().execute(f"""
+            SELECT {", ".join(f"s.{field}" for field in ROOM_STAT_FIELDS)}, s.last_activity
+            FROM room_stats s JOIN rooms r ON r.id = s.room_id WHERE r.user = ? AND r.name = ?
+        """, (user, room)).fetchone()
+        return dict(zip(ROOM_STAT_FIELDS + ("last_activity",), row)) if row else empty_room_stats()
+
+    def ensure_room(self, user, room):
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO rooms (user, name, created_at) VALUES (?, ?, ?)",
+                         (user, room, time.time()))
+            conn.execute("INSERT OR IGNORE INTO room_stats (room_id) SELECT id FROM rooms WHERE user = ? AND name = ?",
+                         (user, room))
+
+    def get_room_metadata(self, user, room):
+        row = self._connect().execute("""
+            SELECT r.meta, r.created_at, s.last_activity FROM rooms r
+            LEFT JOIN room_stats s ON s.room_id = r.id WHERE r.user = ? AND r.name = ?
+        """, (user, room)).fetchone()
+        if row is None:
+            return {}
+        metadata = json.loads(row[0]) if row[0] else {}
+        metadata["created_at"] = row[1]
+        metadata["updated_at"] = row[2]
+        return metadata
+
+    def update_room_metadata(self, user, room, changes):
+        """Gabungkan changes ke metadata room (JSON di rooms.meta); nilai None menghapus key"""
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO rooms (user, name, created_at) VALUES (?, ?, ?)",
+                         (user, room, time.time()))
+            row = conn.execute("SELECT id, meta FROM rooms WHERE user = ? AND name = ?", (user, room)).fetchone()
+            metadata = json.loads(row[1]) if row[1] else {}
+            for key, value in changes.items():
+                if key == "updated_at":
+                    continue  # Diturunkan dari room_stats.last_activity
+                if key == "created_at":
+                    if value is not None:
+                        conn.execute("UPDATE rooms SET created_at = ? WHERE id = ?", (value, row[0]))
+                elif value is None:
+                    metadata.pop(key, None)
+                else:
+                    metadata[key] = value
+            conn.execute("UPDATE rooms SET meta = ? WHERE id = ?",
+                         (json.dumps(metadata, ensure_ascii=False) if metadata else None, row[0]))
+
+    def add_usage(self, user, room, usage):
+        """Catat usage satu request API ke room_usage (jika room masih ada) dan user_usage, satu transaksi"""
+        values = (1, usage["prompt_tokens"], usage.get("cached_tokens", 0), usage["completion_tokens"],
+                  usage["total_tokens"], usage["cost"])
+        increments = ", ".join(f"{field} = {field} + excluded.{field}" for field in USAGE_FIELDS)
+        with self._connect() as conn:
+            room_id = self._room_id(conn, user, room)
+            if room_id is not None:
+                conn.execute(f"""
+                    INSERT INTO room_usage (room_id, {", ".join(USAGE_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (room_id) DO UPDATE SET {increments}
+                """, (room_id, *values))
+            conn.execute(f"""
+                INSERT INTO user_usage (user, {", ".join(USAGE_FIELDS)}) VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user) DO UPDATE SET {increments}
+            """, (user, *values))
+
+    def usage_totals(self, user, room=None):
+        """Counter usage API room, atau seluruh user jika room None"""
+        if room is None:
+            row = self._connect().execute(f"SELECT {', '.join(USAGE_FIELDS)} FROM user_usage WHERE user = ?",
+                                          (user,)).fetchone()
+        else:
+            row = self._connect().execute(f"""
+                SELECT {", ".join(f"u.{field}" for field in USAGE_FIELDS)}
+                FROM room_usage u JOIN rooms r ON r.id = u.room_id WHERE r.user = ? AND r.name = ?
+            """, (user, room)).fetchone()
+        return dict(zip(USAGE_FIELDS, row)) if row else empty_usage_totals()
+
+    def count_messages(self, user, room):
+        # seq selalu berurutan dari 0 (append-only), jadi MAX(seq) + 1 = jumlah pesan via index
+        row = self._connect().execute("""
+            SELECT COALESCE(MAX(m.seq) + 1, 0) FROM messages m
+            JOIN rooms r ON r.id = m.room_id WHERE r.user = ? AND r.name = ?
+        """, (user, room)).fetchone()
+        return row[0]
+
+    def load_messages(self, user, room, offset=0, limit=None):
+        rows = self._connect().execute("""
+            SELECT m.role, m.content, m.meta FROM messages m
+            JOIN rooms r ON r.id = m.room_id
+            WHERE r.user = ? AND r.name = ? AND m.seq >= ?
+            ORDER BY m.seq LIMIT ?
+        """, (user, room, offset, -1 if limit is None else limit)).fetchall()
+        messages = []
+        for role, content, meta in rows:
+            message = json.loads(meta) if meta else {}
+            message["role"] = role
+            message["content"] = content
+            messages.append(message)
+        return messages
+
+    def iter_messages(self, user, room, batch_size=1000):
+        """Yield seluruh pesan room berurutan per batch cursor (export), ts = created_at"""
+        cursor = self._connect().execute("""
+            SELECT m.role, m.content, m.meta, m.created_at FROM messages m
+            JOIN rooms r ON r.id = m.room_id
+            WHERE r.user = ? AND r.name = ? ORDER BY m.seq
+        """, (user, room))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for role, content, meta, created_at in rows:
+                message = json.loads(meta) if meta else {}
+                message["role"] = role
+                message["content"] = content
+                message["ts"] = created_at
+                yield message
+
+    def append_message(self, user, room, message, tokens=0):
+        meta = {k: v for k, v in message.items() if k not in ("role", "content")}
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO rooms (user, name, created_at) VALUES (?, ?, ?)",
+                         (user, room, now))
+            room_id = self._room_id(conn, user, room)
+            conn.execute("""
+                INSERT INTO messages (room_id, seq, role, content, meta, created_at)
+                VALUES (?, (SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE room_id = ?), ?, ?, ?, ?)
+            """, (room_id, room_id, message["role"], message["content"],
+                  json.dumps(meta, ensure_ascii=False) if meta else None, now))
+            # Counter agregat ikut transaksi yang sama dengan insert pesan
+            conn.execute("""
+                INSERT INTO room_stats (room_id, messages, user_messages, assistant_messages, chars, tokens, last_activity)
+                VALUES (?, 1, ?, ?, ?, ?, ?)
+                ON CONFLICT (room_id) DO UPDATE SET
+                    messages = messages + 1,
+                    user_messages = user_messages + excluded.user_messages,
+                    assistant_messages = assistant_messages + excluded.assistant_messages,
+                    chars = chars + excluded.chars,
+                    tokens = tokens + excluded.tokens,
+                    last_activity = excluded.last_activity
+            """, (room_id, int(message["role"] == "user"), int(message["role"] == "assistant"),
+                  len(message["content"]), tokens, now))
+
+    def append_messages(self, user, room, items):
+        """Bulk append (import): items berisi pasangan (message, tokens), satu transaksi per panggilan.
+
+        Key "ts" pesan dipakai sebagai created_at sehingga waktu asli pesan ikut terbawa.
+        """
+        now = time.time()
+        stats = empty_room_stats()
+        with self._connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO rooms (user, name, created_at) VALUES (?, ?, ?)",
+                         (user, room, now))
+            room_id = self._room_id(conn, user, room)
+            seq = conn.execute("SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE room_id = ?",
+                               (room_id,)).fetchone()[0]
+            rows = []
+            for message, tokens in items:
+                meta = {k: v for k, v in message.items() if k not in ("role", "content", "ts")}
+                created_at = message.get("ts") or now
+                rows.append((room_id, seq, message["role"], message["content"],
+                             json.dumps(meta, ensure_ascii=False) if meta else None, created_at))
+                count_message_in_stats(stats, message, tokens, created_at)
+                seq += 1
+            if not rows:
+                return
+            conn.executemany("""
+                INSERT INTO messages (room_id, seq, role, content, meta, created_at) VALUES (?, ?, ?, ?, ?, ?)
+            """, rows)
+            conn.execute("""
+                INSERT INTO room_stats (room_id, messages, user_messages, assistant_messages, chars, tokens, last_activity)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (room_id) DO UPDATE SET
+                    messages = messages + excluded.messages,
+                    user_messages = user_messages + excluded.user_messages,
+                    assistant_messages = assistant_messages + excluded.assistant_messages,
+                    chars = chars + excluded.chars,
+                    tokens = tokens + excluded.tokens,
+                    last_activity = MAX(COALESCE(last_activity, 0), excluded.last_activity)
+            """, (room_id, *(stats[field] for field in ROOM_STAT_FIELDS), stats["last_activity"]))
+
+    def clear_room(self, user, room):
+        with self._connect() as conn:
+            room_id = self._room_id(conn, user, room)
+            if room_id is not None:
+                conn.execute("DELETE FROM messages WHERE room_id = ?", (room_id,))
+                conn.execute(f"""
+                    UPDATE room_stats SET {", ".join(f"{field} = 0" for field in ROOM_STAT_FIELDS)},
+                    last_activity = ? WHERE room_id = ?
+                """, (time.time(), room_id))
+
+    def delete_room(self, user, room):
+        with self._connect() as conn:
+            room_id = self._room_id(conn, user, room)
+            if room_id is not None:
+                conn.execute("DELETE FROM messages WHERE room_id = ?", (room_id,))
+                conn.execute("DELETE FROM room_stats WHERE room_id = ?", (room_id,))
+                conn.execute("DELETE FROM room_usage WHERE room_id = ?", (room_id,))  # user_usage tetap
+                conn.execute("DELETE FROM rooms WHERE id = ?", (room_id,))
+
+    def rename_room(self, user, old_name, new_name):
+        # Pesan mereferensikan room_id, jadi rename tidak menyentuh tabel messages
+        with self._connect() as conn:
+            conn.execute("UPDATE rooms SET name = ? WHERE user = ? AND name = ?",
+                         (new_name, user, old_name))
+
+@st.cache_resource(show_spinner=False)
+def create_sqlite_storage(path):
+    """Storage SQLite dibuat sekali per proses dan dipakai bersama semua session"""
+    return SQLiteChatStorage(path)
+
+def get_chat_storage_backend():
+    """st.secrets['chat_storage']: 'memory' atau 'sqlite' (server mode: room semua user di SQLite bersama)"""
+    return get_secret("chat_storage", "sqlite" if is_server_mode() else "memory")
+
+def get_chat_storage():
+    """Backend storage chatroom; SQLite bersama hanya dipakai setelah login terautentikasi"""
+    # Sebelum login belum ada identitas yang bisa dipercaya: pakai storage memori milik session
+    if get_chat_storage_backend() == "sqlite" and st.session_state.get("auth_user"):
+        default_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "chatrooms.db")
+        return create_sqlite_storage(get_secret("chat_storage_path", default_path))
+    if "memory_storage" not in st.session_state:
+        st.session_state.memory_storage = MemoryChatStorage()
+    return st.session_state.memory_storage
+
 # ===========================
 # CHATROOM MANAGEMENT - FIXED
 # ===========================
+OPEN_ROOMS_LIMIT = 8  # Room yang halaman pesannya tetap di memori session (LRU)
+
+class Chatroom:
+    """Room yang sedang dibuka: ekor log pesan append-only, posisi render, counter agregat dan metadata"""
+    __slots__ = ("name", "messages", "offset", "render_window", "seen_upto", "stats", "metadata")
+
+    def __init__(self, name, messages, offset, stats, metadata=None):
+        self.name = name
+        self.messages = messages  # Pesan dengan indeks absolut offset .. total-1 (satu-satunya salinan di session)
+        self.offset = offset
+        self.render_window = CHAT_RENDER_WINDOW  # Jumlah pesan terakhir yang dirender
+        self.seen_upto = 0  # Pesan dengan indeks absolut < seen_upto sudah pernah dianimasikan
+        self.stats = stats
+        self.metadata = metadata or {}  # created_at, updated_at, role, model, ... (tersimpan di storage)
+
+    @property
+    def total(self):
+        return self.offset + len(self.messages)
+
+    def append(self, message, tokens=0):
+        self.messages.append(message)
+        count_message_in_stats(self.stats, message, tokens, time.time())
+
+    def prepend(self, earlier):
+        """Sisipkan halaman pesan lebih lama di depan (hasil load dari storage)"""
+        self.messages[:0] = earlier
+        self.offset -= len(earlier)
+
+    def clear(self):
+        self.messages = []
+        self.offset = 0
+        self.render_window = CHAT_RENDER_WINDOW
+        self.seen_upto = 0
+        self.stats = empty_room_stats(time.time())
+
+    def mark_seen(self):
+        self.seen_upto = self.total
+
+class RoomManager:
+    """Room milik satu user di satu session: room aktif + cache LRU room yang pernah dibuka.
+
+    Semua operasi (switch, rename, delete) hanya memindahkan referensi Chatroom; history tidak
+    pernah disalin dan tiap pesan yang dimuat hanya ada di satu Chatroom.
+    """
+    __slots__ = ("storage", "user", "current_name", "counter", "_open_rooms")
+
+    def __init__(self, storage, user, current_name="Default"):
+        self.storage = storage
+        self.user = user
+        self.current_name = current_name
+        self.counter = 1  # Nomor untuk nama "Room N" berikutnya
+        self._open_rooms = OrderedDict()  # name -> Chatroom
+
+    def open(self, name):
+        """Chatroom dari cache, atau muat halaman terakhirnya dari storage (lazy)"""
+        room = self._open_rooms.get(name)
+        if room is None:
+            self.storage.ensure_room(self.user, name)
+            total = self.storage.count_messages(self.user, name)
+            offset = max(0, total - CHAT_PAGE_SIZE)
+            room = Chatroom(name, self.storage.load_messages(self.user, name, offset, CHAT_PAGE_SIZE), offset,
+                            self.storage.get_room_stats(self.user, name),
+                            self.storage.get_room_metadata(self.user, name))
+            self._open_rooms[name] = room
+            while len(self._open_rooms) > OPEN_ROOMS_LIMIT:
+                oldest = next(iter(self._open_rooms))
+                if oldest == self.current_name:
+                    self._open_rooms.move_to_end(oldest)
+                    oldest = next(iter(self._open_rooms))
+                del self._open_rooms[oldest]
+        else:
+            self._open_rooms.move_to_end(name)
+        return room
+
+    @property
+    def current(self):
+        return self.open(self.current_name)
+
+    def list_rooms(self):
+        """Dict nama room -> counter agregat dari storage; room Default dan room aktif selalu ada"""
+        rooms = self.storage.room_stats(self.user)
+        missing = [name for name in ("Default", self.current_name) if name not in rooms]
+        if missing:
+            for name in missing:
+                self.storage.ensure_room(self.user, name)
+            rooms = self.storage.room_stats(self.user)
+        return rooms
+
+    def switch(self, name):
+        self.current_name = name
+        return self.current
+
+    def create(self):
+        """Buat room baru bernama "Room N" yang belum dipakai; return namanya"""
+        existing = self.list_rooms()
+        while f"Room {self.counter}" in existing:
+            self.counter += 1
+        name = f"Room {self.counter}"
+        self.counter += 1
+        self.storage.ensure_room(self.user, name)
+        return name
+
+    def rename(self, old_name, new_name):
+        self.storage.rename_room(self.user, old_name, new_name)
+        room = self._open_rooms.pop(old_name, None)
+        if room is not None:
+            room.name = new_name
+            self._open_rooms[new_name] = room
+        if self.current_name == old_name:
+            self.current_name = new_name
+
+    def delete(self, name):
+        """Hapus room; jika room aktif yang dihapus, pindah ke Default"""
+        self.storage.delete_room(self.user, name)
+        self._open_rooms.pop(name, None)
+        if self.current_name == name:
+            self.current_name = "Default"
+
+    def append(self, message, tokens=0):
+        """Insert append-only ke storage lalu ke Chatroom aktif"""
+        room = self.current
+        self.storage.append_message(self.user, room.name, message, tokens=tokens)
+        room.append(message, tokens)
+
+    def clear(self):
+        room = self.current
+        self.storage.clear_room(self.user, room.name)
+        room.clear()
+
+    def sync(self, name):
+        """Tarik pesan yang ditulis di luar session ini (worker generate) ke Chatroom yang sedang dibuka"""
+        room = self._open_rooms.get(name)
+        if room is None:
+            return  # Dimuat lengkap dari storage saat dibuka
+        total = self.storage.count_messages(self.user, name)
+        if total > room.total:
+            room.messages.extend(self.storage.load_messages(self.user, name, room.total))
+        room.stats = self.storage.get_room_stats(self.user, name)
+        room.metadata = self.storage.get_room_metadata(self.user, name)
+
+    def update_metadata(self, name, changes):
+        """Simpan perubahan metadata room ke storage dan ke Chatroom yang sedang dibuka"""
+        self.storage.update_room_metadata(self.user, name, changes)
+        room = self._open_rooms.get(name)
+        if room is not None:
+            room.metadata = self.storage.get_room_metadata(self.user, name)
+
+    def reload(self, name):
+        """Lepas Chatroom dari cache agar dibuka ulang (halaman terakhir saja) dari storage"""
+        self._open_rooms.pop(name, None)
+
+    def load_earlier(self):
+        """Muat satu halaman pesan sebelum pesan paling awal yang sudah dimuat; return jumlahnya"""
+        room = self.current
+        if room.offset <= 0:
+            return 0
+        new_offset = max(0, room.offset - CHAT_PAGE_SIZE)
+        earlier = self.storage.load_messages(self.user, room.name, new_offset, room.offset - new_offset)
+        room.prepend(earlier)
+        return len(earlier)
+
+def get_storage_user():
+    """Key room di storage: username terautentikasi untuk storage bersama, nama panggilan untuk storage memori"""
+    if requires_account():
+        return st.session_state.get("auth_user", "")
+    return st.session_state.get("user_name", "")
+
+def get_room_manager():
+    """RoomManager session ini; dibuat ulang jika user login berganti atau backend storage berubah"""
+    manager = st.session_state.get("room_manager")
+    storage = get_chat_storage()
+    user = get_storage_user()
+    if manager is None or manager.user != user or manager.storage is not storage:
+        manager = RoomManager(storage, user)
+        st.session_state.room_manager = manager
+    return manager
+
+def get_current_room():
+    """Chatroom aktif (halaman pesan yang sudah dimuat + stats)"""
+    return get_room_manager().current
+
+def get_current_room_name():
+    return get_room_manager().current_name
+
 def get_current_messages():
-    """Get messages for current chatroom"""
-    current_room = st.session_state.current_chatroom
-    if current_room not in st.session_state.chatrooms:
-        st.session_state.chatrooms[current_room] = []
-    return st.session_state.chatrooms[current_room]
+    """Get messages (yang sudah dimuat) for current chatroom"""
+    return get_current_room().messages
 
-def save_current_messages(messages):
-    """Save messages to current chatroom"""
-    current_room = st.session_state.current_chatroom
-    st.session_state.chatrooms[current_room] = messages
+def append_current_message(message):
+    """Tambahkan satu pesan ke chatroom aktif (insert append-only ke storage)"""
+    get_room_manager().append(message, tokens=count_tokens(message["content"]))
+
+def clear_current_room():
+    """Kosongkan chatroom aktif beserta ringkasannya (jawaban yang sedang dibuat dibatalkan)"""
+    get_generation_pool().cancel(get_session_id(), get_current_room_name())
+    get_room_manager().clear()
+    reset_room_summary(get_current_room_name())
+
+def list_chatrooms():
+    """Dict nama room -> counter agregat (messages, chars, tokens, ...) untuk user aktif.
+
+    Room Default dan room aktif selalu ada. Counter dibaca dari storage, bukan dihitung dari pesan.
+    """
+    return get_room_manager().list_rooms()
 
 def switch_chatroom(room_name):
     """Switch to different chatroom"""
-    # Save current messages
-    if st.session_state.messages:
-        save_current_messages(st.session_state.messages)
-    
-    # Switch room
-    st.session_state.current_chatroom = room_name
-    
-    # Load messages for new room
-    st.session_state.messages = get_current_messages()
+    get_room_manager().switch(room_name)
+    # Lepas state selector agar mengikuti room aktif, bukan pilihan lama
+    st.session_state.pop("room_selector", None)
 
 def create_new_chatroom():
     """Create new chatroom"""
-    new_name = f"Room {st.session_state.chatroom_counter}"
-    st.session_state.chatrooms[new_name] = []
-    st.session_state.chatroom_counter += 1
+    new_name = get_room_manager().create()
     switch_chatroom(new_name)
     return new_name
 
+def rename_chatroom(old_name, new_name):
+    """Rename chatroom tanpa menyalin history"""
+    pool = get_generation_pool()
+    job = pool.get(get_session_id(), old_name)
+    # Tahan lock job agar worker tidak menulis jawaban ke nama lama di tengah rename
+    with job.lock if job is not None else contextlib.nullcontext():
+        get_room_manager().rename(old_name, new_name)
+        pool.rename(get_session_id(), old_name, new_name)
+    st.session_state.pop("room_selector", None)
+
 def delete_chatroom(room_name):
-    """Delete chatroom - FIXED: Automatic clear messages"""
-    if room_name != "Default" and len(st.session_state.chatrooms) > 1:
-        # Hapus room dari dictionary
-        del st.session_state.chatrooms[room_name]
-        
-        # Jika room yang dihapus adalah room aktif, pindah ke Default
-        if st.session_state.current_chatroom == room_name:
-            switch_chatroom("Default")
-        
-        # Clear messages jika room yang dihapus adalah yang aktif saat ini
-        if st.session_state.current_chatroom == room_name:
-            st.session_state.messages = []
-            
-        return True
-    return False
+    """Hapus room (kecuali Default dan room terakhir); room aktif yang dihapus pindah ke Default"""
+    if room_name == "Default" or len(list_chatrooms()) <= 1:
+        return False
+    get_generation_pool().cancel(get_session_id(), room_name)
+    get_room_manager().delete(room_name)
+    st.session_state.pop("room_selector", None)
+    return True
+
+# ===========================
+# CHATROOM EXPORT / IMPORT
+# ===========================
+ARCHIVE_FORMAT = "final-project/chatrooms"
+ARCHIVE_VERSION = 1
+ARCHIVE_MESSAGE_FIELDS = ("role", "content", "model", "params", "usage", "truncated", "error", "ts")
+ARCHIVE_MESSAGE_ROLES = ("user", "assistant", "system")
+# Tipe tiap field yang boleh diimpor; "ts" dan "created_at" dipakai datetime.fromtimestamp di sidebar
+ARCHIVE_FIELD_TYPES = {"content": str, "model": str, "params": dict, "usage": dict, "truncated": bool,
+                       "error": str, "ts": float, "created_at": float, "role": str}
+# Metadata room yang boleh ikut impor (summary tidak: isinya masuk ke system prompt)
+ARCHIVE_METADATA_FIELDS = ("created_at", "role", "model")
+ARCHIVE_BATCH_SIZE = 1000  # Pesan per transaksi storage saat impor
+ARCHIVE_SPOOL_SIZE = 8 * 1024 * 1024  # File export lebih besar dari ini ditulis ke disk, bukan RAM
+
+class ArchiveError(ValueError):
+    """File impor bukan export chatroom yang valid"""
+
+def export_rooms(storage, user, rooms, fileobj, compress=True):
+    """Tulis room ke fileobj sebagai JSONL (gzip) satu pesan per baris; return dict room -> jumlah pesan.
+
+    Pesan dibaca dari storage dan ditulis bertahap, history tidak pernah dibangun jadi satu string.
+    """
+    raw = gzip.GzipFile(fileobj=fileobj, mode="wb", compresslevel=6, mtime=0) if compress else fileobj
+    out = io.TextIOWrapper(raw, encoding="utf-8", newline="\n")
+    counts = {}
+    try:
+        out.write(json.dumps({"type": "header", "format": ARCHIVE_FORMAT, "version": ARCHIVE_VERSION,
+                              "exported_at": time.time(), "rooms": len(rooms)}) + "\n")
+        for room in rooms:
+            out.write(json.dumps({"type": "room", "name": room, "metadata": storage.get_room_metadata(user, room)},
+                                 ensure_ascii=False) + "\n")
+            counts[room] = 0
+            for message in storage.iter_messages(user, room):
+                record = {"type": "message"}
+                record.update((field, message[field]) for field in ARCHIVE_MESSAGE_FIELDS
+                              if message.get(field) is not None)
+                out.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+                counts[room] += 1
+    finally:
+        out.flush()
+        out.detach()  # fileobj milik pemanggil tetap terbuka
+        if compress:
+            raw.close()
+    return counts
+
+def iter_archive(fileobj):
+    """Yield record dari file export (gzip atau JSONL biasa, dideteksi dari magic byte) baris per baris"""
+    compressed = fileobj.read(2) == b"\x1f\x8b"
+    fileobj.seek(0)
+    raw = gzip.GzipFile(fileobj=fileobj, mode="rb") if compressed else fileobj
+    lines = io.TextIOWrapper(raw, encoding="utf-8")
+    line_number = 0
+    try:
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise ArchiveError(f"Baris {line_number} bukan JSON valid: {e}") from e
+            if not isinstance(record, dict):
+                raise ArchiveError(f"Baris {line_number} bukan object JSON")
+            yield record
+    except UnicodeDecodeError as e:
+        raise ArchiveError(f"Baris {line_number + 1} bukan teks UTF-8") from e
+    except (gzip.BadGzipFile, EOFError, zlib.error) as e:
+        raise ArchiveError(f"File gzip rusak atau terpotong: {e}") from e
+    finally:
+        lines.detach()
+        if compressed:
+            raw.close()
+
+def archive_value_valid(field, value):
+    """Cek tipe nilai field archive; timestamp (ts, created_at) harus angka yang bisa ditampilkan sebagai tanggal"""
+    expected = ARCHIVE_FIELD_TYPES.get(field)
+    if expected is not float:
+        return expected is None or isinstance(value, expected)
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value) or value < 0:
+        return False
+    try:
+        datetime.fromtimestamp(value)
+    except (OverflowError, OSError, ValueError):
+        return False
+    return True
+
+def unique_room_name(name, taken):
+    """Nama room yang belum dipakai: "<nama>", "<nama> (impor)", "<nama> (impor 2)", ..."""
+    candidate, n = name, 1
+    while candidate in taken:
+        candidate = f"{name} (impor)" if n == 1 else f"{name} (impor {n})"
+        n += 1
+    return candidate
+
+def import_rooms(storage, user, fileobj, batch_size=ARCHIVE_BATCH_SIZE):
+    """Impor room dari file export per batch; return dict nama room tujuan -> jumlah pesan.
+
+    Room yang sudah berisi pesan tidak ditimpa: isinya masuk ke room baru "<nama> (impor)".
+    Jika file rusak di tengah, batch yang sudah tertulis tetap tersimpan.
+    """
+    records = iter_archive(fileobj)
+    header = next(records, None)
+    if not header or header.get("type") != "header" or header.get("format") != ARCHIVE_FORMAT:
+        raise ArchiveError("Bukan file export chatroom")
+    version = header.get("version")
+    if not isinstance(version, int) or isinstance(version, bool) or version < 1:
+        raise ArchiveError(f"Versi export tidak valid: {version!r}")
+    if version > ARCHIVE_VERSION:
+        raise ArchiveError(f"Versi export {version} lebih baru dari yang didukung ({ARCHIVE_VERSION})")
+
+    taken = {name for name, stats in storage.room_stats(user).items() if stats["messages"]}
+    imported = {}
+    room, batch = None, []
+    for record in records:
+        kind = record.get("type")
+        if kind == "room":
+            if batch:
+                storage.append_messages(user, room, batch)
+                batch = []
+            # Whitespace dirapikan: baris baru di nama room akan memecah blok HTML sidebar
+            metadata = record.get("metadata") or {}
+            if not isinstance(metadata, dict):
+                raise ArchiveError(f"Metadata room '{record.get('name')}' tidak valid")
+            metadata = {field: metadata[field] for field in ARCHIVE_METADATA_FIELDS if metadata.get(field) is not None}
+            invalid = [field for field, value in metadata.items() if not archive_value_valid(field, value)]
+            if invalid:
+                raise ArchiveError(f"Metadata room '{record.get('name')}' tidak valid: {', '.join(invalid)}")
+            room = unique_room_name(" ".join(str(record.get("name") or "").split()) or "Impor", taken)
+            taken.add(room)
+            storage.ensure_room(user, room)
+            if metadata:
+                storage.update_room_metadata(user, room, metadata)
+            imported[room] = 0
+        elif kind == "message":
+            if room is None:
+                raise ArchiveError("Pesan muncul sebelum baris room")
+            message = {field: record[field] for field in ARCHIVE_MESSAGE_FIELDS if record.get(field) is not None}
+            if (message.get("role") not in ARCHIVE_MESSAGE_ROLES or "content" not in message
+                    or not all(archive_value_valid(field, value) for field, value in message.items())):
+                raise ArchiveError(f"Pesan ke-{imported[room] + 1} di room '{room}' tidak valid")
+            # Token diestimasi len // 4 (seperti migrasi room_stats) agar impor besar tidak menunggu tokenizer
+            batch.append((message, len(message["content"]) // 4))
+            imported[room] += 1
+            if len(batch) >= batch_size:
+                storage.append_messages(user, room, batch)
+                batch = []
+    if batch:
+        storage.append_messages(user, room, batch)
+    return imported
+
+def archive_file_name(rooms):
+    stamp = datetime.now().strftime("%Y%m%d-%H%M")
+    if len(rooms) == 1:
+        slug = re.sub(r"[^A-Za-z0-9_-]+", "-", rooms[0]).strip("-") or "room"
+        return f"chatroom-{slug}-{stamp}.jsonl.gz"
+    return f"chatrooms-{stamp}.jsonl.gz"
+
+def export_chatrooms(rooms):
+    """Callable untuk st.download_button: file export baru dibuat saat tombol diklik (di thread lain)"""
+    storage = get_chat_storage()
+    user = get_storage_user()
+
+    def build():
+        spool = tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE)
+        export_rooms(storage, user, rooms, spool)
+        spool.seek(0)
+        return spool
+    return build
+
+def import_chatrooms(fileobj):
+    """Impor file export ke storage user aktif; room yang sedang terbuka dimuat ulang dari storage"""
+    imported = import_rooms(get_chat_storage(), get_storage_user(), fileobj)
+    manager = get_room_manager()
+    for name in imported:
+        manager.reload(name)
+    return imported
 
 # ===========================
 # LOGIN SYSTEM
 # ===========================
+PASSWORD_HASH_ITERATIONS = 200_000
+
+def is_server_mode():
+    """Mode multi-user: login dengan akun di st.secrets['users'] dan API key OpenRouter bersama"""
+    return bool(get_secret("server_mode", False))
+
+def requires_account():
+    """Login username/password wajib di server mode dan saat room disimpan di SQLite (persisten, bersama).
+
+    Tanpa itu key storage hanyalah nama panggilan bebas: siapa pun yang mengetik nama yang sama bisa
+    membaca dan menghapus room orang lain.
+    """
+    return is_server_mode() or get_chat_storage_backend() == "sqlite"
+
+def hash_password(password, salt=None, iterations=PASSWORD_HASH_ITERATIONS):
+    """Hash password untuk [users] di secrets.toml: pbkdf2_sha256$iterasi$salt$hash"""
+    salt = salt or os.urandom(16).hex()
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt.encode("utf-8"), iterations).hex()
+    return f"pbkdf2_sha256${iterations}${salt}${digest}"
+
+def authenticate_user(username, password):
+    """Cocokkan username/password dengan hash di st.secrets['users']"""
+    stored = (get_secret("users", {}) or {}).get(username)
+    if not stored or not password:
+        return False
+    try:
+        algorithm, iterations, salt, _ = stored.split("$")
+        iterations = int(iterations)
+    except ValueError:
+        return False
+    if algorithm != "pbkdf2_sha256":
+        return False
+    return hmac.compare_digest(hash_password(password, salt, iterations), stored)
+
 def render_login():
     """Tampilkan form login dengan animasi"""
     col1, col2, col3 = st.columns([1, 2, 1])
+    server_mode = is_server_mode()
+    account_required = requires_account()
     
     with col2:
         with st.form("registration_form"):
-            st.markdown("### 📝 Registrasi Pengguna")
-            
-            name = st.text_input(
-                "Nama Panggilan *",
-                placeholder="Contoh: Ucup atau mawar",
-                help="Nama yang akan digunakan AI untuk memanggil Anda"
-            )
-            
-            api_key = st.text_input(
-                "OpenRouter API Key *",
-                type="password",
-                placeholder="sk-or-...",
-                help="API Key diperlukan untuk mengakses layanan AI"
-            )
+            if account_required:
+                st.markdown("### 🔐 Login Tim" if server_mode else "### 🔐 Login")
+                name = st.text_input("Username *", placeholder="Username dari admin")
+                password = st.text_input("Password *", type="password")
+                if not server_mode:
+                    # Room tersimpan persisten: identitas dari akun, API key tetap milik user sendiri
+                    api_key = st.text_input("OpenRouter API Key *", type="password", placeholder="sk-or-...")
+            else:
+                st.markdown("### 📝 Registrasi Pengguna")
+                
+                name = st.text_input(
+                    "Nama Panggilan *",
+                    placeholder="Contoh: Ucup atau mawar",
+                    help="Nama yang akan digunakan AI untuk memanggil Anda"
+                )
+                
+                api_key = st.text_input(
+                    "OpenRouter API Key *",
+                    type="password",
+                    placeholder="sk-or-...",
+                    help="API Key diperlukan untuk mengakses layanan AI"
+                )
             
             st.markdown("---")
             st.markdown("### 🎭 Pilih Role AI Favoritmu")
@@ -584,15 +1239,15 @@ def render_login():
             cols = st.columns(3)
             
             for idx, (role_key, config) in enumerate(role_configs.items()):
-                with cols[idx]:
+                with cols[idx % len(cols)]:
                     st.markdown(f"""
                     <div class="role-card" style="animation-delay: {idx * 0.2}s;">
-                        <div style="font-size: 3rem; text-align: center;">{config['icon']}</div>
-                        <h4 style="text-align: center; margin: 0.5rem 0; color: {config['color']};">
-                            {config['name'].replace(config['icon'], '').strip()}
+                        <div style="font-size: 3rem; text-align: center;">{config.icon}</div>
+                        <h4 style="text-align: center; margin: 0.5rem 0; color: {config.color};">
+                            {config.name.replace(config.icon, '').strip()}
                         </h4>
                         <p style="text-align: center; font-size: 0.9rem; color: #666;">
-                            {config['description']}
+                            {config.description}
                         </p>
                     </div>
                     """, unsafe_allow_html=True)
@@ -625,13 +1280,27 @@ def render_login():
             
             submit = st.form_submit_button("🚀 Daftar & Mulai", type="primary", use_container_width=True)
             
-            if submit:
+            if submit and account_required:
+                if not server_mode and not api_key.strip():
+                    show_error_message("API Key wajib diisi!")
+                elif authenticate_user(name.strip(), password):
+                    # Server mode: API key OpenRouter bersama diambil dari st.secrets
+                    st.session_state.user_name = name.strip()
+                    st.session_state.auth_user = name.strip()
+                    st.session_state.api_key = "" if server_mode else api_key.strip()
+                    st.session_state.is_logged_in = True
+                    notify(f"Selamat datang {name.strip()}!")
+                    st.rerun()
+                else:
+                    show_error_message("Username atau password salah!")
+                    if not get_secret("users"):
+                        st.info('💡 Storage persisten (chat_storage = "sqlite") butuh akun di [users] secrets.toml')
+            elif submit:
                 if name.strip() and api_key.strip():
                     st.session_state.user_name = name.strip()
                     st.session_state.api_key = api_key.strip()
                     st.session_state.is_logged_in = True
-                    show_success_message(f"Selamat datang {name}! Registrasi berhasil!")
-                    time.sleep(1)
+                    notify(f"Selamat datang {name}! Registrasi berhasil!")
                     st.rerun()
                 else:
                     show_error_message("Nama panggilan dan API Key wajib diisi!")
@@ -639,76 +1308,1505 @@ def render_login():
                         st.info("💡 Dapatkan API Key gratis di: https://openrouter.ai/keys")
 
 # ===========================
-# API FUNCTIONS
+# HTTP CLIENT (POOLED)
 # ===========================
-def get_api_key():
-    """Mendapatkan API key"""
-    if st.session_state.api_key:
-        return st.session_state.api_key
+def get_secret(name, default=None):
+    """Baca nilai dari st.secrets, fallback ke default jika tidak ada"""
     try:
-        return st.secrets["openrouter_api_key"]
-    except:
-        return None
+        return st.secrets[name]
+    except Exception:
+        return default
 
-def get_ai_response(user_input):
-    """Mendapatkan respons AI dari OpenRouter API"""
-    api_key = get_api_key()
-    if not api_key:
-        show_error_message("API key tidak ditemukan. Silakan masukkan API key di sidebar.")
-        return None
-    
-    # Prepare messages dengan system message
-    messages = [get_system_message()]
-    for message in st.session_state.messages:
-        if message["role"] != "system":
-            messages.append(message)
-    messages.append({"role": "user", "content": user_input})
+@st.cache_resource(show_spinner=False)
+def create_http_client(base_url, connect_timeout, read_timeout, max_retries):
+    """Client dibuat sekali per proses dan dipakai bersama semua session"""
+    return OpenRouterClient(base_url=base_url, connect_timeout=connect_timeout,
+                            read_timeout=read_timeout, max_retries=max_retries)
+
+def get_http_client():
+    """Ambil client OpenRouter bersama (konfigurasi dari st.secrets)"""
+    return create_http_client(
+        get_secret("openrouter_base_url", OPENROUTER_BASE_URL),
+        float(get_secret("openrouter_connect_timeout", 5.0)),
+        float(get_secret("openrouter_read_timeout", 60.0)),
+        int(get_secret("openrouter_max_retries", 3)),
+    )
+
+# ===========================
+# UPSTREAM SCHEDULER (FAIR CONCURRENCY)
+# ===========================
+@st.cache_resource(show_spinner=False)
+def create_scheduler(max_concurrent, max_per_user, max_waiting):
+    """Scheduler dibuat sekali per proses, dipakai bersama semua session"""
+    return FairScheduler(max_concurrent=max_concurrent, max_per_user=max_per_user, max_waiting=max_waiting)
+
+def get_scheduler():
+    """Scheduler upstream (batas dari st.secrets)"""
+    return create_scheduler(
+        int(get_secret("upstream_max_concurrent", 16)),
+        int(get_secret("upstream_max_per_user", 4)),
+        int(get_secret("upstream_max_queue", 64)),
+    )
 
+@st.cache_resource(show_spinner=False)
+def create_rate_limiter(key_rpm, model_rpm, free_model_rpm, max_wait):
+    """Rate limiter dibuat sekali per proses, dipakai bersama semua session"""
+    return RateLimiter(key_rpm=key_rpm, model_rpm=model_rpm, free_model_rpm=free_model_rpm, max_wait=max_wait)
+
+def get_rate_limiter():
+    """Rate limiter upstream (batas per menit dari st.secrets, 0 = tanpa batas)"""
+    return create_rate_limiter(
+        int(get_secret("rate_limit_key_rpm", 0)),
+        int(get_secret("rate_limit_model_rpm", 0)),
+        int(get_secret("rate_limit_free_rpm", 20)),
+        float(get_secret("rate_limit_max_wait", 10.0)),
+    )
+
+def get_key_id(headers):
+    """Sidik jari API key (hash) untuk kunci limiter, tanpa menyimpan key aslinya"""
+    return hashlib.sha256(headers.get("Authorization", "").encode("utf-8")).hexdigest()[:12]
+
+def get_scheduler_user(headers, payload):
+    """Tenant untuk scheduler: field user OpenRouter (server mode) atau hash API key"""
+    return payload.get("user") or get_key_id(headers)
+
+@contextlib.contextmanager
+def upstream_slot(headers, payload, on_wait=None):
+    """Kuota rate + satu slot upstream selama request (termasuk membaca stream) berjalan.
+
+    on_wait(teks) dipanggil saat request harus menunggu kuota atau antre slot.
+    """
+    model = payload["model"]
+    key_id = get_key_id(headers)
+    limiter = get_rate_limiter()
+    allowed, wait = limiter.reserve(key_id, model)
+    if not allowed:
+        raise RateLimitedError(f"Batas request untuk {model} tercapai, coba lagi dalam ~{wait:.0f} detik")
+    if wait > 0:
+        if on_wait is not None:
+            on_wait(f"⏳ Menunggu kuota rate {model} (~{wait:.0f} dtk)...")
+        time.sleep(wait)
+    
+    scheduler = get_scheduler()
+    user = get_scheduler_user(headers, payload)
+    queue_feedback = None
+    if on_wait is not None:
+        queue_feedback = lambda position: on_wait(f"⏳ Antrean ke-{position}, menunggu slot request...")
+    if not scheduler.acquire(user, timeout=float(get_secret("upstream_wait_timeout", 30.0)),
+                             on_wait=queue_feedback):
+        raise UpstreamBusyError("Semua slot request sedang dipakai, coba lagi sebentar lagi")
     try:
-        response = requests.post(
-            url="https://openrouter.ai/api/v1/chat/completions",
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {api_key}",
-            },
-            data=json.dumps({
-                "model": st.session_state.selected_model,
-                "messages": messages,
-                "max_tokens": st.session_state.max_tokens,
-                "temperature": st.session_state.temperature,
-            })
-        )
-        
-        response.raise_for_status()
-        return response.json()["choices"][0]["message"]["content"]
-        
+        yield
     except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 402:
-            st.markdown("""
-            <div class="error-shake" style="background: linear-gradient(45deg, #e74c3c, #c0392b); 
-                 color: white; padding: 1.5rem; border-radius: 15px; margin: 1rem 0;">
-                <h3 style="margin: 0 0 1rem 0;">💳 Error 402: Payment Required</h3>
-                <p><strong>🔧 Solusi:</strong></p>
-                <ul>
-                    <li><strong>Ganti ke model GRATIS</strong> (yang ada icon 🆓)</li>
-                    <li><strong>Top up kredit</strong> di <a href="https://openrouter.ai/credits" style="color: #fff;">OpenRouter.ai</a></li>
-                    <li><strong>Cek saldo</strong> di dashboard OpenRouter</li>
-                </ul>
-                <p><strong>💡 Model gratis yang direkomendasikan:</strong><br>
-                🆓 Mistral 7B, Google Gemma 7B, Llama 3 8B</p>
-            </div>
-            """, unsafe_allow_html=True)
-            return None
-        else:
-            show_error_message(f"HTTP Error {e.response.status_code}: {e}")
-            return None
-    except Exception as e:
-        show_error_message(f"Terjadi kesalahan: {e}")
-        return None
+        if e.response is not None and e.response.status_code == 429:
+            retry_after = parse_retry_after(e.response)
+            limiter.penalize(key_id, model, retry_after if retry_after is not None else 60.0)
+        raise
+    finally:
+        scheduler.release(user)
+
+# ===========================
+# RESPONSE CACHE
+# ===========================
+class ResponseCache:
+    """Cache respons AI: LRU + TTL di memori dengan tier disk opsional (disk_dir None = hanya memori)"""
+
+    def __init__(self, max_entries=256, max_chars=2_000_000, ttl=3600, disk_dir=None,
+                 max_disk_entries=5000, max_temperature=0.3):
+        self.max_entries = max_entries
+        self.max_chars = max_chars
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.max_disk_entries = max_disk_entries
+        self.max_temperature = max_temperature
+        
+        self._entries = OrderedDict()  # key -> (expires_at, content), urutan = LRU
+        self._chars = 0
+        self._lock = threading.Lock()
+        self._metrics = {"hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(payload):
+        """Hash dari model, messages (termasuk system message), temperature dan max_tokens"""
+        key_data = {
+            "model": payload["model"],
+            "messages": payload["messages"],
+            "temperature": payload["temperature"],
+            "max_tokens": payload["max_tokens"],
+        }
+        raw = json.dumps(key_data, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def is_cacheable(self, payload):
+        """Hanya request dengan temperature rendah yang hasilnya cukup deterministik"""
+        return payload["temperature"] <= self.max_temperature
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, content = entry
+                if expires_at > now:
+                    self._entries.move_to_end(key)
+                    self._metrics["hits"] += 1
+                    return content
+                self._remove(key)
+        
+        content = self._disk_get(key, now)
+        with self._lock:
+            if content is None:
+                self._metrics["misses"] += 1
+                return None
+            self._metrics["hits"] += 1
+            self._metrics["disk_hits"] += 1
+        # Promote ke memori
+        self._memory_put(key, content, now + self.ttl)
+        return content
+
+    def put(self, key, content):
+        expires_at = time.time() + self.ttl
+        self._memory_put(key, content, expires_at)
+        with self._lock:
+            self._metrics["stores"] += 1
+            stores = self._metrics["stores"]
+        self._disk_put(key, content, expires_at, prune=stores % 50 == 0)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["entries"] = len(self._entries)
+            stats["chars"] = self._chars
+        return stats
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._chars = 0
+        if self.disk_dir:
+            for name in os.listdir(self.disk_dir):
+                if name.endswith(".json"):
+                    try:
+                        os.remove(os.path.join(self.disk_dir, name))
+                    except OSError:
+                        pass
+
+    def _remove(self, key):
+        _, content = self._entries.pop(key)
+        self._chars -= len(content)
+
+    def _memory_put(self, key, content, expires_at):
+        if len(content) > self.max_chars:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, content)
+            self._chars += len(content)
+            # Evict LRU sampai kembali dalam batas jumlah entry dan total karakter
+            while len(self._entries) > self.max_entries or self._chars > self.max_chars:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._metrics["evictions"] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get("expires_at", 0) <= now:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        return entry.get("content")
+
+    def _disk_put(self, key, content, expires_at, prune=False):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"expires_at": expires_at, "content": content}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """Hapus entry disk terlama jika melebihi max_disk_entries"""
+        try:
+            files = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir)
+                     if name.endswith(".json")]
+        except OSError:
+            return
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=lambda path: os.path.getmtime(path))
+        for path in files[:len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+@st.cache_resource(show_spinner=False)
+def create_response_cache(disk_dir, ttl, max_temperature):
+    """Cache respons dibuat sekali per proses dan dipakai bersama semua session"""
+    return ResponseCache(disk_dir=disk_dir, ttl=ttl, max_temperature=max_temperature)
+
+def get_response_cache():
+    """Ambil response cache bersama (konfigurasi dari st.secrets).
+
+    Tier disk opt-in lewat response_cache_dir: isinya jawaban percakapan user, jadi default hanya di memori.
+    """
+    return create_response_cache(
+        get_secret("response_cache_dir") or None,
+        float(get_secret("response_cache_ttl", 3600)),
+        float(get_secret("response_cache_max_temperature", 0.3)),
+    )
+
+def lookup_cached_response(payload, enabled=None):
+    """Return (cache_key, respons cache); cache_key None jika request tidak boleh di-cache.
+
+    enabled default dari session state; worker generate (tanpa session state) wajib mengisinya.
+    """
+    if not (st.session_state.use_response_cache if enabled is None else enabled):
+        return None, None
+    cache = get_response_cache()
+    if not cache.is_cacheable(payload):
+        return None, None
+    cache_key = cache.make_key(payload)
+    return cache_key, cache.get(cache_key)
+
+# ===========================
+# USAGE ACCOUNTING
+# ===========================
+USAGE_WINDOW_SECONDS = 3600  # Riwayat request yang disimpan untuk hitung throughput
+
+class UsageLedger:
+    """Counter usage per model dan throughput semua user dalam proses ini, di-update per request.
+
+    Total per room dan per user disimpan di storage chatroom (add_usage) agar bertahan saat restart.
+    """
+
+    def __init__(self, window_seconds=USAGE_WINDOW_SECONDS):
+        self.window_seconds = window_seconds
+        self._lock = threading.Lock()
+        self._models = {}  # model -> counters
+        self._events = deque()  # (timestamp, user, total_tokens, cost) untuk throughput
+
+    def record(self, user, model, usage):
+        now = time.time()
+        with self._lock:
+            count_usage_in_totals(self._models.setdefault(model, empty_usage_totals()), usage)
+            self._events.append((now, user, usage["total_tokens"], usage["cost"]))
+            self._trim(now)
+
+    def _trim(self, now):
+        while self._events and self._events[0][0] < now - self.window_seconds:
+            self._events.popleft()
+
+    def model_totals(self):
+        with self._lock:
+            return {model: dict(counters) for model, counters in self._models.items()}
+
+    def throughput(self, seconds=300, user=None):
+        """Request, tokens dan cost per menit dalam `seconds` terakhir (semua user jika user None)"""
+        now = time.time()
+        requests_count = tokens = cost = 0
+        with self._lock:
+            self._trim(now)
+            for timestamp, event_user, event_tokens, event_cost in reversed(self._events):
+                if timestamp < now - seconds:
+                    break
+                if user is not None and event_user != user:
+                    continue
+                requests_count += 1
+                tokens += event_tokens
+                cost += event_cost
+        minutes = seconds / 60
+        return {
+            "requests_per_min": requests_count / minutes,
+            "tokens_per_min": tokens / minutes,
+            "cost_per_min": cost / minutes,
+        }
+
+@st.cache_resource(show_spinner=False)
+def get_usage_ledger():
+    """Ledger usage dipakai bersama semua session dalam satu proses"""
+    return UsageLedger()
+
+def record_usage(usage, model, room=None, user=None, storage=None):
+    """Catat usage dari respons API ke storage (total room & user) dan ledger proses (model, throughput).
+
+    Return usage yang sudah dinormalisasi. Worker generate (tanpa akses session state) wajib mengisi
+    room, user dan storage.
+    """
+    usage = normalize_usage(usage)
+    if usage is None:
+        return None
+    if room is None:
+        room = get_current_room_name()
+    if user is None:
+        user = get_storage_user()
+    (storage or get_chat_storage()).add_usage(user, room, usage)
+    get_usage_ledger().record(user, model, usage)
+    return usage
+
+# ===========================
+# LATENCY INSTRUMENTATION
+# ===========================
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0)
+# headers = sampai header respons tiba (antre upstream + koneksi + antrean server), bukan TCP/TLS connect saja
+TURN_SPANS = ("prompt_assembly", "headers", "ttfb", "generation", "render", "total")
+SESSION_TIMINGS_LIMIT = 200  # Giliran terakhir yang disimpan per session untuk p50/p95
+
+class TurnTimer:
+    """Timestamp fase satu giliran chat (boleh di-mark dari thread worker)"""
+
+    def __init__(self):
+        self.marks = {"start": time.perf_counter()}
+        self.render_seconds = 0.0
+
+    def mark(self, name, at=None):
+        # Mark pertama yang menang (mis. token pertama dari model pemenang)
+        self.marks.setdefault(name, at if at is not None else time.perf_counter())
+
+    def add_render(self, seconds):
+        self.render_seconds += seconds
+
+    def spans(self):
+        """Durasi per fase dalam detik; fase yang tidak terjadi (mis. error) dilewati"""
+        marks = self.marks
+        spans = {}
+        if "assembled" in marks:
+            spans["prompt_assembly"] = marks["assembled"] - marks["start"]
+            if "headers" in marks:
+                spans["headers"] = marks["headers"] - marks["assembled"]
+            if "first_token" in marks:
+                spans["ttfb"] = marks["first_token"] - marks["assembled"]
+                if "done" in marks:
+                    spans["generation"] = marks["done"] - marks["first_token"]
+        spans["render"] = self.render_seconds
+        if "end" in marks:
+            spans["total"] = marks["end"] - marks["start"]
+        return spans
+
+class LatencyMetrics:
+    """Histogram latency per (span, model) untuk seluruh proses, format Prometheus"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._histograms = {}  # (span, model) -> {"counts": [...], "sum": float, "count": int}
+
+    def observe(self, span, model, seconds):
+        with self._lock:
+            histogram = self._histograms.setdefault((span, model), {
+                "counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram["counts"][i] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def to_prometheus(self):
+        lines = [
+            "# HELP chat_turn_span_seconds Durasi fase per giliran chat",
+            "# TYPE chat_turn_span_seconds histogram",
+        ]
+        with self._lock:
+            for (span, model), histogram in sorted(self._histograms.items()):
+                labels = f'span="{span}",model="{model}"'
+                for bound, count in zip(self.buckets, histogram["counts"]):
+                    lines.append(f'chat_turn_span_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'chat_turn_span_seconds_bucket{{{labels},le="+Inf"}} {histogram["count"]}')
+                lines.append(f'chat_turn_span_seconds_sum{{{labels}}} {histogram["sum"]:.6f}')
+                lines.append(f'chat_turn_span_seconds_count{{{labels}}} {histogram["count"]}')
+        return "\n".join(lines) + "\n"
+
+@st.cache_resource(show_spinner=False)
+def get_latency_metrics():
+    """Histogram latency dipakai bersama semua session dalam satu proses"""
+    return LatencyMetrics()
+
+def get_metrics_dir():
+    return get_secret("metrics_dir", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache", "metrics"))
+
+def export_turn_metrics(record, metrics):
+    """Tulis metrics ke file lokal sesuai st.secrets['metrics_export']: prometheus, jsonl, both, off"""
+    mode = get_secret("metrics_export", "prometheus")
+    if mode == "off":
+        return
+    directory = get_metrics_dir()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        if mode in ("jsonl", "both"):
+            with open(os.path.join(directory, "turns.jsonl"), "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        if mode in ("prometheus", "both"):
+            # Ditulis atomik agar scraper (node_exporter textfile) tidak membaca file setengah jadi
+            path = os.path.join(directory, "chat_latency.prom")
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                f.write(metrics.to_prometheus())
+            os.replace(tmp_path, path)
+    except OSError:
+        pass
+
+def mark_turn(route_info, name):
+    """Mark fase pada TurnTimer giliran ini (jika ada)"""
+    timer = route_info.get("timer")
+    if timer is not None:
+        timer.mark(name)
+
+def record_turn_metrics(timer, model):
+    """Catat span satu giliran ke histogram proses, riwayat session dan file export"""
+    timer.mark("end")
+    spans = timer.spans()
+    metrics = get_latency_metrics()
+    for span, seconds in spans.items():
+        metrics.observe(span, model, seconds)
+    
+    st.session_state.turn_timings.append(spans)
+    if len(st.session_state.turn_timings) > SESSION_TIMINGS_LIMIT:
+        del st.session_state.turn_timings[0]
+    
+    export_turn_metrics({
+        "ts": datetime.now().isoformat(timespec="milliseconds"),
+        "model": model,
+        "stream": st.session_state.stream_responses,
+        "spans": {span: round(seconds, 4) for span, seconds in spans.items()},
+    }, metrics)
+
+@contextlib.contextmanager
+def timed_render(name):
+    """Ukur durasi satu bagian rerun ke st.session_state.render_timings (dibaca benchmark.py)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        st.session_state.render_timings[name] = time.perf_counter() - started
+
+def percentile(values, fraction):
+    """Persentil dengan nearest-rank (cukup untuk ≤ 200 sampel)"""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def render_latency_panel():
+    """Panel p50/p95 per fase untuk giliran di session ini"""
+    timings = st.session_state.turn_timings
+    if not timings:
+        return
+    with st.expander("⏱️ Latency sesi ini", expanded=False):
+        rows = []
+        for span in TURN_SPANS:
+            values = [spans[span] for spans in timings if span in spans]
+            if values:
+                rows.append({
+                    "Fase": span,
+                    "n": len(values),
+                    "p50 (s)": round(percentile(values, 0.5), 3),
+                    "p95 (s)": round(percentile(values, 0.95), 3),
+                })
+        st.dataframe(rows, use_container_width=True, hide_index=True)
+
+# ===========================
+# CONTEXT WINDOW MANAGEMENT
+# ===========================
+DEFAULT_CONTEXT_LIMIT = 8192
+DEFAULT_MAX_HISTORY_TOKENS = 4000  # Batas biaya prompt, walau context model lebih besar
+CONTEXT_SAFETY_MARGIN = 256
+MESSAGE_TOKEN_OVERHEAD = 4  # Token tambahan per message (role, separator)
+SUMMARY_MAX_TOKENS = 300
+SUMMARY_TARGET_RATIO = 0.6  # Setelah meringkas, sisakan ruang agar tidak meringkas tiap giliran
+
+@functools.lru_cache(maxsize=1)
+def get_tokenizer():
+    """Tokenizer tiktoken jika terpasang, None jika tidak (pakai estimasi len // 4)"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+@functools.lru_cache(maxsize=8192)
+def count_tokens(text):
+    """Hitung token teks (hasil di-cache, pesan lama tidak dihitung ulang tiap giliran)"""
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return len(text) // 4
+    return len(tokenizer.encode(text, disallowed_special=()))
+
+def count_message_tokens(message):
+    return count_tokens(message["content"]) + MESSAGE_TOKEN_OVERHEAD
+
+def get_context_budget(model, max_tokens):
+    """Budget token untuk prompt: context model - max_tokens respons - margin"""
+    model_config = get_registry().models.get(model)
+    limit = (model_config and model_config.context_limit) or DEFAULT_CONTEXT_LIMIT
+    budget = limit - max_tokens - CONTEXT_SAFETY_MARGIN
+    budget = min(budget, int(get_secret("context_max_history_tokens", DEFAULT_MAX_HISTORY_TOKENS)))
+    return max(budget, 0)
+
+def select_context_window(history, budget, start=0):
+    """Cari indeks awal sehingga history[cut:] muat dalam budget (pesan terakhir selalu masuk)"""
+    total = 0
+    cut = len(history)
+    for i in range(len(history) - 1, start - 1, -1):
+        tokens = count_message_tokens(history[i])
+        if total + tokens > budget and cut < len(history):
+            break
+        total += tokens
+        cut = i
+    return cut
+
+def get_room_summary(room):
+    """Ringkasan bergulir room dari metadata storage (bertahan lintas halaman dan session)"""
+    return room.metadata.get("summary") or {"text": "", "upto": 0}
+
+def save_room_summary(room_name, text, upto):
+    get_room_manager().update_metadata(room_name, {"summary": {"text": text, "upto": upto}})
+    return True
+
+def reset_room_summary(room_name):
+    get_room_manager().update_metadata(room_name, {"summary": None})
+
+def summarize_messages(previous_summary, messages, headers, model, room, user, storage, scheduler_user=None):
+    """Lipat pesan lama ke ringkasan sebelumnya (satu request kecil, non-streaming, tanpa session state)"""
+    transcript = "\n".join(f"{m['role'].upper()}: {m['content']}" for m in messages)
+    prompt = (
+        "Perbarui ringkasan percakapan berikut dengan pesan-pesan baru. "
+        "Pertahankan fakta penting, nama, keputusan, dan kode/istilah kunci. "
+        "Tulis ringkas dalam bentuk poin.\n\n"
+        f"RINGKASAN SEBELUMNYA:\n{previous_summary or '-'}\n\n"
+        f"PESAN BARU:\n{transcript}"
+    )
+    payload = build_payload(model, [{"role": "user", "content": prompt}], SUMMARY_MAX_TOKENS, 0.2,
+                            user=scheduler_user)
+    try:
+        with upstream_slot(headers, payload):
+            data = get_http_client().post_chat(headers, payload).json()
+        record_usage(data.get("usage"), payload["model"], room, user, storage)
+        return data["choices"][0]["message"]["content"].strip()
+    except Exception:
+        return None
+
+class HistoryContext:
+    """Snapshot history satu giliran untuk menyusun messages dalam budget token model.
+
+    Diambil di thread script; build() tidak menyentuh session state sehingga request ringkasan
+    (bisa beberapa untuk room panjang) dijalankan worker generate, bukan thread script.
+    """
+    __slots__ = ("system_message", "history", "budget", "summarize_history", "storage", "user", "offset",
+                 "summary", "headers", "model", "scheduler_user")
+
+    def __init__(self, system_message, history, budget, summarize_history=False, storage=None, user="",
+                 offset=0, summary=None, headers=None, model=None, scheduler_user=None):
+        self.system_message = system_message
+        self.history = history  # Pesan dengan indeks absolut offset .. (tanpa pesan system)
+        self.budget = budget  # Budget token history (system message sudah dikurangkan)
+        self.summarize_history = summarize_history
+        self.storage = storage
+        self.user = user
+        self.offset = offset
+        summary = summary or {"text": "", "upto": 0}
+        # "upto" disimpan sebagai indeks absolut; ringkasan melewati history berarti room sudah di-clear
+        if summary["upto"] - offset >= len(history):
+            summary = {"text": "", "upto": 0}
+        self.summary = summary
+        self.headers = headers
+        self.model = model
+        self.scheduler_user = scheduler_user
+
+    @property
+    def window_budget(self):
+        # Sisakan ruang untuk ringkasan (yang bisa bertambah panjang setelah diperbarui)
+        return self.budget - SUMMARY_MAX_TOKENS - MESSAGE_TOKEN_OVERHEAD
+
+    @property
+    def needs_summary(self):
+        """True jika build() perlu request ringkasan (pesan belum dimuat atau sudah keluar window)"""
+        if not self.summarize_history:
+            return False
+        start = self.summary["upto"] - self.offset
+        return start < 0 or select_context_window(self.history, self.window_budget, start=start) > start
+
+    def build(self, save_summary=None, room=None, on_status=None):
+        """Messages system (+ ringkasan) + giliran terbaru.
+
+        Tanpa save_summary tidak ada request ringkasan: ringkasan tersimpan dipakai apa adanya.
+        save_summary(text, upto) menyimpan progres dan return False untuk berhenti meringkas
+        (job dibatalkan); room() memberi nama room saat ini (bisa di-rename selama job berjalan).
+        """
+        messages = [self.system_message]
+        if self.summarize_history:
+            summary_text, cut = self.fold(save_summary, room, on_status)
+            if summary_text:
+                messages.append({
+                    "role": "system",
+                    "content": f"Ringkasan percakapan sebelumnya:\n{summary_text}"
+                })
+        else:
+            cut = select_context_window(self.history, self.budget)
+        messages.extend(self.history[cut:])
+        return messages
+
+    def summarize(self, previous_summary, messages, room):
+        return summarize_messages(previous_summary, messages, self.headers, self.model, room, self.user,
+                                  self.storage, self.scheduler_user)
+
+    def fold(self, save_summary, room, on_status):
+        """Return (summary_text, cut): pesan history sebelum cut sudah terwakili ringkasan"""
+        text, upto = self.summary["text"], self.summary["upto"]
+        window_budget = self.window_budget
+        if upto < self.offset:
+            # Room panjang dibuka ulang: pesan sebelum halaman yang dimuat jangan hilang dari konteks
+            if save_summary is not None:
+                text, upto = self.fold_unloaded(text, upto, save_summary, room, on_status)
+            if upto < self.offset:
+                # Gagal meringkas semuanya: pakai window biasa, ringkasan yang ada tetap dikirim
+                return text, select_context_window(self.history, window_budget)
+        start = max(0, upto - self.offset)
+        cut = select_context_window(self.history, window_budget, start=start)
+        if cut <= start:
+            return text, start
+        
+        # Hanya pesan yang baru keluar window yang diringkas, bukan seluruh history
+        cut = select_context_window(self.history, int(window_budget * SUMMARY_TARGET_RATIO), start=start)
+        if save_summary is None:
+            return text, cut
+        if on_status is not None:
+            on_status("🧾 Meringkas riwayat percakapan...")
+        new_text = self.summarize(text, self.history[start:cut], room())
+        if not new_text:
+            return text, cut
+        save_summary(new_text, self.offset + cut)
+        return new_text, cut
+
+    def fold_unloaded(self, text, upto, save_summary, room, on_status):
+        """Lipat pesan di storage yang tidak dimuat session (antara upto dan offset) ke ringkasan.
+
+        Dibaca per halaman dan diringkas per potongan sebesar window budget; progres disimpan tiap
+        potongan. Jika meringkas gagal, sisa pesan dicoba lagi di giliran berikutnya.
+        """
+        chunk, chunk_tokens, chunk_end = [], 0, upto
+        while chunk_end < self.offset:
+            if on_status is not None:
+                on_status(f"🧾 Meringkas {self.offset - upto} pesan lama dari riwayat tersimpan...")
+            page = self.storage.load_messages(self.user, room(), chunk_end,
+                                              min(CHAT_PAGE_SIZE, self.offset - chunk_end))
+            if not page:
+                break
+            for message in page:
+                tokens = count_message_tokens(message)
+                if chunk and chunk_tokens + tokens > self.window_budget:
+                    new_text = self.summarize(text, chunk, room())
+                    if not new_text:
+                        return text, upto
+                    text, upto = new_text, chunk_end
+                    if not save_summary(text, upto):
+                        return text, upto
+                    chunk, chunk_tokens = [], 0
+                if message["role"] != "system":
+                    chunk.append({"role": message["role"], "content": message["content"]})
+                    chunk_tokens += tokens
+                chunk_end += 1
+        if chunk:
+            new_text = self.summarize(text, chunk, room())
+            if not new_text:
+                return text, upto
+            text, upto = new_text, chunk_end
+            save_summary(text, upto)
+        return text, upto
+
+# ===========================
+# API FUNCTIONS
+# ===========================
+def get_api_key():
+    """Mendapatkan API key"""
+    if st.session_state.api_key:
+        return st.session_state.api_key
+    try:
+        return st.secrets["openrouter_api_key"]
+    except:
+        return None
+
+STREAM_RENDER_INTERVAL = 0.05  # Detik minimum antar render saat streaming
+
+def build_history_context(user_input):
+    """Snapshot HistoryContext room aktif (system + history + input user) untuk satu giliran"""
+    room = get_current_room()
+    history = [
+        {"role": message["role"], "content": message["content"]}
+        for message in room.messages
+        if message["role"] != "system"
+    ]
+    # handle_chat sudah menyimpan prompt ke room sebelum request, jangan kirim dua kali
+    user_message = {"role": "user", "content": user_input}
+    if not history or history[-1] != user_message:
+        history.append(user_message)
+    system_message = get_system_message()
+    model = st.session_state.selected_model
+    budget = get_context_budget(model, st.session_state.max_tokens) - count_message_tokens(system_message)
+    return HistoryContext(system_message, history, budget, st.session_state.summarize_history,
+                          get_chat_storage(), get_storage_user(), room.offset, get_room_summary(room),
+                          auth_headers(get_api_key()), model,
+                          get_storage_user() if is_server_mode() else None)
+
+def build_api_messages(user_input):
+    """Susun daftar messages untuk API; ringkasan yang perlu diperbarui dibuat di thread script"""
+    context = build_history_context(user_input)
+    room_name = get_current_room_name()
+    with st.spinner("🧾 Meringkas riwayat percakapan...") if context.needs_summary else contextlib.nullcontext():
+        return context.build(functools.partial(save_room_summary, room_name), lambda: room_name)
+
+def build_api_request(user_input, stream=False, messages=None):
+    """Susun headers dan payload request OpenRouter (messages default dari build_api_messages)"""
+    payload = build_payload(
+        st.session_state.selected_model,
+        build_api_messages(user_input) if messages is None else messages,
+        st.session_state.max_tokens,
+        st.session_state.temperature,
+        stream=stream,
+        user=get_storage_user() if is_server_mode() else None,
+    )
+    return auth_headers(get_api_key()), payload
+
+def payload_for_model(payload, model):
+    """Payload untuk satu model; tambah penanda prompt caching jika model memintanya di registry"""
+    model_config = get_registry().models.get(model)
+    if model_config is None:
+        return dict(payload, model=model)
+    return apply_prompt_cache(payload, model_config)
+
+def show_api_error(e):
+    """Tampilkan error dari OpenRouter API"""
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        if e.response.status_code == 402:
+            st.markdown("""
+            <div class="error-shake" style="background: linear-gradient(45deg, #e74c3c, #c0392b); 
+                 color: white; padding: 1.5rem; border-radius: 15px; margin: 1rem 0;">
+                <h3 style="margin: 0 0 1rem 0;">💳 Error 402: Payment Required</h3>
+                <p><strong>🔧 Solusi:</strong></p>
+                <ul>
+                    <li><strong>Ganti ke model GRATIS</strong> (yang ada icon 🆓)</li>
+                    <li><strong>Top up kredit</strong> di <a href="https://openrouter.ai/credits" style="color: #fff;">OpenRouter.ai</a></li>
+                    <li><strong>Cek saldo</strong> di dashboard OpenRouter</li>
+                </ul>
+                <p><strong>💡 Model gratis yang direkomendasikan:</strong><br>
+                🆓 Mistral 7B, Google Gemma 7B, Llama 3 8B</p>
+            </div>
+            """, unsafe_allow_html=True)
+        else:
+            show_error_message(f"HTTP Error {e.response.status_code}: {e}")
+    elif isinstance(e, requests.exceptions.Timeout):
+        show_error_message("Server AI tidak merespons (timeout). Coba lagi atau ganti model.")
+    elif isinstance(e, UpstreamBusyError):
+        show_error_message(str(e))
+    else:
+        show_error_message(f"Terjadi kesalahan: {e}")
+
+# ===========================
+# MODEL ROUTING (FALLBACK & HEDGING)
+# ===========================
+FALLBACK_STATUS_CODES = (402, 404, 408, 429, 500, 502, 503, 504)
+DEFAULT_HEDGE_DELAY = 4.0  # Detik menunggu token pertama sebelum menembak model cadangan
+
+class ModelHealth:
+    """Skor kesehatan per model: EWMA latency token pertama + circuit breaker"""
+
+    def __init__(self, failure_threshold=3, cooldown=60.0, slow_threshold=8.0, alpha=0.3):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.slow_threshold = slow_threshold
+        self.alpha = alpha
+        self._lock = threading.Lock()
+        self._models = {}
+
+    def _entry(self, model):
+        return self._models.setdefault(model, {
+            "ewma_latency": None, "successes": 0, "failures": 0,
+            "consecutive_failures": 0, "open_until": 0.0,
+        })
+
+    def record_success(self, model, latency):
+        with self._lock:
+            entry = self._entry(model)
+            previous = entry["ewma_latency"]
+            entry["ewma_latency"] = latency if previous is None else (
+                self.alpha * latency + (1 - self.alpha) * previous)
+            entry["successes"] += 1
+            entry["consecutive_failures"] = 0
+            entry["open_until"] = 0.0
+
+    def record_failure(self, model):
+        with self._lock:
+            entry = self._entry(model)
+            entry["failures"] += 1
+            entry["consecutive_failures"] += 1
+            if entry["consecutive_failures"] >= self.failure_threshold:
+                entry["open_until"] = time.time() + self.cooldown
+
+    def is_open(self, model):
+        """Circuit terbuka = model dilewati sampai cooldown selesai (lalu dicoba lagi sekali)"""
+        with self._lock:
+            entry = self._models.get(model)
+            return entry is not None and entry["open_until"] > time.time()
+
+    def is_slow(self, model):
+        with self._lock:
+            entry = self._models.get(model)
+            return (entry is not None and entry["ewma_latency"] is not None
+                    and entry["ewma_latency"] > self.slow_threshold)
+
+    def rank(self, models):
+        """Urutkan kandidat: sehat dulu, lalu yang lambat, lalu circuit terbuka (urutan asli dipertahankan)"""
+        return sorted(models, key=lambda m: (self.is_open(m), self.is_slow(m)))
+
+    def snapshot(self):
+        with self._lock:
+            return {model: dict(entry) for model, entry in self._models.items()}
+
+@st.cache_resource(show_spinner=False)
+def get_model_health():
+    """Health model dipakai bersama semua session dalam satu proses"""
+    return ModelHealth()
+
+def is_fallback_error(e, started=False):
+    """Error yang layak dicoba di model lain: hanya sebelum token pertama, dan hanya error transport,
+    status HTTP 5xx/429 (atau status spesifik model lain di FALLBACK_STATUS_CODES) dan kuota rate"""
+    if started:
+        return False  # Teks sudah tampil: model lain akan mengulang jawaban dari awal
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code in FALLBACK_STATUS_CODES
+    if isinstance(e, UpstreamError):
+        # Error provider di body/stream: ikuti kodenya, error tanpa kode (mis. konten ditolak) tidak diulang
+        return e.code in FALLBACK_STATUS_CODES
+    # Kuota rate habis hanya untuk model ini; model lain mungkin masih punya kuota
+    return isinstance(e, (requests.exceptions.Timeout, requests.exceptions.ConnectionError, RateLimitedError))
+
+def get_route_models():
+    """Model terpilih diikuti recommended_models role, diurutkan menurut health"""
+    models = [st.session_state.selected_model]
+    if st.session_state.auto_fallback:
+        role_config = get_role_configs()[st.session_state.current_role]
+        for model in role_config.recommended_models:
+            if model not in models:
+                models.append(model)
+    return get_model_health().rank(models)
+
+def model_stream_worker(model, headers, payload, events, cancel_event, handles, max_retries):
+    """Thread worker: stream satu model, kirim event (model, jenis, data) ke queue"""
+    on_wait = lambda status: events.put((model, "waiting", status))
+    try:
+        with upstream_slot(headers, payload, on_wait=on_wait):
+            if cancel_event.is_set():
+                return
+            with get_http_client().post_chat(headers, payload, stream=True, max_retries=max_retries) as response:
+                handles[model] = response
+                events.put((model, "open", time.perf_counter()))
+                for delta, usage in iter_stream_chunks(response):
+                    if cancel_event.is_set():
+                        return
+                    if usage:
+                        events.put((model, "usage", usage))
+                    if delta:
+                        events.put((model, "delta", delta))
+        events.put((model, "done", None))
+    except Exception as e:
+        if not cancel_event.is_set():
+            events.put((model, "error", e))
+
+def route_stream(headers, payload, models, hedge_delay=None, route_info=None):
+    """Stream dengan fallback berurutan dan hedging opsional; yield (model, delta, usage).
+
+    Model berikutnya ditembak jika model aktif gagal sebelum token pertama, atau (hedging)
+    jika belum ada token pertama setelah hedge_delay detik. Model pertama yang mengirim
+    token menang, sisanya dibatalkan dan koneksinya ditutup.
+    """
+    health = get_model_health()
+    route_info = route_info if route_info is not None else {}
+    route_info["attempted"] = []
+    events = queue.Queue()
+    cancel_events = {}
+    handles = {}
+    started_at = {}
+    remaining = list(models)
+    active = set()
+    winner = None
+    opened_at = {}
+    timer = route_info.get("timer")
+    stop_event = route_info.get("stop_event")
+    executor = ThreadPoolExecutor(max_workers=len(models), thread_name_prefix="route")
+
+    def launch():
+        model = remaining.pop(0)
+        cancel_events[model] = threading.Event()
+        started_at[model] = time.monotonic()
+        active.add(model)
+        route_info["attempted"].append(model)
+        # Jika masih ada cadangan, jangan habiskan waktu untuk retry panjang di model ini
+        max_retries = 1 if remaining else None
+        executor.submit(model_stream_worker, model, headers, payload_for_model(payload, model),
+                        events, cancel_events[model], handles, max_retries)
+
+    def cancel(model):
+        cancel_events[model].set()
+        response = handles.get(model)
+        if response is not None:
+            response.close()
+
+    try:
+        launch()
+        hedge_at = time.monotonic() + hedge_delay if hedge_delay is not None else None
+        while True:
+            if stop_event is not None and stop_event.is_set():
+                return  # Stop dari user: finally di bawah membatalkan semua model dan menutup koneksinya
+            try:
+                model, kind, data = events.get(timeout=0.05)
+            except queue.Empty:
+                if (winner is None and remaining and hedge_at is not None
+                        and time.monotonic() >= hedge_at):
+                    launch()
+                    hedge_at = time.monotonic() + hedge_delay
+                continue
+            
+            if winner is not None and model != winner:
+                continue
+            if kind == "open":
+                opened_at[model] = data
+                continue
+            if kind == "waiting":
+                if winner is None and route_info.get("on_wait"):
+                    route_info["on_wait"](data)
+                continue
+            if kind == "error":
+                active.discard(model)
+                # Antre/kuota habis bukan kesalahan model, jangan turunkan health-nya
+                if not isinstance(data, UpstreamBusyError):
+                    health.record_failure(model)
+                if not is_fallback_error(data, started=winner == model):
+                    for other in list(active):
+                        cancel(other)
+                    raise data
+                if not active:
+                    if not remaining:
+                        raise data
+                    launch()
+                continue
+            if winner is None:
+                # Token pertama (atau selesai tanpa teks) menentukan pemenang
+                winner = model
+                route_info["model"] = model
+                health.record_success(model, time.monotonic() - started_at[model])
+                if timer is not None:
+                    timer.mark("headers", opened_at.get(model))
+                    timer.mark("first_token")
+                for other in list(active):
+                    if other != model:
+                        cancel(other)
+            if kind == "delta":
+                yield model, data, None
+            elif kind == "usage":
+                yield model, "", data
+            else:
+                if timer is not None:
+                    timer.mark("done")
+                return
+    finally:
+        for model in list(active):
+            cancel(model)
+        executor.shutdown(wait=False)
+
+# ===========================
+# BACKGROUND GENERATION
+# ===========================
+GENERATION_RESULT_TTL = 600.0  # Detik hasil job yang tidak pernah diambil session (tab ditutup) disimpan
+GENERATION_POLL_INTERVAL = 0.1  # Detik antar tick fragment yang menampilkan progres jawaban
+
+class GenerationJob:
+    """Satu giliran chat yang dikerjakan worker pool; script session hanya membaca progresnya"""
+    __slots__ = ("session_id", "user", "room", "stream", "headers", "payload", "models", "hedge_delay",
+                 "cache_key", "storage", "route_info", "parts", "status", "status_text", "error",
+                 "finished_at", "truncated", "stop_event", "collected", "shown", "lock", "context", "use_cache")
+
+    def __init__(self, session_id, user, room, stream, headers, payload, models, hedge_delay=None,
+                 cache_key=None, storage=None, context=None, use_cache=False):
+        self.session_id = session_id
+        self.user = user
+        self.room = room  # Bisa berubah saat room di-rename selama job berjalan (dibaca di bawah lock)
+        self.stream = stream  # Tampilan live per token; upstream selalu SSE agar request bisa diputus
+        self.headers = headers
+        self.payload = payload
+        self.models = models
+        self.hedge_delay = hedge_delay
+        self.cache_key = cache_key
+        self.storage = storage
+        self.context = context  # HistoryContext yang perlu request ringkasan dulu (dikerjakan worker)
+        self.use_cache = use_cache  # Cek cache respons setelah messages final disusun worker
+        self.stop_event = threading.Event()
+        self.route_info = {"timer": TurnTimer(), "on_wait": self.set_status_text, "stop_event": self.stop_event}
+        self.parts = []  # Potongan teks yang sudah diterima (append dari worker, dibaca script)
+        self.status = "running"  # running | done | error | cancelled
+        self.status_text = None  # Posisi antrean / tunggu kuota untuk animasi berpikir
+        self.error = None
+        self.finished_at = None
+        self.truncated = False  # Dihentikan user di tengah stream, jawaban yang disimpan hanya potongan
+        self.collected = False  # Sudah disinkronkan ke session (hanya disentuh thread script)
+        self.shown = False  # Jawaban final sudah mulai ditampilkan (hanya disentuh thread script)
+        self.lock = threading.RLock()  # Reentrant: rename_chatroom menahannya selama rename storage
+
+    @property
+    def key(self):
+        return (self.session_id, self.room)
+
+    @property
+    def active(self):
+        return self.status == "running"
+
+    @property
+    def text(self):
+        return "".join(self.parts)
+
+    def set_status_text(self, status):
+        self.status_text = status
+
+    def save_summary(self, text, upto):
+        """Simpan progres ringkasan ke room job; False jika job sudah dihentikan (berhenti meringkas)"""
+        with self.lock:
+            if self.status != "running":
+                return False  # Room di-clear/dihapus: ringkasan pesan lamanya jangan ditulis lagi
+            self.storage.update_room_metadata(self.user, self.room, {"summary": {"text": text, "upto": upto}})
+        return not self.stop_event.is_set()
+
+    def prepare(self):
+        """Worker: susun messages final (request ringkasan room panjang), lalu cek cache respons.
+
+        Return True jika jawaban sudah tersedia dari cache.
+        """
+        messages = self.context.build(self.save_summary, lambda: self.room, self.set_status_text)
+        self.status_text = None
+        self.payload = dict(self.payload, messages=messages)
+        mark_turn(self.route_info, "assembled")
+        self.cache_key, cached = lookup_cached_response(self.payload, self.use_cache)
+        if cached is None or self.stop_event.is_set():
+            return False
+        self.finish_cached(cached)
+        return True
+
+    def finish_cached(self, content):
+        """Selesaikan job dengan respons dari cache tanpa request upstream"""
+        self.route_info["model"] = self.payload["model"]
+        mark_turn(self.route_info, "first_token")
+        mark_turn(self.route_info, "done")
+        self.parts.append(content)
+        self.finish()
+
+    def cancel(self):
+        """Batalkan job; koneksi upstream diputus dan jawaban yang belum ditulis tidak akan masuk ke room"""
+        self.stop_event.set()
+        with self.lock:
+            if self.status != "running":
+                return False
+            self.status = "cancelled"
+            self.finished_at = time.perf_counter()
+            return True
+
+    def stop(self):
+        """Stop dari user: koneksi upstream diputus; potongan yang sudah diterima disimpan sebagai truncated.
+
+        Mode tampilan (stream atau tidak) hanya menentukan cara teks dirender, bukan nasib potongannya.
+        """
+        self.stop_event.set()
+        return self.active
+
+    def finish(self, error=None):
+        """Tulis jawaban (juga potongan stream yang terputus) ke room di storage, lalu tandai selesai.
+
+        Potongan yang terputus karena Stop atau error upstream ditandai truncated (error juga dicatat)
+        agar history dan export tidak menyajikannya sebagai jawaban utuh.
+        """
+        text = self.text
+        with self.lock:
+            if self.status != "running":
+                return
+            self.truncated = bool(text) and (self.stop_event.is_set() or error is not None)
+            if text:
+                message = {"role": "assistant", "content": text}
+                if self.route_info.get("model"):
+                    message["model"] = self.route_info["model"]
+                message["params"] = {"temperature": self.payload["temperature"],
+                                     "max_tokens": self.payload["max_tokens"]}
+                if self.route_info.get("usage"):
+                    message["usage"] = self.route_info["usage"]
+                if self.truncated:
+                    message["truncated"] = True
+                if error is not None:
+                    message["error"] = str(error) or type(error).__name__
+                self.storage.append_message(self.user, self.room, message, tokens=count_tokens(text))
+            self.error = error
+            self.status = "error" if error is not None else "done"
+            self.finished_at = time.perf_counter()
+
+def run_generation(job):
+    """Worker: jalankan request job sampai selesai, terlepas dari rerun/pindah room di session"""
+    route_info = job.route_info
+    error = None
+    try:
+        if job.context is not None and job.prepare():
+            return
+        if job.stop_event.is_set():
+            job.finish()  # Dihentikan selagi meringkas: tidak perlu membuka request jawaban
+            return
+        # Mode non-streaming juga dikirim sebagai SSE (teks ditampilkan utuh setelah selesai) agar Stop
+        # bisa menutup koneksinya di tengah jalan, tidak menunggu respons utuh tiba
+        stream = route_stream(job.headers, job.payload, job.models, job.hedge_delay, route_info)
+        try:
+            for model, delta, usage in stream:
+                if usage:
+                    route_info["usage"] = record_usage(usage, model, job.room, job.user, job.storage)
+                if delta:
+                    job.parts.append(delta)
+                if not job.active:
+                    break  # Dibatalkan: menutup router juga menutup koneksi upstream
+        finally:
+            stream.close()
+    except Exception as e:
+        error = e
+    # Hanya respons yang selesai utuh (tidak di-stop) dari model terpilih yang masuk cache
+    if (job.cache_key and error is None and job.parts and not job.stop_event.is_set()
+            and route_info.get("model") == job.payload["model"]):
+        get_response_cache().put(job.cache_key, job.text)
+    job.finish(error)
+
+class GenerationPool:
+    """Worker pool generate jawaban, satu job aktif per (session, room); job bertahan lintas rerun"""
+
+    def __init__(self, max_workers=16, result_ttl=GENERATION_RESULT_TTL):
+        self.result_ttl = result_ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._lock = threading.Lock()
+        self._jobs = {}  # (session_id, room) -> GenerationJob (berjalan atau belum diambil)
+        self._metrics = {"submitted": 0, "completed": 0, "failed": 0, "cancelled": 0, "stopped": 0, "expired": 0}
+
+    def _prune(self):
+        now = time.perf_counter()
+        expired = [key for key, job in self._jobs.items()
+                   if not job.active and now - job.finished_at > self.result_ttl]
+        for key in expired:
+            del self._jobs[key]
+        self._metrics["expired"] += len(expired)
+
+    def _run(self, job):
+        run_generation(job)
+        with self._lock:
+            if job.status == "done":
+                self._metrics["completed"] += 1
+            elif job.status == "error":
+                self._metrics["failed"] += 1
+
+    def submit(self, job):
+        """Jadwalkan job; False jika room ini masih punya job yang berjalan"""
+        with self._lock:
+            self._prune()
+            running = self._jobs.get(job.key)
+            if running is not None and running.active:
+                return False
+            self._jobs[job.key] = job
+            self._metrics["submitted"] += 1
+        self._executor.submit(self._run, job)
+        return True
+
+    def get(self, session_id, room):
+        with self._lock:
+            return self._jobs.get((session_id, room))
+
+    def session_jobs(self, session_id):
+        with self._lock:
+            return [job for (owner, _), job in self._jobs.items() if owner == session_id]
+
+    def discard(self, job):
+        with self._lock:
+            if self._jobs.get(job.key) is job:
+                del self._jobs[job.key]
+
+    def cancel(self, session_id, room):
+        """Batalkan dan lepas job room (clear/delete room, ganti role)"""
+        with self._lock:
+            job = self._jobs.pop((session_id, room), None)
+            if job is not None and job.cancel():
+                self._metrics["cancelled"] += 1
+
+    def stop(self, session_id, room):
+        """Stop job room atas permintaan user; job tetap terdaftar sampai potongannya diambil session"""
+        with self._lock:
+            job = self._jobs.get((session_id, room))
+            if job is not None and job.stop():
+                self._metrics["stopped"] += 1
+
+    def rename(self, session_id, old_name, new_name):
+        """Ikutkan job ke nama room baru agar jawaban tetap ditulis ke room yang sama"""
+        with self._lock:
+            job = self._jobs.pop((session_id, old_name), None)
+            if job is None:
+                return
+            with job.lock:
+                job.room = new_name
+            self._jobs[job.key] = job
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["running"] = sum(1 for job in self._jobs.values() if job.active)
+            stats["uncollected"] = len(self._jobs) - stats["running"]
+            return stats
+
+@st.cache_resource(show_spinner=False)
+def create_generation_pool(max_workers):
+    """Pool dibuat sekali per proses, dipakai bersama semua session"""
+    return GenerationPool(max_workers=max_workers)
+
+def get_generation_pool():
+    """Worker pool generate (ukuran dari st.secrets)"""
+    return create_generation_pool(int(get_secret("generation_workers", 16)))
+
+def get_session_id():
+    return st.session_state.session_id
+
+def get_room_generation(room=None):
+    """Job generate milik session ini untuk room (default room aktif), atau None"""
+    return get_generation_pool().get(get_session_id(), room or get_current_room_name())
+
+def start_generation(prompt):
+    """Susun request di thread script (butuh session state) lalu serahkan ke worker pool.
+
+    Request ringkasan history room panjang tidak dikirim di sini: job menyusun ulang messages-nya
+    di worker sebelum request jawaban. Return job, atau None jika request tidak bisa dibuat (error sudah ditampilkan).
+    """
+    if not get_api_key():
+        show_error_message("API key tidak ditemukan. Silakan masukkan API key di sidebar.")
+        return None
+    
+    stream = st.session_state.stream_responses
+    context = build_history_context(prompt)
+    # Messages sementara dari ringkasan tersimpan; jika ringkasan perlu diperbarui, worker menyusun ulang
+    headers, payload = build_api_request(prompt, stream=True, messages=context.build())
+    pending_context = context if context.needs_summary else None
+    cache_key, cached = (None, None) if pending_context else lookup_cached_response(payload)
+    hedge_delay = None
+    if st.session_state.hedge_requests:
+        # Semua job dikirim sebagai SSE, jadi hedging berlaku juga untuk mode tampilan non-streaming
+        hedge_delay = float(get_secret("hedge_delay", DEFAULT_HEDGE_DELAY))
+    job = GenerationJob(get_session_id(), get_storage_user(), get_current_room_name(), stream, headers,
+                        payload, get_route_models(), hedge_delay, cache_key, get_chat_storage(),
+                        pending_context, st.session_state.use_response_cache)
+    if pending_context is None:
+        mark_turn(job.route_info, "assembled")
+    get_room_manager().update_metadata(job.room, {"role": st.session_state.current_role,
+                                                  "model": payload["model"]})
+    if cached is not None:
+        # Cache hit tidak perlu worker: selesaikan langsung di thread script
+        job.finish_cached(cached)
+        return job
+    if not get_generation_pool().submit(job):
+        show_error_message("Jawaban sebelumnya di room ini belum selesai.")
+        return None
+    return job
+
+# ===========================
+# MESSAGE RENDERING (MARKDOWN → HTML)
+# ===========================
+RENDER_CACHE_SIZE = 2048  # Pesan selesai yang HTML-nya disimpan (LRU, dibagi semua session)
+MARKDOWN_FENCE = re.compile(r"^\s*(```|~~~)\s*([\w+#.-]*)\s*$")
+MARKDOWN_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+MARKDOWN_LIST_ITEM = re.compile(r"^\s*(?:([-*+])|(\d+)[.)])\s+(.*)$")
+MARKDOWN_RULE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+MARKDOWN_CODE_SPAN = re.compile(r"(`+)(.+?)\1")
+MARKDOWN_INLINE = (
+    (re.compile(r"\*\*(.+?)\*\*|__(.+?)__"), "strong"),
+    (re.compile(r"~~(.+?)~~"), "del"),
+    (re.compile(r"(?<![\w*])\*(?!\s)(.+?)(?<!\s)\*(?!\w)|(?<![\w_])_(?!\s)(.+?)(?<!\s)_(?!\w)"), "em"),
+)
+# Setelah html.escape, tanda kutip di URL sudah menjadi &quot; jadi tidak bisa keluar dari atribut href
+MARKDOWN_LINK = re.compile(r"\[([^\]]+)\]\(((?:https?://|mailto:)[^\s)]+)\)")
+HEADING_TAGS = {1: "h3", 2: "h4"}  # Heading di chat dibuat lebih kecil dari judul halaman
+
+def render_inline(text):
+    """Escape lalu format inline (code, bold, italic, strikethrough, link http/https/mailto)"""
+    parts = []
+    last = 0
+    # Isi code span tidak diformat lagi
+    for match in MARKDOWN_CODE_SPAN.finditer(text):
+        parts.append(render_inline_text(text[last:match.start()]))
+        parts.append(f"<code>{html.escape(match.group(2).strip())}</code>")
+        last = match.end()
+    parts.append(render_inline_text(text[last:]))
+    return "".join(parts)
+
+def render_inline_text(text):
+    text = html.escape(text)
+    for pattern, tag in MARKDOWN_INLINE:
+        text = pattern.sub(lambda m, tag=tag: f"<{tag}>{m.group(1) or m.group(2)}</{tag}>", text)
+    return MARKDOWN_LINK.sub(r'<a href="\2" target="_blank" rel="noopener noreferrer">\1</a>', text)
+
+def render_code_block(code, language):
+    """Blok kode ter-escape; di-highlight Pygments jika terpasang dan bahasanya dikenal"""
+    body = None
+    if highlight is not None and language:
+        try:
+            body = highlight(code, get_lexer_by_name(language), HtmlFormatter(nowrap=True, noclasses=True))
+        except ClassNotFound:
+            body = None
+    if body is None:
+        body = html.escape(code)
+    # Newline sebagai entity: baris kosong di dalam <pre> akan memutus blok HTML markdown Streamlit
+    body = body.rstrip("\n").replace("\n", "&#10;")
+    label = f'<span class="code-lang">{html.escape(language)}</span>' if language else ""
+    return f'<pre class="code-block">{label}<code>{body}</code></pre>'
+
+def render_markdown(text):
+    """Markdown (subset yang dipakai model) → HTML satu baris; semua teks di-escape lebih dulu.
+
+    Output tanpa baris kosong agar st.markdown memperlakukannya sebagai satu blok HTML utuh.
+    Fence ``` yang belum ditutup (saat streaming) dirender sebagai kode sampai akhir teks.
+    """
+    blocks = []
+    paragraph = []
+    list_tag = None
+    list_items = []
+
+    def flush_paragraph():
+        if paragraph:
+            blocks.append("<p>" + "<br>".join(render_inline(line) for line in paragraph) + "</p>")
+            paragraph.clear()
+
+    def flush_list():
+        nonlocal list_tag
+        if list_items:
+            blocks.append(f"<{list_tag}>" + "".join(f"<li>{item}</li>" for item in list_items) + f"</{list_tag}>")
+            list_items.clear()
+        list_tag = None
+
+    lines = text.replace("\r\n", "\n").split("\n")
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        fence = MARKDOWN_FENCE.match(line)
+        if fence:
+            flush_paragraph()
+            flush_list()
+            code_lines = []
+            i += 1
+            while i < len(lines) and not lines[i].strip().startswith(fence.group(1)):
+                code_lines.append(lines[i])
+                i += 1
+            blocks.append(render_code_block("\n".join(code_lines), fence.group(2)))
+            i += 1
+            continue
+        if not line.strip():
+            flush_paragraph()
+            flush_list()
+        elif heading := MARKDOWN_HEADING.match(line):
+            flush_paragraph()
+            flush_list()
+            tag = HEADING_TAGS.get(len(heading.group(1)), "h5")
+            blocks.append(f"<{tag}>{render_inline(heading.group(2))}</{tag}>")
+        elif MARKDOWN_RULE.match(line):
+            flush_paragraph()
+            flush_list()
+            blocks.append("<hr>")
+        elif item := MARKDOWN_LIST_ITEM.match(line):
+            flush_paragraph()
+            tag = "ul" if item.group(1) else "ol"
+            if tag != list_tag:
+                flush_list()
+                list_tag = tag
+            list_items.append(render_inline(item.group(3)))
+        elif line.lstrip().startswith(">"):
+            flush_paragraph()
+            flush_list()
+            blocks.append(f"<blockquote>{render_inline(line.lstrip()[1:].strip())}</blockquote>")
+        elif list_items and line.startswith((" ", "\t")):
+            # Lanjutan item list yang terbungkus ke baris berikutnya
+            list_items[-1] += "<br>" + render_inline(line.strip())
+        else:
+            flush_list()
+            paragraph.append(line)
+        i += 1
+    flush_paragraph()
+    flush_list()
+    return '<div class="message-body">' + "".join(blocks) + "</div>"
+
+class RenderCache:
+    """LRU HTML hasil render per hash konten pesan; dipakai ulang lintas rerun, room, dan session"""
+
+    def __init__(self, max_entries=RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # blake2b(content) -> html
+        self._metrics = {"hits": 0, "misses": 0}
+
+    def render(self, content):
+        key = hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+                self._metrics["hits"] += 1
+                return rendered
+            self._metrics["misses"] += 1
+        # Render di luar lock; dua session yang render pesan sama hanya membuang sedikit kerja
+        rendered = render_markdown(content)
+        with self._lock:
+            self._entries[key] = rendered
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._metrics)
+            stats["entries"] = len(self._entries)
+            return stats
+
+@st.cache_resource(show_spinner=False)
+def get_render_cache():
+    """Cache render dibuat sekali per proses (fungsi di script dibuat ulang tiap rerun, cache ini tidak)"""
+    return RenderCache()
+
+def render_message_html(content):
+    """HTML aman untuk pesan yang sudah selesai (di-cache)"""
+    return get_render_cache().render(content)
+
+def render_live_text(text):
+    """Teks jawaban yang masih berjalan: hanya di-escape, tanpa markdown (frame tetap murah untuk jawaban panjang).
+
+    Markdown penuh lewat RenderCache hanya untuk pesan final; baris baru jadi <br> agar tetap satu blok HTML.
+    """
+    return '<div class="message-body live-text">' + html.escape(text).replace("\n", "<br>") + "▌</div>"
 
 # ===========================
 # UI COMPONENTS
 # ===========================
+SIDEBAR_STATS_REFRESH = 10.0  # Detik antar rerun fragment statistik sidebar (0 = hanya saat run penuh)
+
 def render_header():
     """Render animated header with current role"""
     user_name = st.session_state.get("user_name", "")
@@ -724,25 +2822,25 @@ def render_welcome_message():
         role_configs = get_role_configs()
         current_config = role_configs[current_role]
         
-        with st.chat_message("assistant", avatar=current_config['icon']):
+        with st.chat_message("assistant", avatar=current_config.icon):
             st.markdown(f"""
             <div class="chat-message">
-                <div style="background: {current_config['gradient']}; color: white; 
+                <div style="background: {current_config.gradient}; color: white; 
                            padding: 1.5rem; border-radius: 15px; margin-bottom: 1rem;">
-                    <h3 style="margin: 0 0 1rem 0;">{current_config['icon']} Selamat datang {user_name if user_name else ""}!</h3>
-                    <p style="margin: 0;">Saya adalah <strong>{current_config['name']}</strong> yang siap membantu Anda dengan {current_config['description'].lower()}.</p>
+                    <h3 style="margin: 0 0 1rem 0;">{current_config.icon} Selamat datang {user_name if user_name else ""}!</h3>
+                    <p style="margin: 0;">Saya adalah <strong>{current_config.name}</strong> yang siap membantu Anda dengan {current_config.description.lower()}.</p>
                 </div>
             </div>
             """, unsafe_allow_html=True)
             
             # Sample questions with animation
             st.markdown("**🌟 Contoh pertanyaan yang bisa Anda ajukan:**")
-            for i, question in enumerate(current_config['sample_questions'], 1):
+            for i, question in enumerate(current_config.sample_questions, 1):
                 st.markdown(f"""
                 <div class="slide-in-left" style="animation-delay: {i * 0.2}s; 
                            background: rgba(24, 44, 122, 0.1); padding: 0.8rem; 
                            border-radius: 10px; margin: 0.5rem 0; 
-                           border-left: 4px solid {current_config['color']};">
+                           border-left: 4px solid {current_config.color};">
                     <strong>{i}.</strong> {question}
                 </div>
                 """, unsafe_allow_html=True)
@@ -757,27 +2855,60 @@ def render_welcome_message():
             </div>
             """, unsafe_allow_html=True)
 
+def mark_messages_seen():
+    """Tandai semua pesan yang sudah dimuat sebagai sudah tampil (tanpa animasi masuk lagi)"""
+    get_current_room().mark_seen()
+
+def show_earlier_messages():
+    """Perluas window render; muat halaman dari storage jika pesan di memori sudah habis"""
+    room = get_current_room()
+    room.render_window += CHAT_RENDER_WINDOW
+    if room.render_window > len(room.messages):
+        get_room_manager().load_earlier()
+
 def render_chat_history():
-    """Tampilkan riwayat chat dengan animasi"""
+    """Tampilkan riwayat chat (hanya window pesan terakhir) dengan animasi untuk pesan baru"""
     current_role = st.session_state.get("current_role", "assistant")
     role_configs = get_role_configs()
-    current_icon = role_configs[current_role]['icon']
-    
-    for i, message in enumerate(get_current_messages()):
+    current_icon = role_configs[current_role].icon
+
+    room = get_current_room()
+    messages = room.messages
+    offset = room.offset
+    start = max(0, len(messages) - room.render_window)
+    hidden = offset + start
+    if hidden > 0:
+        st.button(f"⬆️ Tampilkan pesan sebelumnya ({hidden} tersembunyi)",
+                  key="load_earlier", on_click=show_earlier_messages)
+
+    # Pesan yang sudah pernah tampil di room ini tidak dianimasikan ulang tiap rerun
+    seen_upto = room.seen_upto
+
+    for i in range(start, len(messages)):
+        message = messages[i]
+        is_new = offset + i >= seen_upto
         if message["role"] == "user":
+            animation_class = "slide-in-right chat-message" if is_new else ""
             with st.chat_message("user", avatar="👤"):
                 st.markdown(f"""
-                <div class="slide-in-right chat-message" style="animation-delay: {i * 0.1}s;">
-                    {message["content"]}
+                <div class="{animation_class}">
+                    {render_message_html(message["content"])}
                 </div>
                 """, unsafe_allow_html=True)
         else:
+            animation_class = "slide-in-left chat-message" if is_new else ""
             with st.chat_message("assistant", avatar=current_icon):
                 st.markdown(f"""
-                <div class="slide-in-left chat-message" style="animation-delay: {i * 0.1}s;">
-                    {message["content"]}
+                <div class="{animation_class}">
+                    {render_message_html(message["content"])}
                 </div>
                 """, unsafe_allow_html=True)
+                if message.get("error"):
+                    st.caption(f"⚠️ Jawaban terputus karena error, isinya belum lengkap: {message['error']}")
+                elif message.get("truncated"):
+                    st.caption("✂️ Jawaban dihentikan sebelum selesai")
+
+    mark_messages_seen()
 
 def update_role_defaults():
     """Update temperature dan max_tokens berdasarkan role yang dipilih"""
@@ -787,12 +2918,28 @@ def update_role_defaults():
     
     # Update defaults jika belum pernah diubah manual
     if f"manual_temp_{current_role}" not in st.session_state:
-        st.session_state.temperature = current_config["default_temperature"]
+        st.session_state.temperature = current_config.default_temperature
     if f"manual_tokens_{current_role}" not in st.session_state:
-        st.session_state.max_tokens = current_config["default_max_tokens"]
+        st.session_state.max_tokens = current_config.default_max_tokens
+
+def select_model(model):
+    """Callback tombol model rekomendasi (dijalankan sebelum fragment dirender ulang)"""
+    st.session_state.selected_model = model
+    notify("Model berhasil diubah!")
+
+def reset_role_parameters():
+    """Callback reset parameter ke default role dan hapus flag manual"""
+    current_role = st.session_state.current_role
+    current_config = get_role_configs()[current_role]
+    st.session_state.temperature = current_config.default_temperature
+    st.session_state.max_tokens = current_config.default_max_tokens
+    for key in (f"manual_temp_{current_role}", f"manual_tokens_{current_role}"):
+        if key in st.session_state:
+            del st.session_state[key]
+    notify("Parameter direset ke default!")
 
 def render_sidebar():
-    """Tampilkan sidebar dengan animasi dan styling modern - FIXED: Reorder sections"""
+    """Tampilkan sidebar: bagian statis dirender di run penuh, bagian interaktif sebagai fragment"""
     with st.sidebar:
         # Developer info - ANIMATED
         st.markdown(f"""
@@ -810,119 +2957,369 @@ def render_sidebar():
         st.markdown("### 💬 Chatrooms")
         
         if st.session_state.is_logged_in:
-            current_role = st.session_state.get("current_role", "assistant")
-            role_configs = get_role_configs()
-            current_config = role_configs[current_role]
-            
-            # Current chatroom display
-            current_room = st.session_state.current_chatroom
-            total_rooms = len(st.session_state.chatrooms)
-            current_msgs = len(get_current_messages())
-            
-            st.markdown(f"""
-            <div style="background: {current_config['gradient']}; color: white; 
-                        padding: 1rem; border-radius: 15px; text-align: center; margin-bottom: 1rem;">
-                <div style="font-size: 1.5rem;">💬</div>
-                <h4 style="margin: 0; color: white;">{current_room}</h4>
-                <p style="margin: 0.5rem 0 0 0; opacity: 0.9; font-size: 0.9rem;">
-                    {current_msgs} pesan | {total_rooms} rooms
-                </p>
+            render_room_section()
+        
+        st.markdown("---")
+        
+        # Biaya fragment ini = biaya menerapkan parameter / ganti model (tanpa rerun app)
+        with timed_render("sidebar_controls"):
+            render_sidebar_controls()
+        
+        st.markdown("---")
+        
+        # API Key status with animation
+        if not get_api_key():
+            st.markdown("""
+            <div class="error-shake" style="background: linear-gradient(45deg, #e74c3c, #c0392b); 
+                 color: white; padding: 1rem; border-radius: 10px; text-align: center;">
+                🔑 API Key tidak ditemukan!
             </div>
             """, unsafe_allow_html=True)
-            
-            # Room selector
-            col1, col2 = st.columns([3, 1])
-            with col1:
-                selected_room = st.selectbox(
-                    "Pilih Room:",
-                    options=list(st.session_state.chatrooms.keys()),
-                    index=list(st.session_state.chatrooms.keys()).index(current_room),
-                    key="room_selector"
-                )
-            with col2:
-                if st.button("➕", help="Buat room baru", key="new_room_btn"):
-                    new_room = create_new_chatroom()
-                    show_success_message(f"Room '{new_room}' dibuat!")
-                    time.sleep(0.5)
-                    st.rerun()
-            
-            # Switch room if different
-            if selected_room != current_room:
-                switch_chatroom(selected_room)
-                show_success_message(f"Pindah ke '{selected_room}'!")
-                time.sleep(0.5)
+            st.info("💡 Logout dan daftar ulang dengan API Key yang valid")
+        else:
+            st.markdown("""
+            <div class="success-bounce" style="background: linear-gradient(45deg, #2ecc71, #27ae60); 
+                 color: white; padding: 1rem; border-radius: 10px; text-align: center;">
+                ✅ API Key aktif!
+            </div>
+            """, unsafe_allow_html=True)
+
+        # Statistik di-refresh berkala oleh fragment-nya sendiri, bukan oleh rerun halaman
+        refresh = float(get_secret("sidebar_stats_refresh", SIDEBAR_STATS_REFRESH))
+        stats_fragment = st.fragment(render_sidebar_stats,
+                                     run_every=refresh if refresh > 0 and st.session_state.is_logged_in else None)
+        stats_fragment()
+
+@st.fragment
+def render_room_section():
+    """Fragment daftar & aksi room; pindah/buat/hapus room merender ulang seluruh app (chat pane ikut berubah)"""
+    render_notifications()
+    current_role = st.session_state.get("current_role", "assistant")
+    role_configs = get_role_configs()
+    current_config = role_configs[current_role]
+    
+    # Current chatroom display
+    current_room = get_current_room_name()
+    chatrooms = list_chatrooms()
+    total_rooms = len(chatrooms)
+    current_msgs = chatrooms[current_room]["messages"]
+    
+    # Metadata room: kapan dibuat dan role terakhir yang dipakai
+    metadata = get_current_room().metadata
+    details = []
+    if metadata.get("created_at"):
+        details.append(f"📅 {datetime.fromtimestamp(metadata['created_at']).strftime('%d/%m/%Y %H:%M')}")
+    if metadata.get("role") in role_configs:
+        details.append(role_configs[metadata["role"]].name)
+    
+    st.markdown(f"""
+    <div style="background: {current_config.gradient}; color: white; 
+                padding: 1rem; border-radius: 15px; text-align: center; margin-bottom: 1rem;">
+        <div style="font-size: 1.5rem;">💬</div>
+        <h4 style="margin: 0; color: white;">{html.escape(current_room)}</h4>
+        <p style="margin: 0.5rem 0 0 0; opacity: 0.9; font-size: 0.9rem;">
+            {current_msgs} pesan | {total_rooms} rooms
+        </p>
+        <p style="margin: 0.3rem 0 0 0; opacity: 0.8; font-size: 0.8rem;">{" · ".join(details)}</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # Room selector
+    col1, col2 = st.columns([3, 1])
+    with col1:
+        selected_room = st.selectbox(
+            "Pilih Room:",
+            options=list(chatrooms.keys()),
+            index=list(chatrooms.keys()).index(current_room),
+            key="room_selector"
+        )
+    with col2:
+        if st.button("➕", help="Buat room baru", key="new_room_btn"):
+            new_room = create_new_chatroom()
+            notify(f"Room '{new_room}' dibuat!")
+            st.rerun()
+    
+    # Switch room if different
+    if selected_room != current_room:
+        switch_chatroom(selected_room)
+        notify(f"Pindah ke '{selected_room}'!")
+        st.rerun()
+    
+    # Room actions
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("🔄 Rename Room", key="rename_room", disabled=current_room=="Default"):
+            st.session_state.show_rename_input = True
+    with col2:
+        if st.button("🗑️ Delete Room", key="delete_room", disabled=current_room=="Default" or total_rooms<=1):
+            if delete_chatroom(current_room):
+                notify(f"Room '{current_room}' dihapus!")
                 st.rerun()
-            
-            # Room actions
+            else:
+                show_error_message("Gagal menghapus room!")
+    
+    # Rename input (conditional)
+    if hasattr(st.session_state, 'show_rename_input') and st.session_state.show_rename_input:
+        with st.form("rename_form"):
+            new_name = st.text_input("Nama baru:", value=current_room)
             col1, col2 = st.columns(2)
             with col1:
-                if st.button("🔄 Rename Room", key="rename_room", disabled=current_room=="Default"):
-                    st.session_state.show_rename_input = True
-            with col2:
-                if st.button("🗑️ Delete Room", key="delete_room", disabled=current_room=="Default" or total_rooms<=1):
-                    if delete_chatroom(current_room):
-                        show_success_message(f"Room '{current_room}' dihapus!")
-                        time.sleep(0.5)
+                if st.form_submit_button("✅ Simpan"):
+                    if new_name and new_name != current_room and new_name not in chatrooms:
+                        # Rename room
+                        rename_chatroom(current_room, new_name)
+                        st.session_state.show_rename_input = False
+                        notify(f"Room diubah ke '{new_name}'!")
                         st.rerun()
                     else:
-                        show_error_message("Gagal menghapus room!")
-            
-            # Rename input (conditional)
-            if hasattr(st.session_state, 'show_rename_input') and st.session_state.show_rename_input:
-                with st.form("rename_form"):
-                    new_name = st.text_input("Nama baru:", value=current_room)
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        if st.form_submit_button("✅ Simpan"):
-                            if new_name and new_name != current_room and new_name not in st.session_state.chatrooms:
-                                # Rename room
-                                st.session_state.chatrooms[new_name] = st.session_state.chatrooms.pop(current_room)
-                                st.session_state.current_chatroom = new_name
-                                st.session_state.show_rename_input = False
-                                show_success_message(f"Room diubah ke '{new_name}'!")
-                                time.sleep(0.5)
-                                st.rerun()
-                            else:
-                                show_error_message("Nama tidak valid atau sudah ada!")
-                    with col2:
-                        if st.form_submit_button("❌ Batal"):
-                            st.session_state.show_rename_input = False
-                            st.rerun()
-            
-            # All rooms overview
-            st.markdown("**📋 Semua Rooms:**")
-            for room_name, messages in st.session_state.chatrooms.items():
-                is_current = room_name == current_room
-                icon = "📍" if is_current else "💬"
-                msg_count = len(messages)
-                
-                st.markdown(f"""
-                <div style="{'background: rgba(24, 44, 122, 0.2);' if is_current else 'background: rgba(24, 44, 122, 0.05);'} 
-                             padding: 0.5rem; border-radius: 8px; margin: 0.3rem 0;
-                             border-left: 4px solid {'#182c7a' if is_current else '#ccc'};">
-                    {icon} <strong>{room_name}</strong> ({msg_count} pesan)
-                </div>
-                """, unsafe_allow_html=True)
-            
-            # Clear chat with animation
-            if st.button("🗑️ Clear Chat", type="secondary"):
-                st.session_state.messages = []
-                save_current_messages([])
-                show_success_message("Chat berhasil dibersihkan!")
-                time.sleep(0.5)
+                        show_error_message("Nama tidak valid atau sudah ada!")
+            with col2:
+                if st.form_submit_button("❌ Batal"):
+                    st.session_state.show_rename_input = False
+                    st.rerun()
+    
+    # All rooms overview
+    st.markdown("**📋 Semua Rooms:**")
+    generating = {job.room for job in get_generation_pool().session_jobs(get_session_id()) if job.active}
+    for room_name, room_stats in chatrooms.items():
+        is_current = room_name == current_room
+        icon = "⏳" if room_name in generating else "📍" if is_current else "💬"
+        
+        # Nama room bisa berasal dari file impor: selalu di-escape sebelum masuk markup HTML
+        st.markdown(f"""
+        <div style="{'background: rgba(24, 44, 122, 0.2);' if is_current else 'background: rgba(24, 44, 122, 0.05);'} 
+                     padding: 0.5rem; border-radius: 8px; margin: 0.3rem 0;
+                     border-left: 4px solid {'#182c7a' if is_current else '#ccc'};">
+            {icon} <strong>{html.escape(room_name)}</strong> ({room_stats["messages"]} pesan)
+        </div>
+        """, unsafe_allow_html=True)
+    
+    # Clear chat with animation
+    if st.button("🗑️ Clear Chat", type="secondary"):
+        clear_current_room()
+        notify("Chat berhasil dibersihkan!")
+        st.rerun()
+    
+    with st.expander("📦 Export / Import"):
+        scope = st.radio("Export:", ["Room aktif", "Semua room"], horizontal=True, key="export_scope")
+        export_names = [current_room] if scope == "Room aktif" else list(chatrooms)
+        st.download_button(
+            "⬇️ Download .jsonl.gz",
+            data=export_chatrooms(export_names),
+            file_name=archive_file_name(export_names),
+            mime="application/gzip",
+            on_click="ignore",
+            key="export_rooms",
+        )
+        uploaded = st.file_uploader(
+            "Impor file export:", type=["gz", "jsonl"],
+            key=f"import_file_{st.session_state.import_uploader_nonce}",
+        )
+        if uploaded is not None and st.button("⬆️ Impor", key="import_rooms"):
+            try:
+                imported = import_chatrooms(uploaded)
+            except ArchiveError as e:
+                show_error_message(f"Gagal impor: {e}")
+            else:
+                st.session_state.import_uploader_nonce += 1
+                notify(f"{sum(imported.values())} pesan diimpor ke {len(imported)} room: {', '.join(imported)}")
+                st.rerun()
+
+@st.fragment
+def render_sidebar_controls():
+    """Fragment user info, role, model & parameter; interaksi di sini hanya merender ulang fragment ini"""
+    sync_registry_selection()
+    render_notifications()
+    role_configs = get_role_configs()
+    current_config = role_configs[st.session_state.current_role]
+    
+    # User info diisi paling akhir agar menampilkan model & parameter yang diterapkan di run ini
+    user_info = st.container()
+    
+    st.markdown("---")
+    
+    # Role Selector with ANIMATED CARDS
+    st.markdown("### 🎭 Pilih Role AI")
+    role_configs = get_role_configs()
+    
+    # Create animated role cards
+    for role_key, config in role_configs.items():
+        is_active = role_key == st.session_state.current_role
+        card_class = "role-card active" if is_active else "role-card"
+        
+        if st.button(f"{config.icon} {config.name.replace(config.icon, '').strip()}", 
+                    key=f"role_{role_key}", 
+                    help=config.description,
+                    use_container_width=True):
+            if role_key != st.session_state.current_role:
+                st.session_state.current_role = role_key
+                # Clear current room when switching roles
+                clear_current_room()
+                # Set recommended model for new role
+                recommended_models = config.recommended_models
+                available_models = get_available_models()
+                for model in recommended_models:
+                    if model in available_models:
+                        st.session_state.selected_model = model
+                        break
+                # Update role defaults
+                update_role_defaults()
+                notify(f"Beralih ke {config.name}!")
                 st.rerun()
+    
+    # Show current role info with animation
+    current_config = role_configs[st.session_state.current_role]
+    st.markdown(f"""
+    <div style="background: {current_config.gradient}; color: white; 
+                padding: 1.5rem; border-radius: 15px; margin: 1rem 0; text-align: center;
+                animation: pulse 3s infinite;">
+        <div style="font-size: 2rem; margin-bottom: 0.5rem;">{current_config.icon}</div>
+        <h4 style="margin: 0; color: white;">Role Aktif</h4>
+        <p style="margin: 0.5rem 0 0 0; opacity: 0.9;">{current_config.description}</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    st.markdown("---")
+    
+    # Model Selection with animations
+    st.markdown("### 👾 AI Model")
+    available_models = get_available_models()
+    recommended_models = current_config.recommended_models
+    
+    # Show recommended models first
+    st.markdown("**⭐ Rekomendasi untuk role ini:**")
+    for model in recommended_models[:3]:
+        if model in available_models:
+            st.button(f"{available_models[model]}", key=f"rec_{model}", on_click=select_model, args=(model,))
+    
+    st.markdown("**📋 Semua Model:**")
+    selected_model = st.selectbox(
+        "Model:",
+        options=list(available_models.keys()),
+        format_func=lambda x: available_models[x],
+        index=list(available_models.keys()).index(st.session_state.selected_model)
+    )
+    if selected_model != st.session_state.selected_model:
+        st.session_state.selected_model = selected_model
+
+    # Compare mode: satu prompt ke beberapa model sekaligus
+    st.toggle("⚖️ Mode bandingkan model", key="compare_mode",
+              help="Kirim pertanyaan ke beberapa model paralel dan bandingkan latency & tokens")
+    if st.session_state.compare_mode:
+        if not st.session_state.compare_models:
+            st.session_state.compare_models = [m for m in recommended_models if m in available_models]
+        st.multiselect(
+            "Model yang dibandingkan:",
+            options=list(available_models.keys()),
+            format_func=lambda x: available_models[x],
+            max_selections=4,
+            key="compare_models"
+        )
+    
+    st.markdown("---")
+    
+    # AI Parameters Section with animations
+    st.markdown("### ⚙️ Parameter AI")
+    
+    # Slider & toggle dikumpulkan dalam form: menggeser slider tidak memicu rerun sampai diterapkan
+    with st.form("parameter_form", border=False):
+        new_temperature = st.slider(
+            "🌡️ Temperature",
+            min_value=0.0,
+            max_value=1.0,
+            value=st.session_state.temperature,
+            step=0.1,
+            help="Mengontrol kreativitas AI. Rendah = lebih konsisten, Tinggi = lebih kreatif"
+        )
+        new_max_tokens = st.slider(
+            "📝 Max Tokens",
+            min_value=100,
+            max_value=2000,
+            value=st.session_state.max_tokens,
+            step=50,
+            help="Mengontrol panjang respons AI. Lebih tinggi = respons lebih panjang"
+        )
         
-        st.markdown("---")
+        # Streaming mode
+        stream_responses = st.toggle(
+            "⚡ Streaming respons",
+            value=st.session_state.stream_responses,
+            help="Tampilkan jawaban AI token demi token saat diterima, tanpa menunggu respons lengkap"
+        )
+        use_response_cache = st.toggle(
+            "💾 Cache respons",
+            value=st.session_state.use_response_cache,
+            help="Pakai ulang jawaban untuk percakapan yang sama persis (hanya temperature rendah)"
+        )
+        auto_fallback = st.toggle(
+            "↪️ Fallback otomatis",
+            value=st.session_state.auto_fallback,
+            help="Jika model gagal (402/429/5xx/timeout), coba model rekomendasi role berikutnya"
+        )
+        hedge_requests = st.toggle(
+            "🏁 Hedging model lambat",
+            value=st.session_state.hedge_requests,
+            help="Jika token pertama belum datang beberapa detik, jalankan model cadangan dan pakai yang lebih cepat "
+                 "(butuh fallback otomatis)"
+        )
+        summarize_history = st.toggle(
+            "🧾 Ringkas riwayat lama",
+            value=st.session_state.summarize_history,
+            help="Pesan lama yang tidak muat di context window dilipat ke ringkasan, bukan dibuang"
+        )
+        reduced_motion = st.toggle(
+            "🪶 Mode ringan",
+            value=st.session_state.reduced_motion,
+            help="Matikan gradient bergerak dan animasi berulang (hemat CPU/baterai, ramah reduced motion)"
+        )
         
-        # User info - ANIMATED
-        if st.session_state.is_logged_in:
+        if st.form_submit_button("✅ Terapkan Parameter", use_container_width=True):
+            if new_temperature != st.session_state.temperature:
+                st.session_state.temperature = new_temperature
+                st.session_state[f"manual_temp_{st.session_state.current_role}"] = True
+            if new_max_tokens != st.session_state.max_tokens:
+                st.session_state.max_tokens = new_max_tokens
+                st.session_state[f"manual_tokens_{st.session_state.current_role}"] = True
+            st.session_state.stream_responses = stream_responses
+            st.session_state.use_response_cache = use_response_cache
+            st.session_state.auto_fallback = auto_fallback
+            st.session_state.hedge_requests = hedge_requests
+            st.session_state.summarize_history = summarize_history
+            notify("Parameter diterapkan!")
+            if reduced_motion != st.session_state.reduced_motion:
+                # Tema disuntikkan configure_page di run penuh
+                st.session_state.reduced_motion = reduced_motion
+                st.rerun()
+
+    # Parameter indicators with role recommendations
+    st.markdown("**🎯 Rekomendasi untuk role ini:**")
+    default_temp = current_config.default_temperature
+    default_tokens = current_config.default_max_tokens
+    
+    temp_status = "✅" if abs(st.session_state.temperature - default_temp) < 0.05 else "⚠️"
+    tokens_status = "✅" if abs(st.session_state.max_tokens - default_tokens) < 50 else "⚠️"
+    
+    st.markdown(f"""
+    <div style="background: rgba(24, 44, 122, 0.1); padding: 1rem; border-radius: 10px;">
+        <p style="margin: 0;">{temp_status} Temperature: {default_temp}</p>
+        <p style="margin: 0;">{tokens_status} Max Tokens: {default_tokens}</p>
+    </div>
+    """, unsafe_allow_html=True)
+    
+    # Reset to role defaults button
+    st.button("🔄 Reset ke Default Role", help="Reset parameter sesuai rekomendasi role",
+              on_click=reset_role_parameters)
+    
+    # User info - ANIMATED
+    if st.session_state.is_logged_in:
+        with user_info:
             available_models = get_available_models()
             
             st.markdown(f"""
-            <div class="sidebar-item" style="background: {current_config['gradient']}; color: white;">
+            <div class="sidebar-item" style="background: {current_config.gradient}; color: white;">
                 <h3 style="margin: 0 0 0.5rem 0;">👤 User Info</h3>
                 <p style="margin: 0;"><strong>Nama:</strong> {st.session_state.user_name}</p>
-                <p style="margin: 0;"><strong>Role:</strong> {current_config['name']}</p>
+                <p style="margin: 0;"><strong>Role:</strong> {current_config.name}</p>
                 <p style="margin: 0;"><strong>Model:</strong> {available_models[st.session_state.selected_model][:20]}...</p>
                 <div style="display: flex; gap: 1rem; margin-top: 0.5rem;">
                     <div class="param-display" style="flex: 1;">Temp: {st.session_state.temperature}</div>
@@ -932,203 +3329,168 @@ def render_sidebar():
             """, unsafe_allow_html=True)
             
             if st.button("🔄 Logout & Ganti User", type="secondary"):
-                for key in ["user_name", "is_logged_in", "messages", "api_key"]:
+                for key in ["user_name", "auth_user", "is_logged_in", "api_key", "room_manager"]:
                     if key in st.session_state:
                         del st.session_state[key]
-                show_success_message("Logout berhasil!")
-                time.sleep(1)
+                notify("Logout berhasil!")
                 st.rerun()
-        
-        st.markdown("---")
-        
-        # Role Selector with ANIMATED CARDS
-        st.markdown("### 🎭 Pilih Role AI")
-        role_configs = get_role_configs()
-        
-        # Create animated role cards
-        for role_key, config in role_configs.items():
-            is_active = role_key == st.session_state.current_role
-            card_class = "role-card active" if is_active else "role-card"
-            
-            if st.button(f"{config['icon']} {config['name'].replace(config['icon'], '').strip()}", 
-                        key=f"role_{role_key}", 
-                        help=config['description'],
-                        use_container_width=True):
-                if role_key != st.session_state.current_role:
-                    st.session_state.current_role = role_key
-                    # Clear current room when switching roles
-                    st.session_state.messages = []
-                    save_current_messages([])
-                    # Set recommended model for new role
-                    recommended_models = config["recommended_models"]
-                    available_models = get_available_models()
-                    for model in recommended_models:
-                        if model in available_models:
-                            st.session_state.selected_model = model
-                            break
-                    # Update role defaults
-                    update_role_defaults()
-                    show_success_message(f"Beralih ke {config['name']}!")
-                    time.sleep(0.5)
-                    st.rerun()
-        
-        # Show current role info with animation
-        current_config = role_configs[st.session_state.current_role]
+
+def render_sidebar_stats():
+    """Metrics koneksi & statistik chat; dijalankan sebagai fragment yang rerun berkala (sidebar_stats_refresh)"""
+    if st.session_state.is_logged_in:
+        # Jawaban room lain yang selesai di background diumumkan lewat refresh berkala ini
+        collect_finished_generations()
+        render_notifications()
+    # Connection pool metrics
+    with st.expander("🔌 Koneksi API", expanded=False):
+        client_stats = get_http_client().stats()
         st.markdown(f"""
-        <div style="background: {current_config['gradient']}; color: white; 
-                    padding: 1.5rem; border-radius: 15px; margin: 1rem 0; text-align: center;
-                    animation: pulse 3s infinite;">
-            <div style="font-size: 2rem; margin-bottom: 0.5rem;">{current_config['icon']}</div>
-            <h4 style="margin: 0; color: white;">Role Aktif</h4>
-            <p style="margin: 0.5rem 0 0 0; opacity: 0.9;">{current_config['description']}</p>
+        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 0.5rem;">
+            <div class="param-display">Request: {client_stats['requests']}</div>
+            <div class="param-display">Retry: {client_stats['retries']}</div>
+            <div class="param-display">Pool hit: {client_stats['pool_hits']}</div>
+            <div class="param-display">Koneksi baru: {client_stats['new_connections']}</div>
         </div>
         """, unsafe_allow_html=True)
-        
-        st.markdown("---")
-        
-        # Model Selection with animations
-        st.markdown("### 👾 AI Model")
-        available_models = get_available_models()
-        recommended_models = current_config["recommended_models"]
-        
-        # Show recommended models first
-        st.markdown("**⭐ Rekomendasi untuk role ini:**")
-        for model in recommended_models[:3]:
-            if model in available_models:
-                if st.button(f"{available_models[model]}", key=f"rec_{model}"):
-                    st.session_state.selected_model = model
-                    show_success_message("Model berhasil diubah!")
-                    time.sleep(0.5)
-                    st.rerun()
-        
-        st.markdown("**📋 Semua Model:**")
-        selected_model = st.selectbox(
-            "Model:",
-            options=list(available_models.keys()),
-            format_func=lambda x: available_models[x],
-            index=list(available_models.keys()).index(st.session_state.selected_model)
+
+        health = get_model_health()
+        for model, entry in health.snapshot().items():
+            if health.is_open(model):
+                status = "🔴"
+            elif health.is_slow(model):
+                status = "🐢"
+            else:
+                status = "🟢"
+            latency = f"{entry['ewma_latency']:.1f}s" if entry["ewma_latency"] is not None else "-"
+            st.caption(f"{status} {model} · {latency} · ✅ {entry['successes']} · ❌ {entry['failures']}")
+        scheduler_stats = get_scheduler().stats()
+        st.caption(
+            f"🚦 Slot upstream: {scheduler_stats['in_flight']} berjalan · "
+            f"{scheduler_stats['waiting']} antre · {scheduler_stats['active_users']} user aktif"
         )
-        if selected_model != st.session_state.selected_model:
-            st.session_state.selected_model = selected_model
-        
-        st.markdown("---")
-        
-        # AI Parameters Section with animations
-        st.markdown("### ⚙️ Parameter AI")
-        
-        # Temperature Control with animated display
-        col1, col2 = st.columns([3, 1])
-        with col1:
-            new_temperature = st.slider(
-                "🌡️ Temperature",
-                min_value=0.0,
-                max_value=1.0,
-                value=st.session_state.temperature,
-                step=0.1,
-                help="Mengontrol kreativitas AI. Rendah = lebih konsisten, Tinggi = lebih kreatif"
-            )
-        with col2:
-            st.markdown(f"""
-            <div class="param-display" style="margin-top: 1rem;">
-                {new_temperature}
-            </div>
-            """, unsafe_allow_html=True)
-        
-        if new_temperature != st.session_state.temperature:
-            st.session_state.temperature = new_temperature
-            st.session_state[f"manual_temp_{st.session_state.current_role}"] = True
+        limiter_stats = get_rate_limiter().stats()
+        st.caption(
+            f"🪣 Rate limit: {limiter_stats['allowed']} lolos · {limiter_stats['delayed']} ditunda · "
+            f"{limiter_stats['rejected']} ditolak · {limiter_stats['throttled_429']}× 429"
+        )
+        generation_stats = get_generation_pool().stats()
+        st.caption(
+            f"🧵 Generate: {generation_stats['running']} berjalan · {generation_stats['completed']} selesai · "
+            f"{generation_stats['failed']} gagal · {generation_stats['stopped']} di-stop · "
+            f"{generation_stats['cancelled']} dibatalkan"
+        )
+        st.caption(f"🎨 Payload tema per rerun: {st.session_state.get('theme_payload_bytes', 0)} B")
+        render_stats = get_render_cache().stats()
+        st.caption(
+            f"🧩 Render cache: {render_stats['hits']} hit · {render_stats['misses']} miss · "
+            f"{render_stats['entries']}/{RENDER_CACHE_SIZE} pesan"
+        )
+
+    st.markdown("---")
+    
+    # Chat stats with animations
+    cache_stats = get_response_cache().stats()
+    # Counter agregat room aktif (O(1)), bukan scan pesan yang hanya berisi halaman terakhir
+    room_stats = get_current_room().stats if st.session_state.is_logged_in else None
+    if room_stats and room_stats["messages"]:
+        total = room_stats["messages"]
+        user_msgs = room_stats["user_messages"]
+        ai_msgs = room_stats["assistant_messages"]
+        room_usage = get_chat_storage().usage_totals(get_storage_user(), get_current_room_name())
         
-        # Max Tokens Control with animated display
-        col1, col2 = st.columns([3, 1])
-        with col1:
-            new_max_tokens = st.slider(
-                "📝 Max Tokens",
-                min_value=100,
-                max_value=2000,
-                value=st.session_state.max_tokens,
-                step=50,
-                help="Mengontrol panjang respons AI. Lebih tinggi = respons lebih panjang"
-            )
-        with col2:
-            st.markdown(f"""
-            <div class="param-display" style="margin-top: 1rem;">
-                {new_max_tokens}
+        st.markdown("""
+        <div class="sidebar-item" style="background: linear-gradient(135deg, #182c7a, #1d2f7e); color: white;">
+            <h3 style="margin: 0 0 0.5rem 0;">📊 Chat Statistics</h3>
+            <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 0.5rem;">
+                <div class="param-display">Total: {}</div>
+                <div class="param-display">User: {}</div>
+                <div class="param-display">AI: {}</div>
+                <div class="param-display">Tokens API: {}</div>
             </div>
-            """, unsafe_allow_html=True)
-        
-        if new_max_tokens != st.session_state.max_tokens:
-            st.session_state.max_tokens = new_max_tokens
-            st.session_state[f"manual_tokens_{st.session_state.current_role}"] = True
-        
-        # Parameter indicators with role recommendations
-        st.markdown("**🎯 Rekomendasi untuk role ini:**")
-        default_temp = current_config["default_temperature"]
-        default_tokens = current_config["default_max_tokens"]
-        
-        temp_status = "✅" if abs(st.session_state.temperature - default_temp) < 0.05 else "⚠️"
-        tokens_status = "✅" if abs(st.session_state.max_tokens - default_tokens) < 50 else "⚠️"
-        
+        </div>
+        """.format(total, user_msgs, ai_msgs, room_usage["total_tokens"]), 
+        unsafe_allow_html=True)
+    # Counter cache proses ini, ditampilkan juga saat room aktif masih kosong
+    st.caption(
+        f"🗄️ Cache respons: {cache_stats['hits']} hit ({cache_stats['disk_hits']} dari disk) · "
+        f"{cache_stats['misses']} miss · {cache_stats['entries']} entry · "
+        f"disk {'aktif' if get_response_cache().disk_dir else 'mati'}"
+    )
+
+    if st.session_state.is_logged_in:
+        render_usage_dashboard()
+        render_room_stats_dashboard(list_chatrooms())
+        render_latency_panel()
+
+def render_usage_dashboard():
+    """Dashboard biaya & throughput dari usage yang dilaporkan API"""
+    ledger = get_usage_ledger()
+    storage = get_chat_storage()
+    user = get_storage_user()
+    with st.expander("💰 Usage & Biaya", expanded=False):
+        room_usage = storage.usage_totals(user, get_current_room_name())
+        user_usage = storage.usage_totals(user)
+        user_rate = ledger.throughput(user=user)
+        global_rate = ledger.throughput()
         st.markdown(f"""
-        <div style="background: rgba(24, 44, 122, 0.1); padding: 1rem; border-radius: 10px;">
-            <p style="margin: 0;">{temp_status} Temperature: {default_temp}</p>
-            <p style="margin: 0;">{tokens_status} Max Tokens: {default_tokens}</p>
+        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 0.5rem;">
+            <div class="param-display">Room: {room_usage['total_tokens']} tok</div>
+            <div class="param-display">Room: ${room_usage['cost']:.4f}</div>
+            <div class="param-display">Anda: {user_usage['total_tokens']} tok</div>
+            <div class="param-display">Anda: ${user_usage['cost']:.4f}</div>
         </div>
         """, unsafe_allow_html=True)
-        
-        # Reset to role defaults button
-        if st.button("🔄 Reset ke Default Role", help="Reset parameter sesuai rekomendasi role"):
-            st.session_state.temperature = default_temp
-            st.session_state.max_tokens = default_tokens
-            # Remove manual flags
-            current_role = st.session_state.current_role
-            if f"manual_temp_{current_role}" in st.session_state:
-                del st.session_state[f"manual_temp_{current_role}"]
-            if f"manual_tokens_{current_role}" in st.session_state:
-                del st.session_state[f"manual_tokens_{current_role}"]
-            show_success_message("Parameter direset ke default!")
-            time.sleep(0.5)
-            st.rerun()
-        
-        st.markdown("---")
-        
-        # API Key status with animation
-        if not st.session_state.api_key:
-            st.markdown("""
-            <div class="error-shake" style="background: linear-gradient(45deg, #e74c3c, #c0392b); 
-                 color: white; padding: 1rem; border-radius: 10px; text-align: center;">
-                🔑 API Key tidak ditemukan!
-            </div>
-            """, unsafe_allow_html=True)
-            st.info("💡 Logout dan daftar ulang dengan API Key yang valid")
-        else:
-            st.markdown("""
-            <div class="success-bounce" style="background: linear-gradient(45deg, #2ecc71, #27ae60); 
-                 color: white; padding: 1rem; border-radius: 10px; text-align: center;">
-                ✅ API Key aktif!
-            </div>
-            """, unsafe_allow_html=True)
-        
-        st.markdown("---")
-        
-        # Chat stats with animations
-        if st.session_state.messages:
-            total = len(st.session_state.messages)
-            user_msgs = len([m for m in st.session_state.messages if m["role"] == "user"])
-            ai_msgs = len([m for m in st.session_state.messages if m["role"] == "assistant"])
-            
-            st.markdown("""
-            <div class="sidebar-item" style="background: linear-gradient(135deg, #182c7a, #1d2f7e); color: white;">
-                <h3 style="margin: 0 0 0.5rem 0;">📊 Chat Statistics</h3>
-                <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 0.5rem;">
-                    <div class="param-display">Total: {}</div>
-                    <div class="param-display">User: {}</div>
-                    <div class="param-display">AI: {}</div>
-                    <div class="param-display">Tokens: ~{}</div>
-                </div>
-            </div>
-            """.format(total, user_msgs, ai_msgs, 
-                      sum(len(m["content"]) for m in st.session_state.messages) // 4), 
-            unsafe_allow_html=True)
+        st.caption(
+            f"⏱️ 5 menit terakhir — Anda: {user_rate['requests_per_min']:.1f} req/min, "
+            f"{user_rate['tokens_per_min']:.0f} tok/min · Semua user: "
+            f"{global_rate['requests_per_min']:.1f} req/min, {global_rate['tokens_per_min']:.0f} tok/min, "
+            f"${global_rate['cost_per_min'] * 60:.4f}/jam"
+        )
+        model_totals = ledger.model_totals()
+        if model_totals:
+            st.dataframe([
+                {
+                    "Model": model,
+                    "Req": counters["requests"],
+                    "Prompt": counters["prompt_tokens"],
+                    "Cached": counters["cached_tokens"],
+                    "Completion": counters["completion_tokens"],
+                    "Cost ($)": round(counters["cost"], 5),
+                }
+                for model, counters in sorted(model_totals.items(), key=lambda item: -item[1]["cost"])
+            ], use_container_width=True, hide_index=True)
+
+def render_room_stats_dashboard(room_stats):
+    """Ringkasan lintas room dari counter agregat (tanpa memuat pesan satu pun)"""
+    with st.expander("📈 Statistik Semua Room", expanded=False):
+        totals = {field: sum(stats[field] for stats in room_stats.values()) for field in ROOM_STAT_FIELDS}
+        active_rooms = sum(1 for stats in room_stats.values() if stats["messages"])
+        average_chars = totals["chars"] // totals["messages"] if totals["messages"] else 0
+        st.markdown(f"""
+        <div style="display: grid; grid-template-columns: 1fr 1fr; gap: 0.5rem;">
+            <div class="param-display">Room aktif: {active_rooms}/{len(room_stats)}</div>
+            <div class="param-display">Pesan: {totals['messages']}</div>
+            <div class="param-display">User: {totals['user_messages']}</div>
+            <div class="param-display">AI: {totals['assistant_messages']}</div>
+            <div class="param-display">Token pesan: {totals['tokens']}</div>
+            <div class="param-display">Rata-rata: {average_chars} char</div>
+        </div>
+        """, unsafe_allow_html=True)
+        rows = [
+            {
+                "Room": name,
+                "Pesan": stats["messages"],
+                "User": stats["user_messages"],
+                "AI": stats["assistant_messages"],
+                "Karakter": stats["chars"],
+                "Token": stats["tokens"],
+                "Aktivitas": (datetime.fromtimestamp(stats["last_activity"]).strftime("%d/%m %H:%M")
+                              if stats["last_activity"] else "-"),
+            }
+            # Room yang paling baru aktif di atas
+            for name, stats in sorted(room_stats.items(), key=lambda item: -(item[1]["last_activity"] or 0))
+        ]
+        st.dataframe(rows, use_container_width=True, hide_index=True)
 
 # ===========================
 # CHAT FUNCTIONALITY
@@ -1137,77 +3499,389 @@ def handle_chat():
     """Handle chat input dan response dengan animasi"""
     current_role = st.session_state.get("current_role", "assistant")
     role_configs = get_role_configs()
-    current_icon = role_configs[current_role]['icon']
+    current_icon = role_configs[current_role].icon
     
-    if prompt := st.chat_input(f"💬 Chat dengan {role_configs[current_role]['name']}...", key="chat_input"):
+    # Jawaban room ini masih dibuat di worker (mis. setelah pindah room lalu kembali): lanjutkan tampilannya
+    job = get_room_generation()
+    if job is not None:
+        render_generation(job, current_icon)
+    
+    # Satu job per room: input dikunci selama jawaban room ini masih dibuat
+    busy = job is not None and job.active
+    placeholder = "⏳ Menunggu jawaban selesai..." if busy else f"💬 Chat dengan {role_configs[current_role].name}..."
+    if prompt := st.chat_input(placeholder, key="chat_input", disabled=busy):
+        if busy:
+            # Terkirim sebelum input sempat terkunci; jangan render dua job di run yang sama
+            show_error_message("Jawaban sebelumnya di room ini belum selesai. Tunggu atau klik ⏹️ Stop.")
+            return
+        if st.session_state.compare_mode and st.session_state.compare_models:
+            # Mode bandingkan: hasil tidak disimpan ke room, hanya metrics per model
+            with st.chat_message("user", avatar="👤"):
+                st.markdown(prompt)
+            run_model_comparison(prompt, st.session_state.compare_models)
+            return
+        
         # Add user message dengan animasi
-        current_messages = get_current_messages()
-        current_messages.append({"role": "user", "content": prompt})
-        st.session_state.messages = current_messages
-        save_current_messages(current_messages)
+        append_current_message({"role": "user", "content": prompt})
         
         # Display user message dengan slide animation
         with st.chat_message("user", avatar="👤"):
             st.markdown(f"""
             <div class="slide-in-right chat-message">
-                {prompt}
+                {render_message_html(prompt)}
             </div>
             """, unsafe_allow_html=True)
+        mark_messages_seen()
         
-        # Get and display AI response dengan animasi
-        with st.chat_message("assistant", avatar=current_icon):
-            
-            # Get AI response
-            ai_response = get_ai_response(prompt)
-            
-            if ai_response:
-                # Show typing animation for response
-                response_container = st.empty()
-                displayed_text = ""
-                
-                for char in ai_response:
-                    displayed_text += char
-                    response_container.markdown(f"""
-                    <div class="slide-in-left chat-message">
-                        {displayed_text}▌
-                    </div>
-                    """, unsafe_allow_html=True)
-                    time.sleep(st.session_state.typing_speed)
-                
-                # Final response without cursor
+        job = start_generation(prompt)
+        if job is None:
+            return
+        if job.active:
+            # Rerun penuh: input terkunci dan daftar room menandai ⏳ selama job berjalan
+            st.rerun()
+        render_generation(job, current_icon)
+
+def render_generation(job, icon):
+    """Tampilkan job room aktif tanpa menahan thread script.
+
+    Selama job berjalan progresnya digambar fragment polling yang tiap tick langsung kembali, jadi
+    klik lain (pindah room, sidebar, parameter) tetap dilayani. Setelah job selesai app dirender
+    ulang sekali dan jawaban finalnya ditampilkan di sini.
+    """
+    if job.active:
+        interval = float(get_secret("generation_poll_interval", GENERATION_POLL_INTERVAL))
+        st.fragment(render_live_generation, run_every=interval)(job, icon)
+    else:
+        render_finished_generation(job, icon)
+
+def render_live_generation(job, icon):
+    """Satu tick polling: gambar progres job saat ini lalu kembali, tidak menunggu job selesai"""
+    if not job.active:
+        # Rerun app: polling berhenti dan render_finished_generation menampilkan jawaban final
+        st.rerun()
+    timer = job.route_info["timer"]
+    with st.chat_message("assistant", avatar=icon):
+        text = job.text
+        if job.stream and text:
+            started = time.perf_counter()
+            st.markdown(f"""
+            <div class="chat-message">
+                {render_live_text(text)}
+            </div>
+            """, unsafe_allow_html=True)
+            timer.add_render(time.perf_counter() - started)
+        elif job.status_text:
+            show_thinking_animation(job.status_text)
+        else:
+            show_thinking_animation()
+        st.button("⏹️ Stop", key=f"stop_{id(job)}", help="Hentikan jawaban ini",
+                  on_click=stop_generation, args=(job.room,))
+
+def render_finished_generation(job, icon):
+    """Jawaban final job (animasi ketik untuk non-streaming, error, stats), lalu ambil job ke session"""
+    timer = job.route_info["timer"]
+    ai_response = job.text if job.status != "cancelled" else ""
+    with st.chat_message("assistant", avatar=icon):
+        response_container = st.empty()
+        render_started = time.perf_counter()
+        if ai_response and not job.stream and not job.shown:
+            # Animasi ketik hanya sekali, walau rerun memotongnya di tengah jalan
+            job.shown = True
+            # Beberapa karakter per frame (maks ~1 frame per STREAM_RENDER_INTERVAL), kecepatan total tetap
+            typing_speed = st.session_state.typing_speed
+            step = max(1, int(STREAM_RENDER_INTERVAL / typing_speed)) if typing_speed > 0 else len(ai_response)
+            for end in range(step, len(ai_response) + step, step):
                 response_container.markdown(f"""
                 <div class="slide-in-left chat-message">
-                    {ai_response}
-                </div>
-                """, unsafe_allow_html=True)
-                
-                current_messages = get_current_messages()
-                current_messages.append({"role": "assistant", "content": ai_response})
-                st.session_state.messages = current_messages
-                save_current_messages(current_messages)
-                
-                # Show response stats dengan animasi
-                response_length = len(ai_response)
-                estimated_tokens = response_length // 4
-                st.markdown(f"""
-                <div class="param-display" style="margin-top: 1rem; font-size: 0.8rem;">
-                    📊 {response_length} karakter (~{estimated_tokens} tokens) | 
-                    🌡️ {st.session_state.temperature} | 📝 {st.session_state.max_tokens}
+                    {render_live_text(ai_response[:end])}
                 </div>
                 """, unsafe_allow_html=True)
+                time.sleep(typing_speed * step)
+        if ai_response:
+            response_container.markdown(f"""
+            <div class="chat-message">
+                {render_message_html(ai_response)}
+            </div>
+            """, unsafe_allow_html=True)
+        timer.add_render(time.perf_counter() - render_started)
+        
+        if job.error is not None:
+            show_api_error(job.error)
+        if ai_response:
+            show_response_stats(job, ai_response)
+        elif job.status == "cancelled" or (job.error is None and job.stop_event.is_set()):
+            st.caption("⏹️ Dihentikan sebelum jawaban tiba")
+        elif job.error is None:
+            show_error_message("Gagal mendapat respons. Coba lagi.")
+    collect_generation(job, watched=True)
+
+def stop_generation(room):
+    """Callback tombol Stop (dijalankan di awal rerun fragment polling)"""
+    get_generation_pool().stop(get_session_id(), room)
+
+def show_response_stats(job, ai_response):
+    """Baris ringkas panjang, tokens, biaya dan model yang menjawab di bawah respons"""
+    response_length = len(ai_response)
+    usage = job.route_info.get("usage")
+    if usage:
+        token_info = f"{usage['prompt_tokens']} + {usage['completion_tokens']} tokens"
+        if usage.get("cached_tokens"):
+            token_info += f" | ⚡ {usage['cached_tokens']} cached"
+        if usage["cost"]:
+            token_info += f" | 💲{usage['cost']:.5f}"
+    else:
+        token_info = f"~{response_length // 4} tokens"
+    requested_model = job.payload["model"]
+    answered_by = job.route_info.get("model", requested_model)
+    fallback_note = ""
+    if answered_by != requested_model:
+        fallback_note = f" | ↪️ {get_available_models().get(answered_by, answered_by)}"
+    truncated_note = ""
+    if job.truncated:
+        truncated_note = " | ⚠️ terputus (error)" if job.error is not None else " | ✂️ dihentikan"
+    st.markdown(f"""
+    <div class="param-display" style="margin-top: 1rem; font-size: 0.8rem;">
+        📊 {response_length} karakter ({token_info}) | 
+        🌡️ {job.payload["temperature"]} | 📝 {job.payload["max_tokens"]}{fallback_note}{truncated_note}
+    </div>
+    """, unsafe_allow_html=True)
+
+def collect_generation(job, watched=False):
+    """Ambil job yang selesai: tarik jawabannya ke Chatroom session dan catat metrics giliran"""
+    if job.collected or job.active:
+        return
+    job.collected = True
+    get_generation_pool().discard(job)
+    if job.status == "cancelled":
+        return
+    get_room_manager().sync(job.room)
+    timer = job.route_info["timer"]
+    if watched:
+        # Respons sudah tampil live, jangan dianimasikan ulang di rerun berikutnya
+        mark_messages_seen()
+    else:
+        timer.mark("end", job.finished_at)
+        if job.error is not None and not job.parts:
+            notify(f"Gagal mendapat respons di room '{job.room}'", kind="error")
+        elif job.error is not None:
+            notify(f"Jawaban di room '{job.room}' terputus karena error", kind="warning")
+        elif job.room != get_current_room_name():
+            notify(f"Jawaban di room '{job.room}' sudah selesai!", kind="info")
+    record_turn_metrics(timer, job.route_info.get("model", job.payload["model"]))
+
+def collect_finished_generations():
+    """Ambil job session ini yang selesai di background di room lain (job room aktif ditampilkan handle_chat)"""
+    current_room = get_current_room_name()
+    for job in get_generation_pool().session_jobs(get_session_id()):
+        if not job.active and job.room != current_room:
+            collect_generation(job, watched=False)
+
+# ===========================
+# MODEL COMPARISON
+# ===========================
+def compare_model_worker(model, headers, payload, events, cancel_event):
+    """Jalankan satu model di thread pool; kirim event (model, jenis, data) ke queue"""
+    started = time.monotonic()
+    first_token_at = None
+    usage = None
+    parts = []
+    try:
+        on_wait = lambda status: events.put((model, "waiting", status))
+        with upstream_slot(headers, payload, on_wait=on_wait), \
+                get_http_client().post_chat(headers, payload, stream=True) as response:
+            for delta, chunk_usage in iter_stream_chunks(response):
+                if cancel_event.is_set():
+                    break
+                if chunk_usage:
+                    usage = chunk_usage
+                if delta:
+                    if first_token_at is None:
+                        first_token_at = time.monotonic()
+                    parts.append(delta)
+                    events.put((model, "delta", delta))
+    except UpstreamBusyError as e:
+        events.put((model, "error", str(e)))
+        return
+    except Exception as e:
+        get_model_health().record_failure(model)
+        events.put((model, "error", str(e)))
+        return
+    
+    finished = time.monotonic()
+    if first_token_at is not None:
+        get_model_health().record_success(model, first_token_at - started)
+    text = "".join(parts)
+    completion_tokens = (usage or {}).get("completion_tokens") or count_tokens(text)
+    generation_time = finished - (first_token_at or started)
+    events.put((model, "done", {
+        "latency": finished - started,
+        "ttft": (first_token_at - started) if first_token_at else None,
+        "prompt_tokens": (usage or {}).get("prompt_tokens"),
+        "completion_tokens": completion_tokens,
+        "tokens_per_sec": completion_tokens / generation_time if generation_time > 0 else None,
+        "usage_reported": usage is not None,
+        "usage": usage,
+    }))
+
+def use_compared_model(model):
+    """Callback tombol 'Pakai model ini' (tetap jalan walau tombol tidak dirender ulang)"""
+    st.session_state.selected_model = model
+    st.session_state.compare_mode = False
+    st.session_state.rerun_app = True  # Sidebar (model & toggle) ada di luar fragment chat pane
+
+def run_model_comparison(prompt, models):
+    """Kirim satu prompt ke beberapa model secara paralel, stream hasil ke kolom masing-masing"""
+    api_key = get_api_key()
+    if not api_key:
+        show_error_message("API key tidak ditemukan. Silakan masukkan API key di sidebar.")
+        return
+    
+    available_models = get_available_models()
+    headers, base_payload = build_api_request(prompt, stream=True)
+    
+    columns = st.columns(len(models))
+    containers = {}
+    texts = {}
+    last_render = {}
+    for column, model in zip(columns, models):
+        with column:
+            st.markdown(f"**{available_models.get(model, model)}**")
+            containers[model] = st.empty()
+            with containers[model]:
+                show_thinking_animation()
+        texts[model] = ""
+        last_render[model] = 0.0
+    
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=len(models), thread_name_prefix="compare")
+    try:
+        for model in models:
+            payload = payload_for_model(base_payload, model)
+            executor.submit(compare_model_worker, model, headers, payload, events, cancel_event)
+        
+        # Hanya thread script yang boleh menyentuh elemen Streamlit: worker cukup mengisi queue
+        while len(results) < len(models):
+            try:
+                model, kind, data = events.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if kind == "waiting":
+                with containers[model]:
+                    show_thinking_animation(data)
+            elif kind == "delta":
+                texts[model] += data
+                now = time.monotonic()
+                if now - last_render[model] >= STREAM_RENDER_INTERVAL:
+                    containers[model].markdown(f"{texts[model]}▌")
+                    last_render[model] = now
+            elif kind == "error":
+                results[model] = {"error": data}
+                containers[model].error(f"❌ {data}")
             else:
-                show_error_message("Gagal mendapat respons. Coba lagi.")
+                results[model] = data
+                containers[model].markdown(texts[model])
+    finally:
+        # Rerun di tengah perbandingan: hentikan worker yang masih streaming
+        cancel_event.set()
+        executor.shutdown(wait=False)
+    
+    role = st.session_state.current_role
+    for column, model in zip(columns, models):
+        result = results[model]
+        st.session_state.compare_results.append(dict(
+            result, model=model, role=role, ts=datetime.now().isoformat(timespec="seconds")))
+        if "error" in result:
+            continue
+        with column:
+            record_usage(result.pop("usage"), model)
+            ttft = f"{result['ttft']:.2f}s" if result["ttft"] is not None else "-"
+            tps = f"{result['tokens_per_sec']:.1f}" if result["tokens_per_sec"] else "-"
+            approx = "" if result["usage_reported"] else "~"
+            st.markdown(f"""
+            <div class="param-display" style="font-size: 0.8rem;">
+                ⏱️ {result['latency']:.2f}s | ⚡ TTFT {ttft} | 📝 {approx}{result['completion_tokens']} tokens | 🚀 {tps} tok/s
+            </div>
+            """, unsafe_allow_html=True)
+            st.button("✅ Pakai model ini", key=f"use_compare_{model}",
+                      on_click=use_compared_model, args=(model,))
+
+def summarize_compare_results():
+    """Rata-rata latency, TTFT dan throughput per (role, model) dari semua perbandingan"""
+    summary = {}
+    for result in st.session_state.compare_results:
+        key = (result["role"], result["model"])
+        row = summary.setdefault(key, {"runs": 0, "errors": 0, "latency": [], "ttft": [], "tokens_per_sec": [],
+                                       "completion_tokens": []})
+        row["runs"] += 1
+        if "error" in result:
+            row["errors"] += 1
+            continue
+        for field in ("latency", "ttft", "tokens_per_sec", "completion_tokens"):
+            if result.get(field) is not None:
+                row[field].append(result[field])
+    
+    role_configs = get_role_configs()
+    rows = []
+    for (role, model), row in summary.items():
+        average = lambda values: round(sum(values) / len(values), 2) if values else None
+        rows.append({
+            "Role": role_configs[role].name if role in role_configs else role,
+            "Model": model,
+            "Runs": row["runs"],
+            "Error": row["errors"],
+            "Latency (s)": average(row["latency"]),
+            "TTFT (s)": average(row["ttft"]),
+            "Tokens/s": average(row["tokens_per_sec"]),
+            "Tokens": average(row["completion_tokens"]),
+        })
+    rows.sort(key=lambda r: (r["Role"], r["Latency (s)"] if r["Latency (s)"] is not None else float("inf")))
+    return rows
+
+def reset_compare_results():
+    st.session_state.compare_results = []
+
+def render_compare_results():
+    """Tabel ringkasan hasil perbandingan model di sesi ini"""
+    if not st.session_state.compare_results:
+        return
+    with st.expander("📈 Hasil perbandingan model", expanded=False):
+        st.dataframe(summarize_compare_results(), use_container_width=True, hide_index=True)
+        st.button("🗑️ Reset hasil perbandingan", key="reset_compare", on_click=reset_compare_results)
 
 # ===========================
 # MAIN APPLICATION
 # ===========================
+@st.fragment
+def render_chat_pane():
+    """Fragment riwayat + input chat: kirim pesan hanya merender ulang pane ini, bukan sidebar"""
+    if st.session_state.pop("rerun_app", False):
+        st.rerun()
+    sync_registry_selection()
+    collect_finished_generations()
+    render_notifications()
+    render_welcome_message()
+    with timed_render("chat_history"):
+        render_chat_history()
+    handle_chat()
+    render_compare_results()
+
 def main():
     """Fungsi aplikasi utama"""
     configure_page()
     initialize_session_state()
+    sync_registry_selection()  # Cek hot reload file registry di awal run
+    render_notifications()
+    registry_error = get_registry_holder()["error"]
+    if registry_error:
+        st.sidebar.warning(f"⚠️ File registry tidak valid, memakai konfigurasi terakhir: {registry_error}")
+    
+    st.session_state.render_timings = {}  # Durasi bagian rerun ini
     
     # Render sidebar
-    render_sidebar()
+    with timed_render("sidebar"):
+        render_sidebar()
     
     # Check login status
     if not st.session_state.is_logged_in:
@@ -1216,9 +3890,7 @@ def main():
     
     # Main content dengan animasi
     render_header()
-    render_welcome_message()
-    render_chat_history()
-    handle_chat()
+    render_chat_pane()
     
     # Animated Footer
     st.markdown("---")
@@ -0,0 +1,208 @@
+"""Server OpenRouter palsu untuk benchmark dan uji lokal (tanpa API key dan kuota).
+
+Contoh:
+    python mock_openrouter.py --port 8765 --latency 0.2 --tokens-per-sec 80 --error-rate 0.05
+
+Lalu arahkan app ke server ini lewat .streamlit/secrets.toml:
+    openrouter_base_url = "http://127.0.0.1:8765/api/v1"
+
+Hanya endpoint POST /chat/completions (streaming SSE dan non-streaming) yang
+ditiru, lengkap dengan usage (termasuk cached_tokens untuk pesan bertanda
+cache_control) sehingga seluruh jalur app bisa diukur tanpa jaringan.
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_WORDS = (
+    "halo", "ini", "jawaban", "dari", "model", "palsu", "untuk", "benchmark",
+    "latency", "streaming", "token", "dan", "throughput", "aplikasi", "chat", "AI",
+)
+
+@dataclass(frozen=True, slots=True)
+class MockConfig:
+    """Perilaku server palsu: latency, kecepatan token, dan injeksi error"""
+    latency: float = 0.1            # detik sebelum byte pertama (TTFB)
+    tokens_per_sec: float = 100.0   # kecepatan generate; 0 = semua token langsung
+    completion_tokens: int = 64     # panjang jawaban (dibatasi max_tokens request)
+    error_rate: float = 0.0         # peluang request dijawab error_status
+    error_status: int = 500
+    retry_after: float = None       # header Retry-After untuk error 429
+    seed: int = None                # seed RNG injeksi error agar run bisa diulang
+
+def estimate_tokens(content):
+    """Perkiraan kasar jumlah token (4 karakter per token) untuk string atau content part"""
+    if isinstance(content, list):
+        return sum(estimate_tokens(part.get("text", "")) for part in content)
+    return max(1, len(content or "") // 4)
+
+def count_cached_tokens(messages):
+    """Token dari content part yang ditandai cache_control (meniru prompt caching provider)"""
+    cached = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            cached += sum(estimate_tokens(part.get("text", "")) for part in content if part.get("cache_control"))
+    return cached
+
+class MockOpenRouterHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, data, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def do_POST(self):
+        config = self.server.config
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.endswith("/chat/completions"):
+            self.send_json(404, {"error": {"message": f"Endpoint {self.path} tidak ada di mock"}})
+            return
+        self.server.count("requests")
+
+        if self.server.should_fail():
+            self.server.count("errors")
+            headers = {}
+            if config.error_status == 429 and config.retry_after is not None:
+                headers["Retry-After"] = str(config.retry_after)
+            self.send_json(config.error_status, {"error": {"message": "Injected error dari mock", "code": config.error_status}},
+                           headers)
+            return
+
+        messages = payload.get("messages") or []
+        prompt_tokens = sum(estimate_tokens(message.get("content")) for message in messages)
+        completion_tokens = min(config.completion_tokens, int(payload.get("max_tokens") or config.completion_tokens))
+        words = [MOCK_WORDS[i % len(MOCK_WORDS)] for i in range(completion_tokens)]
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "cost": 0.0,
+            "prompt_tokens_details": {"cached_tokens": count_cached_tokens(messages)},
+        }
+        token_delay = 1.0 / config.tokens_per_sec if config.tokens_per_sec > 0 else 0.0
+        time.sleep(config.latency)
+
+        if not payload.get("stream"):
+            time.sleep(token_delay * completion_tokens)
+            self.send_json(200, {
+                "id": f"mock-{time.monotonic_ns()}",
+                "model": payload.get("model"),
+                "choices": [{"message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        self.server.count("streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            self.write_chunk(": OPENROUTER PROCESSING\n\n")
+            for i, word in enumerate(words):
+                delta = {"choices": [{"delta": {"content": word if i == 0 else f" {word}"}}]}
+                self.write_chunk(f"data: {json.dumps(delta)}\n\n")
+                if token_delay:
+                    time.sleep(token_delay)
+            final = {"choices": [{"delta": {}, "finish_reason": "stop"}], "usage": usage}
+            self.write_chunk(f"data: {json.dumps(final)}\n\n")
+            self.write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # Client membatalkan stream (cancel/hedging), bukan error server
+            self.server.count("cancelled")
+            self.close_connection = True
+
+class MockOpenRouterServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer dengan MockConfig dan counter request"""
+    daemon_threads = True
+
+    def __init__(self, address, config):
+        super().__init__(address, MockOpenRouterHandler)
+        self.config = config
+        self._random = random.Random(config.seed)
+        self._lock = threading.Lock()
+        self._metrics = {"requests": 0, "streams": 0, "errors": 0, "cancelled": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/v1"
+
+    def handle_error(self, request, client_address):
+        # Client menutup koneksi keep-alive/stream lebih dulu: normal, jangan cetak traceback
+        if isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+    def count(self, key):
+        with self._lock:
+            self._metrics[key] += 1
+
+    def should_fail(self):
+        with self._lock:
+            return self._random.random() < self.config.error_rate
+
+    def stats(self):
+        with self._lock:
+            return dict(self._metrics)
+
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    """Jalankan mock di thread daemon; port 0 = pilih port kosong. Return server (server.base_url)"""
+    server = MockOpenRouterServer((host, port), config or MockConfig())
+    threading.Thread(target=server.serve_forever, name="mock-openrouter", daemon=True).start()
+    return server
+
+def add_mock_arguments(parser):
+    """Argumen CLI MockConfig (dipakai juga oleh benchmark.py)"""
+    defaults = MockConfig()
+    parser.add_argument("--latency", type=float, default=defaults.latency, help="Detik sebelum byte pertama")
+    parser.add_argument("--tokens-per-sec", type=float, default=defaults.tokens_per_sec,
+                        help="Kecepatan token (0 = langsung)")
+    parser.add_argument("--completion-tokens", type=int, default=defaults.completion_tokens,
+                        help="Panjang jawaban dalam token")
+    parser.add_argument("--error-rate", type=float, default=defaults.error_rate, help="Peluang error per request (0-1)")
+    parser.add_argument("--error-status", type=int, default=defaults.error_status, help="Status HTTP error yang diinjeksi")
+    parser.add_argument("--retry-after", type=float, default=defaults.retry_after, help="Header Retry-After untuk 429")
+    parser.add_argument("--seed", type=int, default=defaults.seed, help="Seed RNG injeksi error")
+
+def mock_config_from_args(args):
+    return MockConfig(**{name: getattr(args, name) for name in asdict(MockConfig())})
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Server OpenRouter palsu untuk benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_mock_arguments(parser)
+    args = parser.parse_args(argv)
+    server = MockOpenRouterServer((args.host, args.port), mock_config_from_args(args))
+    print(f"Mock OpenRouter di {server.base_url} ({asdict(server.config)})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Total usage API per room dan per user disimpan di storage chatroom (bertahan saat restart)"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from final_project import MemoryChatStorage, SQLiteChatStorage  # noqa: E402
+
+USAGE = {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15, "cached_tokens": 2, "cost": 0.5}
+
+
+def test_sqlite_usage_survives_reopen_rename_and_delete(tmp_path):
+    path = str(tmp_path / "chatrooms.db")
+    storage = SQLiteChatStorage(path)
+    storage.ensure_room("alice", "A")
+    storage.add_usage("alice", "A", USAGE)
+    storage.add_usage("alice", "A", USAGE)
+
+    reopened = SQLiteChatStorage(path)
+    assert reopened.usage_totals("alice", "A")["total_tokens"] == 30
+    assert reopened.usage_totals("alice")["requests"] == 2
+
+    reopened.rename_room("alice", "A", "B")
+    assert reopened.usage_totals("alice", "B")["cost"] == 1.0
+    reopened.delete_room("alice", "B")
+    assert reopened.usage_totals("alice", "B")["requests"] == 0
+    # Total user tetap mencakup biaya room yang dihapus
+    assert reopened.usage_totals("alice")["cached_tokens"] == 4
+    assert reopened.usage_totals("bob")["requests"] == 0
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_usage_for_missing_room_only_counts_user(backend, tmp_path):
+    storage = MemoryChatStorage() if backend == "memory" else SQLiteChatStorage(str(tmp_path / "chatrooms.db"))
+    # Job yang selesai setelah room-nya dihapus tidak boleh menghidupkan room itu lagi
+    storage.add_usage("alice", "Hilang", USAGE)
+    assert "Hilang" not in storage.room_stats("alice")
+    assert storage.usage_totals("alice", "Hilang")["requests"] == 0
+    assert storage.usage_totals("alice")["requests"] == 1
+    storage.ensure_room("alice", "A")
+    storage.add_usage("alice", "A", USAGE)
+    storage.rename_room("alice", "A", "B")
+    assert storage.usage_totals("alice", "B")["total_tokens"] == 15